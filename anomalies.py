@@ -0,0 +1,225 @@
+import math
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from flask import current_app
+from sqlalchemy import Float, and_, case, cast, event, func, select
+from app import db
+from models import Category, CategorySpendStats, SpendingAnomaly, Transaction
+from utils import BASE_AMOUNT, _bucket_start, _bucket_date, _insert_ignoring_conflicts
+
+# Idle weeks folded into the weekly statistics at most; by then an idle category's weekly mean is near zero anyway
+MAX_IDLE_WEEKS = 52
+
+STATS_FIELDS = ('count', 'mean', 'variance', 'week_start', 'week_spent', 'week_flagged', 'weeks', 'weekly_mean',
+                'weekly_variance')
+
+def _ewma_update(mean, variance, count, value, alpha):
+    """Fold value into an exponentially weighted mean and variance; the first value starts them"""
+    if count == 0:
+        return value, 0.0
+    diff = value - mean
+    increment = alpha * diff
+    return mean + increment, (1 - alpha) * (variance + diff * increment)
+
+def _z_score(value, mean, variance):
+    # The deviation has a floor, so after a run of identical amounts a small change is not an outlier
+    deviation = max(math.sqrt(variance), abs(mean) * 0.1, 1.0)
+    return (value - mean) / deviation
+
+def _week_start(day):
+    return day - timedelta(days=day.weekday())
+
+def _fold_week(stats, spent, alpha):
+    stats['weekly_mean'], stats['weekly_variance'] = _ewma_update(
+        stats['weekly_mean'], stats['weekly_variance'], stats['weeks'], spent, alpha
+    )
+    stats['weeks'] += 1
+
+def _advance_week(stats, week, alpha):
+    """Close the accumulated week and any idle weeks before `week`, then start accumulating `week`"""
+    if stats['week_start'] is not None:
+        _fold_week(stats, stats['week_spent'], alpha)
+        idle_weeks = (week - stats['week_start']).days // 7 - 1
+        for _ in range(min(idle_weeks, MAX_IDLE_WEEKS)):
+            _fold_week(stats, 0.0, alpha)
+    stats['week_start'] = week
+    stats['week_spent'] = 0.0
+    stats['week_flagged'] = False
+
+def _anomaly(transaction, kind, amount, mean, z_score):
+    return {
+        'user_id': transaction.user_id,
+        'transaction_id': transaction.id,
+        'category_id': transaction.category_id,
+        'kind': kind,
+        'amount': Decimal(str(round(amount, 2))),
+        'expected': Decimal(str(round(mean, 2))),
+        'z_score': z_score,
+        'created_at': datetime.now()
+    }
+
+def _load_stats(conn, user_id, category_id):
+    """The statistics row for update, created empty if missing"""
+    table = CategorySpendStats.__table__
+    key = and_(table.c.user_id == user_id, table.c.category_id == category_id)
+    query = select(*(table.c[field] for field in STATS_FIELDS)).where(key).with_for_update()
+    row = conn.execute(query).first()
+    if row is None:
+        _insert_ignoring_conflicts(conn, table, {
+            'user_id': user_id, 'category_id': category_id, 'count': 0, 'mean': 0, 'variance': 0,
+            'week_spent': 0, 'week_flagged': False, 'weeks': 0, 'weekly_mean': 0, 'weekly_variance': 0
+        })
+        row = conn.execute(query).first()
+    return dict(row._mapping)
+
+@event.listens_for(db.session, 'after_flush')
+def track_spending_anomalies(session, flush_context):
+    """Fold each new expense into its category's running statistics, and flag it when the amount,
+    or its week's spend so far, is an outlier against the statistics before it.
+    
+    The update is constant time per expense. Edits and deletions are not unwound; the
+    weights of older expenses fade, and `flask backfill-anomaly-stats` rebuilds from history.
+    """
+    new = [obj for obj in session.new
+           if isinstance(obj, Transaction) and obj.transaction_type == 'expense' and obj.category_id]
+    deleted_ids = [obj.id for obj in session.deleted if isinstance(obj, Transaction)]
+    if not (new or deleted_ids):
+        return
+    conn = session.connection()
+    anomalies = SpendingAnomaly.__table__
+    if deleted_ids:
+        conn.execute(anomalies.delete().where(anomalies.c.transaction_id.in_(deleted_ids)))
+    if not new:
+        return
+    
+    config = current_app.config
+    alpha, weekly_alpha = config['ANOMALY_ALPHA'], config['ANOMALY_WEEKLY_ALPHA']
+    min_samples, threshold = config['ANOMALY_MIN_SAMPLES'], config['ANOMALY_Z_THRESHOLD']
+    
+    stats_by_key, flagged = {}, []
+    for transaction in sorted(new, key=lambda t: (t.transaction_date, t.id)):
+        key = (transaction.user_id, transaction.category_id)
+        if key not in stats_by_key:
+            stats_by_key[key] = _load_stats(conn, *key)
+        stats = stats_by_key[key]
+        value = float(transaction.base_amount if transaction.base_amount is not None else transaction.amount)
+        
+        if stats['count'] >= min_samples:
+            z_score = _z_score(value, stats['mean'], stats['variance'])
+            if z_score >= threshold:
+                flagged.append(_anomaly(transaction, 'amount', value, stats['mean'], z_score))
+        stats['mean'], stats['variance'] = _ewma_update(stats['mean'], stats['variance'], stats['count'], value, alpha)
+        stats['count'] += 1
+        
+        # Back-dated expenses count towards the amount statistics only
+        week = _week_start(transaction.transaction_date)
+        if stats['week_start'] is None or week > stats['week_start']:
+            _advance_week(stats, week, weekly_alpha)
+        if week == stats['week_start']:
+            stats['week_spent'] += value
+            if stats['weeks'] >= min_samples and not stats['week_flagged']:
+                z_score = _z_score(stats['week_spent'], stats['weekly_mean'], stats['weekly_variance'])
+                if z_score >= threshold:
+                    flagged.append(_anomaly(transaction, 'weekly', stats['week_spent'], stats['weekly_mean'], z_score))
+                    stats['week_flagged'] = True
+    
+    table = CategorySpendStats.__table__
+    for (user_id, category_id), stats in stats_by_key.items():
+        conn.execute(table.update().where(table.c.user_id == user_id, table.c.category_id == category_id).values(**stats))
+    if flagged:
+        conn.execute(anomalies.insert(), flagged)
+
+def backfill_stats(user_ids, today=None):
+    """Rebuild the statistics of these users from their whole expense history; returns the rows written.
+    
+    The exponentially weighted mean and variance are written as sums over each category's expenses
+    weighted by their rank, so two set-based queries give what replaying every expense through
+    the running update would.
+    """
+    today = today or date.today()
+    config = current_app.config
+    alpha, weekly_alpha = config['ANOMALY_ALPHA'], config['ANOMALY_WEEKLY_ALPHA']
+    expenses = and_(
+        Transaction.user_id.in_(user_ids),
+        Transaction.transaction_type == 'expense',
+        Transaction.category_id.isnot(None)
+    )
+    
+    partition = (Transaction.user_id, Transaction.category_id)
+    ranked = select(
+        Transaction.user_id,
+        Transaction.category_id,
+        cast(BASE_AMOUNT, Float).label('amount'),
+        (func.row_number().over(partition_by=partition, order_by=(Transaction.transaction_date.desc(),
+                                                                  Transaction.id.desc())) - 1).label('age'),
+        func.count().over(partition_by=partition).label('n')
+    ).where(expenses).subquery()
+    # The running mean started at the oldest expense weighs the one `age` places back alpha * (1 - alpha)^age,
+    # except the oldest, which keeps (1 - alpha)^age
+    weight = case(
+        (ranked.c.age == ranked.c.n - 1, func.power(1 - alpha, ranked.c.age)),
+        else_=alpha * func.power(1 - alpha, ranked.c.age)
+    )
+    means = select(
+        ranked.c.user_id, ranked.c.category_id,
+        func.max(ranked.c.n).label('count'),
+        func.sum(weight * ranked.c.amount).label('mean')
+    ).group_by(ranked.c.user_id, ranked.c.category_id).subquery()
+    deviation = ranked.c.amount - means.c.mean
+    amount_stats = db.session.execute(select(
+        means.c.user_id, means.c.category_id, means.c.count, means.c.mean,
+        func.sum(weight * deviation * deviation).label('variance')
+    ).join(means, and_(means.c.user_id == ranked.c.user_id, means.c.category_id == ranked.c.category_id))
+     .group_by(means.c.user_id, means.c.category_id, means.c.count, means.c.mean)).all()
+    
+    # Weekly totals come grouped from the database; only weeks are folded here
+    week = _bucket_start('week', Transaction.transaction_date)
+    weekly = {}
+    for user_id, category_id, week_start, spent in db.session.execute(
+        select(Transaction.user_id, Transaction.category_id, week, func.sum(cast(BASE_AMOUNT, Float)))
+        .where(expenses).group_by(Transaction.user_id, Transaction.category_id, week)
+    ):
+        weekly.setdefault((user_id, category_id), {})[_bucket_date(week_start)] = spent or 0.0
+    
+    rows = []
+    current_week = _week_start(today)
+    for user_id, category_id, count, mean, variance in amount_stats:
+        stats = {'count': count, 'mean': mean or 0.0, 'variance': max(variance or 0.0, 0.0), 'week_start': None,
+                 'week_spent': 0.0, 'week_flagged': False, 'weeks': 0, 'weekly_mean': 0.0, 'weekly_variance': 0.0}
+        totals = weekly.get((user_id, category_id), {})
+        for week_start in sorted(totals):
+            if week_start > current_week:
+                break
+            if stats['week_start'] is None or week_start > stats['week_start']:
+                _advance_week(stats, week_start, weekly_alpha)
+            stats['week_spent'] = totals[week_start]
+        if stats['week_start'] is not None and stats['week_start'] < current_week:
+            _advance_week(stats, current_week, weekly_alpha)
+        rows.append(dict(stats, user_id=user_id, category_id=category_id))
+    
+    table = CategorySpendStats.__table__
+    db.session.execute(table.delete().where(table.c.user_id.in_(user_ids)))
+    if rows:
+        db.session.execute(table.insert(), rows)
+    db.session.commit()
+    return len(rows)
+
+def get_spending_anomalies(user_id, since=None, limit=50):
+    """A user's flagged expenses, newest first, optionally only those flagged after `since`"""
+    query = db.session.query(
+        SpendingAnomaly.id,
+        SpendingAnomaly.kind,
+        SpendingAnomaly.amount,
+        SpendingAnomaly.expected,
+        SpendingAnomaly.z_score,
+        SpendingAnomaly.created_at,
+        Transaction.id.label('transaction_id'),
+        Transaction.transaction_date,
+        Transaction.description,
+        Category.name.label('category')
+    ).join(Transaction, Transaction.id == SpendingAnomaly.transaction_id)\
+    .outerjoin(Category, Category.id == SpendingAnomaly.category_id)\
+    .filter(SpendingAnomaly.user_id == user_id)
+    if since is not None:
+        query = query.filter(SpendingAnomaly.created_at > since)
+    return query.order_by(SpendingAnomaly.created_at.desc(), SpendingAnomaly.id.desc()).limit(limit).all()
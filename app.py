@@ -4,6 +4,8 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
+from replica import RoutingSession
+from db_pool import engine_options_from_env, instrument_engines
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -11,7 +13,7 @@ logging.basicConfig(level=logging.DEBUG)
 class Base(DeclarativeBase):
     pass
 
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={"class_": RoutingSession})
 
 # Create the app
 app = Flask(__name__)
@@ -20,16 +22,112 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 # Configure the database
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
+# Pool sizing and timeouts come from DB_* environment variables (see db_pool.py)
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options_from_env(app.config["SQLALCHEMY_DATABASE_URI"])
+
+# Optional read replica for report and chart queries (see replica.py); for local
+# testing this can point at a second Postgres instance or a copy of a SQLite file
+if os.environ.get("DATABASE_REPLICA_URL"):
+    app.config["SQLALCHEMY_BINDS"] = {"replica": os.environ["DATABASE_REPLICA_URL"]}
+
+# Currency that all aggregates (net worth, trends, budgets) are reported in
+app.config["BASE_CURRENCY"] = os.environ.get("BASE_CURRENCY", "USD")
+
+# Maximum number of transactions accepted by one /api/transactions/batch request
+app.config["BATCH_MAX_TRANSACTIONS"] = int(os.environ.get("BATCH_MAX_TRANSACTIONS", "200"))
+
+# Seconds to wait after the last write before recomputing a user's health score
+app.config["HEALTH_SCORE_DEBOUNCE_SECONDS"] = float(os.environ.get("HEALTH_SCORE_DEBOUNCE_SECONDS", "5"))
+
+# Percentages of a budget at which an alert email is sent as this month's spending crosses them
+app.config["BUDGET_ALERT_THRESHOLDS"] = sorted(
+    int(percent) for percent in os.environ.get("BUDGET_ALERT_THRESHOLDS", "80,100,120").split(",")
+)
+
+# A new transaction matching an existing one's account, type, amount and description within
+# this many days is treated as a duplicate (see duplicates.py); negative disables the check
+app.config["DUPLICATE_DATE_TOLERANCE_DAYS"] = int(os.environ.get("DUPLICATE_DATE_TOLERANCE_DAYS", "1"))
+
+# Spending anomalies (see anomalies.py): weight of the newest expense and week in the running
+# statistics, how many of each are needed before flagging, and the z-score flagged
+app.config["ANOMALY_ALPHA"] = float(os.environ.get("ANOMALY_ALPHA", "0.1"))
+app.config["ANOMALY_WEEKLY_ALPHA"] = float(os.environ.get("ANOMALY_WEEKLY_ALPHA", "0.2"))
+app.config["ANOMALY_MIN_SAMPLES"] = int(os.environ.get("ANOMALY_MIN_SAMPLES", "8"))
+app.config["ANOMALY_Z_THRESHOLD"] = float(os.environ.get("ANOMALY_Z_THRESHOLD", "3"))
+
+# Session storage: "cookie" (signed cookie, default), "db" or "filesystem" (see session_store.py)
+app.config["SESSION_BACKEND"] = os.environ.get("SESSION_BACKEND", "cookie")
+app.config["SESSION_FILE_DIR"] = os.environ.get("SESSION_FILE_DIR", os.path.join(app.instance_path, "sessions"))
+
+# Seconds a computed dashboard widget is served from the in-process cache
+app.config["WIDGET_CACHE_TTL"] = int(os.environ.get("WIDGET_CACHE_TTL", "300"))
+
+# Savings goal projections: completed months of contribution history fitted, and seconds they are cached
+app.config["GOAL_PROJECTION_MONTHS"] = int(os.environ.get("GOAL_PROJECTION_MONTHS", "12"))
+app.config["GOAL_PROJECTION_CACHE_SECONDS"] = int(os.environ.get("GOAL_PROJECTION_CACHE_SECONDS", "300"))
+
+# Most month ends /api/accounts/<id>/balance-history returns; longer ranges keep the latest ones
+app.config["BALANCE_HISTORY_MAX_MONTHS"] = int(os.environ.get("BALANCE_HISTORY_MAX_MONTHS", "1200"))
+
+# Most points per series returned by /api/timeseries, whatever the date range (see timeseries.py)
+app.config["TIMESERIES_MAX_POINTS"] = int(os.environ.get("TIMESERIES_MAX_POINTS", "2000"))
+# Most days /api/timeseries computes; longer ranges keep their last TIMESERIES_MAX_DAYS days
+app.config["TIMESERIES_MAX_DAYS"] = int(os.environ.get("TIMESERIES_MAX_DAYS", "36525"))
+
+# Years of transaction partitions kept ahead of today when transactions is partitioned (see partitions.py)
+app.config["TRANSACTION_PARTITIONS_AHEAD"] = int(os.environ.get("TRANSACTION_PARTITIONS_AHEAD", "1"))
+
+# Where `flask archive-transactions` writes compressed files of archived years (see archive.py)
+app.config["TRANSACTION_ARCHIVE_DIR"] = os.environ.get("TRANSACTION_ARCHIVE_DIR", os.path.join(app.instance_path, "archive"))
+
+# Prometheus metrics (see metrics.py): each process writes its values to METRICS_DIR every
+# METRICS_FLUSH_SECONDS and /metrics merges them, so any gunicorn worker can be scraped
+app.config["METRICS_DIR"] = os.environ.get("METRICS_DIR", os.path.join(app.instance_path, "metrics"))
+app.config["METRICS_FLUSH_SECONDS"] = float(os.environ.get("METRICS_FLUSH_SECONDS", "10"))
+
+# Background job queue (see jobs.py). Run `flask worker`, or let each web process
+# run a single-threaded worker with JOB_WORKER_EMBEDDED=1 (the default)
+app.config["JOB_WORKER_EMBEDDED"] = os.environ.get("JOB_WORKER_EMBEDDED", "1") == "1"
+app.config["JOB_POLL_INTERVAL"] = float(os.environ.get("JOB_POLL_INTERVAL", "1"))
+app.config["JOB_MAX_ATTEMPTS"] = int(os.environ.get("JOB_MAX_ATTEMPTS", "5"))
+app.config["JOB_RETRY_BASE_SECONDS"] = float(os.environ.get("JOB_RETRY_BASE_SECONDS", "10"))
+app.config["JOB_LOCK_TIMEOUT"] = int(os.environ.get("JOB_LOCK_TIMEOUT", "600"))
+app.config["JOB_RETENTION_DAYS"] = int(os.environ.get("JOB_RETENTION_DAYS", "7"))
+
+# Voice uploads: identical recordings within this window reuse the earlier result, and
+# each user gets a token bucket of OpenAI calls per worker process
+app.config["VOICE_RESULT_CACHE_SECONDS"] = int(os.environ.get("VOICE_RESULT_CACHE_SECONDS", "120"))
+app.config["VOICE_RATE_LIMIT_PER_MINUTE"] = float(os.environ.get("VOICE_RATE_LIMIT_PER_MINUTE", "6"))
+app.config["VOICE_RATE_LIMIT_BURST"] = int(os.environ.get("VOICE_RATE_LIMIT_BURST", "3"))
+
+# Voice audio is decoded with ffmpeg (when installed) to 16 kHz mono with silence trimmed
+# before transcription. Uploads above VOICE_SPOOL_BYTES are buffered on disk.
+app.config["VOICE_PREPROCESS"] = os.environ.get("VOICE_PREPROCESS", "1") == "1"
+app.config["VOICE_MAX_UPLOAD_BYTES"] = int(os.environ.get("VOICE_MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+app.config["VOICE_SPOOL_BYTES"] = int(os.environ.get("VOICE_SPOOL_BYTES", str(1024 * 1024)))
+app.config["VOICE_MAX_SECONDS"] = int(os.environ.get("VOICE_MAX_SECONDS", "60"))
+app.config["VOICE_SILENCE_DB"] = float(os.environ.get("VOICE_SILENCE_DB", "-45"))
 
 # Initialize the app with the extension
 db.init_app(app)
 
 with app.app_context():
+    instrument_engines(db.engines)
+    
     # Import models to ensure tables are created
     import models  # noqa: F401
-    db.create_all()
+    import migrations
+    import partitions
+    import session_store
+    db.create_all(bind_key=None)  # primary only; a replica receives the schema by replication
+    migrations.add_missing_columns()
+    partitions.ensure_future_partitions(app.config["TRANSACTION_PARTITIONS_AHEAD"])
     logging.info("Database tables created")
+    
+    session_store.init_app(app, db)
+    
+    import metrics
+    metrics.init_app(app, db)
+    
+    import jobs
+    jobs.init_app(app)
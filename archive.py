@@ -0,0 +1,156 @@
+import csv
+import gzip
+import hashlib
+import logging
+import os
+from datetime import date, datetime
+from decimal import Decimal
+from sqlalchemy import and_, func
+from app import app, db
+from models import (Transaction, TransactionArchive, ArchivedAccountTotal, User, SyncTombstone, SpendingAnomaly,
+                    transaction_tags, signed_transaction_amount)
+import partitions
+
+# Columns of an archive file, in order; 'tags' holds comma-separated tag names
+ARCHIVE_FIELDS = ('id', 'account_id', 'category_id', 'amount', 'base_amount', 'description', 'transaction_date',
+                  'transaction_type', 'transfer_id', 'payment_method', 'notes', 'is_recurring', 'idempotency_key',
+                  'created_at', 'updated_at', 'tags')
+
+def archive_path(user_id, year):
+    # User ids come from the identity provider, so hash them into a safe file name
+    name = hashlib.sha256(user_id.encode()).hexdigest()[:32]
+    return os.path.join(app.config['TRANSACTION_ARCHIVE_DIR'], str(year), f'{name}.csv.gz')
+
+def _to_row(transaction):
+    row = {field: getattr(transaction, field) for field in ARCHIVE_FIELDS if field != 'tags'}
+    row['tags'] = [tag.name for tag in transaction.tags]
+    return row
+
+def _parse_row(row):
+    """Archive CSV row -> dict with the model's Python types"""
+    parsed = {field: row[field] or None for field in ARCHIVE_FIELDS}
+    for field in ('id', 'account_id', 'category_id'):
+        parsed[field] = int(row[field]) if row[field] else None
+    for field in ('amount', 'base_amount'):
+        parsed[field] = Decimal(row[field]) if row[field] else None
+    for field in ('created_at', 'updated_at'):
+        parsed[field] = datetime.fromisoformat(row[field]) if row[field] else None
+    parsed['transaction_date'] = date.fromisoformat(row['transaction_date'])
+    parsed['is_recurring'] = row['is_recurring'] == 'True'
+    parsed['tags'] = row['tags'].split(',') if row['tags'] else []
+    return parsed
+
+def read_archive_file(path):
+    with gzip.open(path, 'rt', newline='') as f:
+        for row in csv.DictReader(f):
+            yield _parse_row(row)
+
+def _write_archive_file(path, rows):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wt', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=ARCHIVE_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict(row, tags=','.join(row['tags'])))
+    os.replace(tmp_path, path)
+
+# Ids per DELETE, below the bind parameter limits of SQLite and PostgreSQL
+DELETE_BATCH_SIZE = 5000
+
+def archive_year(year):
+    """Move every transaction dated in `year` to per-user compressed CSV files.
+    
+    The year's balance change per account is kept in archived_account_totals, so
+    balances and net worth are unchanged. A partitioned table drops the year's
+    partition when it holds only the archived rows; otherwise the archived rows are
+    deleted by id, so a back-dated entry added meanwhile stays for the next run.
+    Archiving a year again merges into the existing files. Returns the rows archived.
+    """
+    in_year = and_(Transaction.transaction_date >= date(year, 1, 1), Transaction.transaction_date < date(year + 1, 1, 1))
+    user_ids = [user_id for (user_id,) in db.session.query(Transaction.user_id).filter(in_year).distinct()]
+    
+    archived = []
+    totals = {}  # account_id -> [balance, base_balance]
+    for user_id in user_ids:
+        # Locked until the commit, so a row cannot change between its archiving and its deletion
+        transactions = Transaction.query.filter(Transaction.user_id == user_id, in_year).with_for_update().all()
+        record = TransactionArchive.query.filter_by(user_id=user_id, year=year).first()
+        if record is None:
+            record = TransactionArchive(user_id=user_id, year=year)
+            db.session.add(record)
+        
+        # Rows still in the table are not in any total yet, even if an interrupted
+        # earlier run already wrote them to the file. SQLite can reuse the id of a
+        # deleted row, so rows are told apart by creation time as well.
+        rows = {(row['id'], row['created_at']): row for row in read_archive_file(record.path)} if record.path else {}
+        for transaction in transactions:
+            row = rows[transaction.id, transaction.created_at] = _to_row(transaction)
+            total = totals.setdefault(row['account_id'], [Decimal('0'), Decimal('0')])
+            total[0] += signed_transaction_amount(row['transaction_type'], row['amount'], row['transfer_id'])
+            total[1] += signed_transaction_amount(row['transaction_type'], row['base_amount'] or row['amount'],
+                                                  row['transfer_id'])
+        
+        record.path = archive_path(user_id, year)
+        _write_archive_file(record.path, sorted(rows.values(), key=lambda row: (row['transaction_date'], row['id'])))
+        record.row_count = len(rows)
+        record.archived_at = datetime.now()
+        archived.extend(transactions)
+    
+    for account_id, (balance, base_balance) in totals.items():
+        total = db.session.get(ArchivedAccountTotal, (account_id, year))
+        if total is None:
+            total = ArchivedAccountTotal(account_id=account_id, year=year, balance=0, base_balance=0)
+            db.session.add(total)
+        total.balance += balance
+        total.base_balance += base_balance
+    db.session.flush()
+    
+    conn = db.session.connection()
+    archived_ids = [transaction.id for transaction in archived]
+    batches = [archived_ids[i:i + DELETE_BATCH_SIZE] for i in range(0, len(archived_ids), DELETE_BATCH_SIZE)]
+    for batch in batches:
+        conn.execute(transaction_tags.delete().where(transaction_tags.c.transaction_id.in_(batch)))
+        conn.execute(SpendingAnomaly.__table__.delete().where(SpendingAnomaly.transaction_id.in_(batch)))
+    if not partitions.detach_partition(conn, year, len(archived_ids)):
+        deleted = sum(conn.execute(Transaction.__table__.delete().where(Transaction.id.in_(batch), in_year)).rowcount
+                      for batch in batches)
+        if deleted != len(archived_ids):
+            db.session.rollback()
+            raise RuntimeError(f"Archived {len(archived_ids)} transactions from {year} but deleted {deleted}")
+    # Sync clients drop archived transactions like deleted ones
+    if archived:
+        db.session.execute(SyncTombstone.__table__.insert(), [
+            {'user_id': transaction.user_id, 'entity': 'transactions', 'entity_id': transaction.id,
+             'deleted_at': datetime.now()}
+            for transaction in archived
+        ])
+    if user_ids:
+        # Bulk deletes skip the ORM hooks, so invalidate derived data here
+        conn.execute(
+            User.__table__.update()
+            .where(User.__table__.c.id.in_(user_ids))
+            .values(data_version=func.coalesce(User.__table__.c.data_version, 0) + 1)
+        )
+    db.session.commit()
+    for transaction in archived:
+        db.session.expunge(transaction)
+    logging.info(f"Archived {len(archived)} transactions from {year}")
+    return len(archived)
+
+def get_archived_years(user_id):
+    return {year for (year,) in db.session.query(TransactionArchive.year).filter_by(user_id=user_id)}
+
+def iter_archived_transactions(user_id, start_date=None, end_date=None):
+    """Archived transactions of a user as dicts, oldest first, read from the archive files on demand"""
+    query = TransactionArchive.query.filter_by(user_id=user_id)
+    if start_date:
+        query = query.filter(TransactionArchive.year >= start_date.year)
+    if end_date:
+        query = query.filter(TransactionArchive.year <= end_date.year)
+    
+    for record in query.order_by(TransactionArchive.year).all():
+        for row in read_archive_file(record.path):
+            if (start_date is None or row['transaction_date'] >= start_date) and \
+                    (end_date is None or row['transaction_date'] <= end_date):
+                yield row
@@ -0,0 +1,148 @@
+import hashlib
+import io
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import wave
+
+SAMPLE_RATE = 16000  # what Whisper resamples to anyway
+BYTES_PER_SECOND = SAMPLE_RATE * 2  # 16-bit mono PCM
+
+_stats_lock = threading.Lock()
+# Voice requests handled by this process, split by whether the audio was preprocessed,
+# so upload size and latency can be compared with and without it
+_stats = {
+    mode: {'requests': 0, 'bytes_in': 0, 'bytes_out': 0, 'preprocess_seconds': 0.0, 'transcribe_seconds': 0.0,
+           'total_seconds': 0.0}
+    for mode in ('preprocessed', 'original')
+}
+
+class AudioRejected(Exception):
+    """The recording is too large, too long, silent or not decodable; the message is shown to the user"""
+
+class SpooledUpload:
+    """A copy of an uploaded file, in memory up to `threshold` bytes and in a temporary file above.
+    
+    The content is hashed while it is copied. AudioRejected is raised past `max_bytes`.
+    """
+    
+    def __init__(self, stream, threshold, max_bytes, hasher=None, chunk_size=64 * 1024):
+        self.size = 0
+        self.hasher = hasher or hashlib.sha256()
+        self.path = None
+        self._buffer = io.BytesIO()
+        target = self._buffer
+        try:
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                self.size += len(chunk)
+                if self.size > max_bytes:
+                    raise AudioRejected(f'Recordings can be at most {max_bytes // (1024 * 1024)} MB')
+                self.hasher.update(chunk)
+                if self.path is None and self.size > threshold:
+                    # Move to disk, so large uploads do not sit in worker memory
+                    target = tempfile.NamedTemporaryFile(prefix='voice-', delete=False)
+                    self.path = target.name
+                    target.write(self._buffer.getvalue())
+                    self._buffer = None
+                target.write(chunk)
+        except BaseException:
+            self.close()
+            raise
+        finally:
+            if self.path is not None:
+                target.close()
+    
+    def open(self):
+        """A readable file object positioned at the start"""
+        if self.path is not None:
+            return open(self.path, 'rb')
+        return io.BytesIO(self._buffer.getvalue())
+    
+    def close(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+        self._buffer = None
+
+def _run_ffmpeg(args, data=None, timeout=30):
+    return subprocess.run(
+        [shutil.which('ffmpeg'), '-hide_banner', '-loglevel', 'error', *args],
+        input=data, stdin=None if data is not None else subprocess.DEVNULL,
+        capture_output=True, timeout=timeout
+    )
+
+def _silence_filter(threshold_db):
+    # RMS energy over short windows, trimmed from the start; reversing trims the end the same way
+    trim = f'silenceremove=start_periods=1:start_threshold={threshold_db}dB:start_silence=0.2:detection=rms'
+    return f'{trim},areverse,{trim},areverse'
+
+def _to_wav(pcm):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(pcm)
+    return buffer.getvalue()
+
+def preprocess(upload, max_seconds, silence_db=-45):
+    """Decode an upload to 16 kHz mono, trim leading and trailing silence and re-encode it compactly.
+    
+    Returns (filename, bytes, content type) for the transcription API, or None when
+    ffmpeg is not installed, in which case the original upload should be sent.
+    Raises AudioRejected for undecodable, silent or overlong recordings.
+    """
+    if shutil.which('ffmpeg') is None:
+        return None
+    started = time.monotonic()
+    
+    source = ['-i', upload.path] if upload.path else ['-i', 'pipe:0']
+    data = None if upload.path else upload.open().read()
+    # Decoding stops a little past the limit, so an hour-long upload costs no more than a long one
+    decoded = _run_ffmpeg(['-t', str(max_seconds * 2), *source, '-af', _silence_filter(silence_db),
+                           '-ac', '1', '-ar', str(SAMPLE_RATE), '-f', 's16le', 'pipe:1'], data)
+    if decoded.returncode != 0:
+        logging.warning(f"Could not decode voice upload: {decoded.stderr.decode(errors='replace')[-500:]}")
+        raise AudioRejected('Could not read the recording. Please try again.')
+    
+    pcm = decoded.stdout
+    seconds = len(pcm) / BYTES_PER_SECOND
+    if seconds < 0.1:
+        raise AudioRejected('No speech detected in the recording.')
+    if seconds > max_seconds:
+        raise AudioRejected(f'Recordings can be at most {max_seconds} seconds long.')
+    
+    encoded = _run_ffmpeg(['-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', '1', '-i', 'pipe:0',
+                           '-c:a', 'libopus', '-b:a', '24k', '-application', 'voip', '-f', 'ogg', 'pipe:1'], pcm)
+    if encoded.returncode == 0 and encoded.stdout:
+        audio = ('speech.ogg', encoded.stdout, 'audio/ogg')
+    else:
+        # ffmpeg builds without libopus still get resampled, trimmed audio
+        audio = ('speech.wav', _to_wav(pcm), 'audio/wav')
+    
+    logging.info(f"Voice upload {upload.size} bytes -> {len(audio[1])} bytes, {seconds:.1f}s of speech, "
+                 f"preprocessed in {(time.monotonic() - started) * 1000:.0f}ms")
+    return audio
+
+def record_request(preprocessed, bytes_in, bytes_out, preprocess_seconds, transcribe_seconds, total_seconds):
+    with _stats_lock:
+        stats = _stats['preprocessed' if preprocessed else 'original']
+        stats['requests'] += 1
+        stats['bytes_in'] += bytes_in
+        stats['bytes_out'] += bytes_out
+        stats['preprocess_seconds'] += preprocess_seconds
+        stats['transcribe_seconds'] += transcribe_seconds
+        stats['total_seconds'] += total_seconds
+
+def get_audio_stats():
+    """Per-request averages of this process's voice uploads, with and without preprocessing"""
+    with _stats_lock:
+        stats = {mode: dict(values) for mode, values in _stats.items()}
+    for values in stats.values():
+        requests = values['requests'] or 1
+        for name in ('bytes_in', 'bytes_out', 'preprocess_seconds', 'transcribe_seconds', 'total_seconds'):
+            values[f'avg_{name}'] = values[name] / requests
+    return stats
@@ -0,0 +1,99 @@
+import threading
+import time
+
+caches = {}  # name -> named TTLCache of this process, reported by /metrics
+
+class TTLCache:
+    """Small thread-safe in-process cache with per-entry expiry.
+    
+    Each worker process keeps its own copy, so keys must embed whatever makes an
+    entry stale (for example the user's data_version) rather than relying on
+    explicit invalidation across processes.
+    """
+    
+    def __init__(self, max_entries=10000, name=None):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+        if name:
+            caches[name] = self
+    
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+    
+    def set(self, key, value, ttl):
+        """Cache value under key for ttl seconds"""
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._evict()
+            self._entries[key] = (time.monotonic() + ttl, value)
+    
+    def get_or_set(self, key, compute, ttl):
+        """Return the cached value for key, computing and caching it on a miss.
+        
+        Returns (value, hit).
+        """
+        value = self.get(key)
+        if value is not None:
+            return value, True
+        value = compute()
+        self.set(key, value, ttl)
+        return value, False
+    
+    def _evict(self):
+        # Drop expired entries first; if still full, drop the oldest-expiring half
+        now = time.monotonic()
+        self._entries = {k: v for k, v in self._entries.items() if v[0] > now}
+        if len(self._entries) >= self.max_entries:
+            keep = sorted(self._entries.items(), key=lambda item: item[1][0])[len(self._entries) // 2:]
+            self._entries = dict(keep)
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class SingleFlight:
+    """Coalesce concurrent calls that share a key into one execution.
+    
+    The first caller runs the function; callers arriving while it runs wait and
+    get its result or exception. Like TTLCache this is per process.
+    """
+    
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+    
+    def do(self, key, compute):
+        """Return (value, shared), where shared is True if another caller computed the value"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+        
+        try:
+            call.value = compute()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value, False
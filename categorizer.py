@@ -0,0 +1,202 @@
+from collections import Counter, deque
+from sqlalchemy import func, or_, update
+from app import db
+from cache import TTLCache
+from models import Category, CategoryRule, Transaction
+from duplicates import normalize_description
+from utils import invalidate_derived_data
+import anomalies
+
+# Compiled matchers are keyed by a signature of the rules, so a rule change is picked up on the next
+# lookup; the expiry only bounds how long a process keeps matchers of users who went idle
+MATCHER_CACHE_SECONDS = 3600
+_matchers = TTLCache(max_entries=1000, name='category_rules')
+
+CATEGORIZED_TYPES = ('expense', 'income')
+
+class KeywordMatcher:
+    """Aho-Corasick automaton over whole-word keywords.
+    
+    Built from (pattern, value, rank) triples; match() scans a normalized text once, whatever
+    the number of keywords, and returns the value of the highest-ranked keyword found in it.
+    """
+    
+    def __init__(self, rules):
+        self._goto = [{}]
+        self._fail = [0]
+        self._best = [None]  # (rank, value) of the best keyword ending at each state
+        for pattern, value, rank in rules:
+            state = 0
+            # Spaces on both ends make keywords match whole words of the space-padded text
+            for char in f' {pattern} ':
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._best.append(None)
+                state = next_state
+            if self._best[state] is None or rank > self._best[state][0]:
+                self._best[state] = (rank, value)
+        
+        # Breadth first, so each state's failure state (its longest proper suffix that is also a
+        # keyword prefix) is complete before it; keywords ending there end here too
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[next_state] = fail
+                inherited, own = self._best[fail], self._best[next_state]
+                if inherited is not None and (own is None or inherited[0] > own[0]):
+                    self._best[next_state] = inherited
+    
+    def match(self, text):
+        """Value of the highest-ranked keyword occurring in text as whole words, or None"""
+        goto, fail, best = self._goto, self._fail, self._best
+        state, found = 0, None
+        for char in f' {text} ':
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            candidate = best[state]
+            if candidate is not None and (found is None or candidate[0] > found[0]):
+                found = candidate
+        return found[1] if found is not None else None
+
+def merchant_key(description):
+    """The words of a description without those containing digits (store numbers, dates, references),
+    so every variant of one merchant's description gives the same learned rule"""
+    return ' '.join(word for word in normalize_description(description).split()
+                    if not any(char.isdigit() for char in word))
+
+def _visible_rules(user_id):
+    return or_(CategoryRule.user_id == user_id, CategoryRule.user_id.is_(None))
+
+def _build_matchers(user_id):
+    # A user's rules outrank system rules, then longer (more specific) keywords win
+    rules = {}
+    for pattern, rule_user_id, category_id, category_type in db.session.query(
+        CategoryRule.pattern, CategoryRule.user_id, Category.id, Category.type
+    ).join(Category, Category.id == CategoryRule.category_id).filter(_visible_rules(user_id)):
+        rules.setdefault(category_type, []).append((pattern, category_id, (rule_user_id is not None, len(pattern))))
+    return {category_type: KeywordMatcher(type_rules) for category_type, type_rules in rules.items()}
+
+def get_matchers(user_id):
+    """Compiled matchers of a user's and the system rules, by category type.
+    
+    Only the rules' count and latest update are read on each call; the matchers are
+    compiled again when those change.
+    """
+    count, latest = db.session.query(func.count(CategoryRule.id), func.max(CategoryRule.updated_at))\
+        .filter(_visible_rules(user_id)).one()
+    matchers, _ = _matchers.get_or_set(('category_rules', user_id, count, latest),
+                                       lambda: _build_matchers(user_id), MATCHER_CACHE_SECONDS)
+    return matchers
+
+def categorize(user_id, description, transaction_type='expense', matchers=None):
+    """Category id the rules give a description of this transaction type, or None"""
+    matcher = (matchers if matchers is not None else get_matchers(user_id)).get(transaction_type)
+    if matcher is None or not description:
+        return None
+    return matcher.match(normalize_description(description))
+
+def categorize_transactions(user_ids=None, overwrite=False, batch_size=5000):
+    """Categorize stored income and expenses from the rules, in keyset batches of bulk UPDATEs.
+    
+    Only uncategorized transactions are changed unless overwrite. Derived data of the users
+    whose transactions changed is invalidated and their anomaly statistics rebuilt.
+    Returns the number of transactions changed.
+    """
+    changed = 0
+    changed_users = set()
+    matchers_by_user = {}
+    last_id = 0
+    while True:
+        query = db.session.query(
+            Transaction.id, Transaction.user_id, Transaction.description, Transaction.transaction_type,
+            Transaction.category_id
+        ).filter(Transaction.id > last_id, Transaction.transaction_type.in_(CATEGORIZED_TYPES))
+        if not overwrite:
+            query = query.filter(Transaction.category_id.is_(None))
+        if user_ids:
+            query = query.filter(Transaction.user_id.in_(user_ids))
+        rows = query.order_by(Transaction.id).limit(batch_size).all()
+        if not rows:
+            break
+        
+        updates = []
+        for transaction_id, user_id, description, transaction_type, category_id in rows:
+            if user_id not in matchers_by_user:
+                matchers_by_user[user_id] = get_matchers(user_id)
+            matched = categorize(user_id, description, transaction_type, matchers_by_user[user_id])
+            if matched is not None and matched != category_id:
+                updates.append({'id': transaction_id, 'category_id': matched})
+                changed_users.add(user_id)
+        if updates:
+            db.session.execute(update(Transaction), updates)
+        db.session.commit()
+        changed += len(updates)
+        last_id = rows[-1][0]
+    
+    if changed_users:
+        invalidate_derived_data(list(changed_users))
+        db.session.commit()
+        anomalies.backfill_stats(list(changed_users))
+    return changed
+
+def learn_rules(user_id, min_count=3, min_share=0.8):
+    """Add rules for merchants the user has categorized consistently.
+    
+    Descriptions are grouped by merchant_key; a merchant seen at least min_count times with
+    at least min_share of them in one category gets a learned rule for it, unless the rules
+    already give that category. Learned rules are updated as the user's choices change, but
+    manual rules are never replaced. Returns the number of rules added or changed.
+    """
+    counts = {}  # (transaction type, merchant) -> Counter of category ids
+    for description, transaction_type, category_id in db.session.query(
+        Transaction.description, Transaction.transaction_type, Transaction.category_id
+    ).filter(
+        Transaction.user_id == user_id,
+        Transaction.transaction_type.in_(CATEGORIZED_TYPES),
+        Transaction.category_id.isnot(None),
+        Transaction.description.isnot(None)
+    ).yield_per(1000):
+        merchant = merchant_key(description)
+        if merchant and len(merchant) <= 100:
+            counts.setdefault((transaction_type, merchant), Counter())[category_id] += 1
+    
+    categories = dict(db.session.query(Category.id, Category.type).filter(
+        (Category.user_id == user_id) | (Category.is_system == True)
+    ).all())
+    user_rules = {rule.pattern: rule for rule in CategoryRule.query.filter_by(user_id=user_id)}
+    matchers = get_matchers(user_id)
+    learned = set()
+    for (transaction_type, merchant), by_category in counts.items():
+        total = sum(by_category.values())
+        category_id, count = by_category.most_common(1)[0]
+        if total < min_count or count < min_share * total or categories.get(category_id) != transaction_type:
+            continue
+        # One rule per merchant; one used for both income and expenses keeps the first learned
+        if merchant in learned:
+            continue
+        if categorize(user_id, merchant, transaction_type, matchers) == category_id:
+            continue
+        rule = user_rules.get(merchant)
+        if rule is None:
+            rule = CategoryRule(user_id=user_id, pattern=merchant, category_id=category_id, source='learned')
+            db.session.add(rule)
+            user_rules[merchant] = rule
+        elif rule.source == 'learned':
+            rule.category_id = category_id
+        else:
+            continue
+        learned.add(merchant)
+    
+    db.session.commit()
+    return len(learned)
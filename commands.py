@@ -0,0 +1,251 @@
+import csv
+from datetime import date
+import click
+from app import app, db
+from models import Transaction, AccountBalanceCheckpoint, User, rebuild_category_closure
+from utils import set_transaction_tags, import_exchange_rates, reconvert_base_amounts
+import anomalies
+import archive
+import categorizer
+import duplicates
+import jobs
+import migrations
+import partitions
+import recompute
+
+@app.cli.command('migrate-tags')
+@click.option('--batch-size', default=500, show_default=True, help='Transactions to convert per commit')
+def migrate_tags(batch_size):
+    """Parse legacy free-text Transaction tags into the tags/transaction_tags tables"""
+    last_id = 0
+    migrated = 0
+    
+    while True:
+        # Keyset pagination keeps each batch an index range scan on the primary key
+        batch = Transaction.query.filter(
+            Transaction.id > last_id,
+            Transaction.legacy_tags.isnot(None),
+            Transaction.legacy_tags != ''
+        ).order_by(Transaction.id).limit(batch_size).all()
+        if not batch:
+            break
+        
+        for transaction in batch:
+            set_transaction_tags(transaction, transaction.legacy_tags)
+        db.session.commit()
+        
+        last_id = batch[-1].id
+        migrated += len(batch)
+        click.echo(f'Migrated tags for {migrated} transactions')
+    
+    click.echo(f'Done. {migrated} transactions migrated.')
+
+@app.cli.command('import-rates')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--reconvert/--no-reconvert', default=True, show_default=True,
+              help='Re-convert stored base amounts affected by changed rates')
+def import_rates(path, reconvert):
+    """Import exchange rates from a CSV file with date,currency,rate columns.
+    
+    Rates are units of BASE_CURRENCY per unit of currency, dates are YYYY-MM-DD.
+    """
+    with open(path, newline='') as f:
+        rows = [
+            (date.fromisoformat(row['date'].strip()), row['currency'].strip(), row['rate'].strip())
+            for row in csv.DictReader(f)
+        ]
+    
+    written, changed_since = import_exchange_rates(rows)
+    click.echo(f'Imported {written} of {len(rows)} rates')
+    
+    if reconvert:
+        for currency, since in sorted(changed_since.items()):
+            updated = reconvert_base_amounts(currency=currency, since=since)
+            click.echo(f'Re-converted {updated} {currency} transactions since {since}')
+
+@app.cli.command('reconvert-amounts')
+@click.option('--currency', help='Only accounts in this currency')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), help='Only transactions on or after this date')
+def reconvert_amounts(currency, since):
+    """Recompute stored base-currency amounts from the current exchange rates"""
+    updated = reconvert_base_amounts(
+        currency=currency.upper() if currency else None,
+        since=since.date() if since else None
+    )
+    click.echo(f'Re-converted {updated} transactions')
+
+@app.cli.command('sweep-sessions')
+def sweep_sessions():
+    """Delete expired server-side sessions"""
+    store = getattr(app.session_interface, 'store', None)
+    if store is None:
+        click.echo('SESSION_BACKEND is "cookie"; nothing to sweep')
+        return
+    click.echo(f'Removed {store.sweep()} expired sessions')
+
+@app.cli.command('rebuild-category-closure')
+def rebuild_category_closure_command():
+    """Recreate the category closure table from the category parent links"""
+    click.echo(f'Wrote {rebuild_category_closure()} category paths')
+
+@app.cli.command('reset-balance-checkpoints')
+def reset_balance_checkpoints():
+    """Drop all account balance checkpoints; they are rebuilt on the next balance lookup"""
+    deleted = AccountBalanceCheckpoint.query.delete()
+    db.session.commit()
+    click.echo(f'Deleted {deleted} balance checkpoints')
+
+@app.cli.command('partition-transactions')
+def partition_transactions_command():
+    """Convert transactions into a table partitioned by year (PostgreSQL only)"""
+    try:
+        copied = partitions.partition_transactions(app.config['TRANSACTION_PARTITIONS_AHEAD'])
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Partitioned transactions ({copied} rows copied)')
+
+@app.cli.command('create-partitions')
+def create_partitions():
+    """Create missing yearly partitions up to TRANSACTION_PARTITIONS_AHEAD years ahead"""
+    partitions.ensure_future_partitions(app.config['TRANSACTION_PARTITIONS_AHEAD'])
+    click.echo('Partitions are up to date')
+
+@app.cli.command('archive-transactions')
+@click.option('--before', 'before_year', type=int, required=True, help='Archive every year before this one')
+def archive_transactions(before_year):
+    """Move transactions of years before --before to compressed files in TRANSACTION_ARCHIVE_DIR"""
+    if before_year > date.today().year - 1:
+        raise click.ClickException('Only years before last year can be archived')
+    first_date = db.session.query(db.func.min(Transaction.transaction_date)).scalar()
+    if first_date is None:
+        click.echo('No transactions to archive')
+        return
+    for year in range(first_date.year, before_year):
+        click.echo(f'{year}: archived {archive.archive_year(year)} transactions')
+
+@app.cli.command('worker')
+@click.option('--concurrency', default=2, show_default=True, help='Jobs run at the same time')
+@click.option('--poll-interval', type=float, default=None, help='Seconds between polls when idle (default JOB_POLL_INTERVAL)')
+def worker(concurrency, poll_interval):
+    """Run background jobs until interrupted"""
+    click.echo(f'Worker started with {concurrency} threads')
+    jobs.Worker(app, concurrency, poll_interval or app.config['JOB_POLL_INTERVAL']).run()
+    click.echo('Worker stopped')
+
+@app.cli.command('job-stats')
+def job_stats():
+    """Show queued, running, done and failed job counts per task"""
+    stats = jobs.get_job_stats()
+    for name, counts in sorted(stats['queue'].items()):
+        click.echo(f"{name}: " + ', '.join(f'{status} {count}' for status, count in sorted(counts.items())))
+    click.echo(f"Oldest due job waiting {stats['oldest_due_seconds']:.0f}s")
+
+@app.cli.command('recompute')
+@click.argument('what', type=click.Choice(sorted(recompute.TARGETS)))
+@click.option('--users', help='Comma-separated user ids (default all users)')
+@click.option('--workers', default=4, show_default=True, help='Worker processes, each with its own connection pool')
+@click.option('--batch-size', default=50, show_default=True, help='Users handed to a worker at a time')
+@click.option('--rate', type=float, default=0, help='Maximum users per second across all workers (default unlimited)')
+@click.option('--verify', is_flag=True, help='Only compare stored values with a recomputation from transactions')
+@click.option('--restart', is_flag=True, help='Ignore the progress of an interrupted run')
+def recompute_command(what, users, workers, batch_size, rate, verify, restart):
+    """Rebuild or verify derived data: balance checkpoints, category rollups, health scores, base amounts
+    or budget spend counters.
+    
+    A full run can be interrupted and resumes with the users it has not finished.
+    """
+    user_ids = [user_id.strip() for user_id in users.split(',') if user_id.strip()] if users else None
+    summary = recompute.run(what, user_ids, workers=workers, batch_size=batch_size, rate=rate, verify=verify,
+                            restart=restart, echo=click.echo)
+    
+    per_second = summary['users'] / summary['seconds'] if summary['seconds'] else 0
+    click.echo(f"Processed {summary['users']} users in {summary['seconds']:.1f}s ({per_second:.1f} users/s)"
+               + ('' if verify else f", {summary['rows']} rows written"))
+    for user_id, error in sorted(summary['failed'].items()):
+        click.echo(f'Failed {user_id}: {error}')
+    for user_id, diffs in sorted(summary['diffs'].items()):
+        for diff in diffs:
+            click.echo(f'Mismatch {user_id}: {diff}')
+    if verify:
+        click.echo(f"{len(summary['diffs'])} users with mismatches")
+    if summary['failed'] or summary['diffs']:
+        raise SystemExit(1)
+
+@app.cli.command('backfill-anomaly-stats')
+@click.option('--users', help='Comma-separated user ids (default all users)')
+@click.option('--batch-size', default=500, show_default=True, help='Users rebuilt per pair of queries')
+def backfill_anomaly_stats(users, batch_size):
+    """Rebuild per-category spending statistics used to flag anomalies from each user's expense history"""
+    user_ids = [user_id.strip() for user_id in users.split(',') if user_id.strip()] if users else \
+        [user_id for (user_id,) in db.session.query(User.id).order_by(User.id)]
+    written = 0
+    for i in range(0, len(user_ids), batch_size):
+        written += anomalies.backfill_stats(user_ids[i:i + batch_size])
+        click.echo(f'{min(i + batch_size, len(user_ids))}/{len(user_ids)} users, {written} category statistics')
+    click.echo(f'Done. {written} category statistics written.')
+
+@app.cli.command('backfill-updated-at')
+def backfill_updated_at():
+    """Set updated_at from created_at where it is missing, e.g. rows stored before the column was
+    added by an earlier startup; new columns are backfilled when they are added"""
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            changed = migrations.backfill_updated_at(conn, table)
+            if changed:
+                click.echo(f'{table.name}: {changed} rows')
+    click.echo('Done.')
+
+@app.cli.command('find-duplicates')
+@click.option('--users', help='Comma-separated user ids (default all users)')
+@click.option('--merge', is_flag=True, help='Keep the first transaction of each group and delete the others')
+@click.option('--merge-different-dates', is_flag=True,
+              help='With --merge, also merge groups whose transactions are on different dates')
+def find_duplicates(users, merge, merge_different_dates):
+    """Report transactions that look like duplicates (same account, type, amount and description,
+    dated within DUPLICATE_DATE_TOLERANCE_DAYS), optionally merging them"""
+    filled = duplicates.fill_missing_fingerprints()
+    if filled:
+        click.echo(f'Fingerprinted {filled} older transactions')
+    
+    user_ids = [user_id.strip() for user_id in users.split(',') if user_id.strip()] if users else None
+    groups = duplicates.find_duplicate_groups(user_ids)
+    deleted = 0
+    for group in groups:
+        first = group[0]
+        click.echo(f'{first.user_id}: {len(group)} x {first.transaction_type} {first.amount} '
+                   f'"{first.description or ""}" on account {first.account_id}, '
+                   + ', '.join(f'#{t.id} {t.transaction_date.isoformat()}' for t in group))
+        if merge:
+            merged = duplicates.merge_duplicate_group(group, merge_different_dates)
+            deleted += merged
+            if merged:
+                continue
+            if any(t.transfer_id for t in group):
+                click.echo('  transfer, not merged')
+            else:
+                click.echo('  on different dates, not merged (use --merge-different-dates)')
+    
+    click.echo(f'{len(groups)} duplicate groups' + (f', {deleted} transactions deleted' if merge else ''))
+
+@app.cli.command('categorize-transactions')
+@click.option('--users', help='Comma-separated user ids (default all users)')
+@click.option('--overwrite', is_flag=True, help='Also recategorize transactions that have a category')
+@click.option('--batch-size', default=5000, show_default=True, help='Transactions to categorize per commit')
+def categorize_transactions(users, overwrite, batch_size):
+    """Set the category of stored income and expenses from the category rules"""
+    user_ids = [user_id.strip() for user_id in users.split(',') if user_id.strip()] if users else None
+    changed = categorizer.categorize_transactions(user_ids, overwrite=overwrite, batch_size=batch_size)
+    click.echo(f'Done. {changed} transactions categorized.')
+
+@app.cli.command('learn-category-rules')
+@click.option('--users', help='Comma-separated user ids (default all users)')
+@click.option('--min-count', default=3, show_default=True, help='Transactions of a merchant needed to learn a rule')
+@click.option('--min-share', default=0.8, show_default=True, help='Share of them that must be in one category')
+def learn_category_rules(users, min_count, min_share):
+    """Add category rules for merchants each user keeps putting in the same category"""
+    user_ids = [user_id.strip() for user_id in users.split(',') if user_id.strip()] if users else \
+        [user_id for (user_id,) in db.session.query(User.id).order_by(User.id)]
+    learned = 0
+    for user_id in user_ids:
+        learned += categorizer.learn_rules(user_id, min_count=min_count, min_share=min_share)
+    click.echo(f'Done. {learned} rules learned for {len(user_ids)} users.')
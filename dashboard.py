@@ -0,0 +1,127 @@
+from datetime import date
+from models import Account
+from utils import (get_account_balance, get_recent_transactions, get_monthly_spending_by_category,
+                   get_budget_progress, get_savings_goals_progress, get_upcoming_bills,
+                   get_stored_health_score, calculate_net_worth, get_base_currency)
+
+def accounts_widget(user):
+    """Active accounts with balances in their own currency"""
+    accounts = Account.query.filter_by(user_id=user.id, is_active=True).all()
+    return {
+        'accounts': [{
+            'id': account.id,
+            'name': account.name,
+            'account_type': account.account_type,
+            'currency': account.currency,
+            'balance': float(get_account_balance(account.id))
+        } for account in accounts]
+    }
+
+def recent_transactions_widget(user):
+    """Latest transactions"""
+    return {
+        'transactions': [{
+            'id': transaction.id,
+            'date': transaction.transaction_date.isoformat(),
+            'description': transaction.description,
+            'amount': float(transaction.amount),
+            'type': transaction.transaction_type,
+            'category': transaction.category.name if transaction.category else 'Uncategorized',
+            'account': transaction.account.name
+        } for transaction in get_recent_transactions(user.id)]
+    }
+
+def spending_by_category_widget(user):
+    """Current month spending per category, in chart.js shape"""
+    monthly_spending = get_monthly_spending_by_category(user.id)
+    return {
+        'labels': [item[0] for item in monthly_spending],
+        'data': [float(item[2]) for item in monthly_spending],
+        'backgroundColor': [item[1] for item in monthly_spending]
+    }
+
+def budgets_widget(user):
+    """Current month budget progress"""
+    return {
+        'budgets': [{
+            'id': bp['budget'].id,
+            'category': bp['budget'].category.name,
+            'amount': float(bp['budget'].amount),
+            'spent': float(bp['spent']),
+            'remaining': float(bp['remaining']),
+            'progress_percent': bp['progress_percent'],
+            'is_over_budget': bp['is_over_budget']
+        } for bp in get_budget_progress(user.id)]
+    }
+
+def goals_widget(user):
+    """Savings goals progress"""
+    return {
+        'goals': [{
+            'id': gp['goal'].id,
+            'name': gp['goal'].name,
+            'target_amount': float(gp['goal'].target_amount),
+            'current_amount': float(gp['saved_amount']),
+            'progress_percent': gp['progress_percent'],
+            'days_remaining': gp['days_remaining'],
+            'remaining_amount': float(gp['remaining_amount']),
+            'monthly_rate': float(gp['monthly_rate']) if gp['monthly_rate'] is not None else None,
+            'projected_completion_date': (gp['projected_completion_date'].isoformat()
+                                          if gp['projected_completion_date'] else None),
+            'required_monthly_rate': (float(gp['required_monthly_rate'])
+                                      if gp['required_monthly_rate'] is not None else None),
+            'on_track': gp['on_track']
+        } for gp in get_savings_goals_progress(user.id)]
+    }
+
+def bills_widget(user):
+    """Unpaid bills due soon"""
+    return {
+        'bills': [{
+            'id': bill.id,
+            'name': bill.name,
+            'amount': float(bill.amount),
+            'due_date': bill.due_date.isoformat(),
+            'auto_pay': bill.auto_pay
+        } for bill in get_upcoming_bills(user.id)]
+    }
+
+def health_score_widget(user):
+    """Precomputed financial health score and its factors"""
+    stored = get_stored_health_score(user.id, user.data_version or 0)
+    return {
+        'score': stored.score,
+        'budget_score': stored.budget_score,
+        'savings_score': stored.savings_score,
+        'net_worth_score': stored.net_worth_score,
+        'computed_at': stored.computed_at.isoformat() if stored.computed_at else None
+    }
+
+def net_worth_widget(user):
+    """Assets, liabilities and net worth in the base currency"""
+    net_worth_data = calculate_net_worth(user.id)
+    return {
+        'currency': get_base_currency(),
+        'assets': float(net_worth_data['assets']),
+        'liabilities': float(net_worth_data['liabilities']),
+        'net_worth': float(net_worth_data['net_worth'])
+    }
+
+# Dashboard widgets, each loaded by the browser from its own endpoint and called with the current user
+WIDGETS = {
+    'accounts': accounts_widget,
+    'recent_transactions': recent_transactions_widget,
+    'spending_by_category': spending_by_category_widget,
+    'budgets': budgets_widget,
+    'goals': goals_widget,
+    'bills': bills_widget,
+    'health_score': health_score_widget,
+    'net_worth': net_worth_widget,
+}
+
+# Widgets that are already a single precomputed row, and would only go stale in the cache
+UNCACHED_WIDGETS = {'health_score'}
+
+def widget_cache_key(name, user):
+    """Cache key for a widget; changes whenever the user's data or the date changes"""
+    return f"widget:{name}:{user.id}:{user.data_version or 0}:{date.today().isoformat()}"
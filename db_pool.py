@@ -0,0 +1,118 @@
+import logging
+import os
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection"""
+    
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            _record(self, 'checkout_errors', 1)
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with _lock:
+                stats = _pool_stats(self)
+                stats['waits'] += 1
+                stats['wait_seconds_total'] += waited
+                stats['wait_seconds_max'] = max(stats['wait_seconds_max'], waited)
+
+_lock = threading.Lock()
+_stats = {}  # engine url -> counters, shared by the pools an engine creates over its lifetime
+
+def _pool_stats(pool):
+    key = getattr(pool, '_stats_key', None) or 'default'
+    if key not in _stats:
+        _stats[key] = {'waits': 0, 'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0,
+                       'checkout_errors': 0, 'pre_ping_failures': 0, 'invalidations': 0}
+    return _stats[key]
+
+def _record(pool, counter, amount):
+    with _lock:
+        _pool_stats(pool)[counter] += amount
+
+def _env_int(name):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else None
+
+def engine_options_from_env(database_url):
+    """Build SQLALCHEMY_ENGINE_OPTIONS from DB_* environment variables.
+    
+    DB_POOL_SIZE, DB_MAX_OVERFLOW and DB_POOL_TIMEOUT fall back to SQLAlchemy's
+    defaults when unset. DB_STATEMENT_TIMEOUT_MS sets a per-statement timeout on
+    Postgres connections.
+    """
+    options = {
+        "pool_recycle": _env_int("DB_POOL_RECYCLE") or 300,
+        "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "1").lower() not in ("0", "false", "no"),
+    }
+    
+    # In-memory SQLite needs its single-connection pool; every other URL gets a timed QueuePool
+    in_memory = (database_url or "").startswith("sqlite") and (":memory:" in database_url or database_url == "sqlite://")
+    if not in_memory:
+        options["poolclass"] = TimedQueuePool
+        for option, name in (("pool_size", "DB_POOL_SIZE"),
+                             ("max_overflow", "DB_MAX_OVERFLOW"),
+                             ("pool_timeout", "DB_POOL_TIMEOUT")):
+            value = _env_int(name)
+            if value is not None:
+                options[option] = value
+    
+    statement_timeout = _env_int("DB_STATEMENT_TIMEOUT_MS")
+    if statement_timeout and (database_url or "").startswith("postgres"):
+        options["connect_args"] = {"options": f"-c statement_timeout={statement_timeout}"}
+    
+    return options
+
+def instrument_engines(engines):
+    """Attach pool metrics listeners and fork-safety to every engine.
+    
+    `engines` is db.engines, keyed by bind key (None for the primary).
+    """
+    for bind_key, engine in engines.items():
+        engine.pool._stats_key = bind_key or 'primary'
+        
+        @event.listens_for(engine, 'handle_error')
+        def count_pre_ping_failure(context, pool=engine.pool):
+            if getattr(context, 'is_pre_ping', False):
+                _record(pool, 'pre_ping_failures', 1)
+        
+        @event.listens_for(engine, 'invalidate')
+        def count_invalidation(dbapi_connection, connection_record, exception, pool=engine.pool):
+            _record(pool, 'invalidations', 1)
+        
+        # A recreated pool (after dispose) keeps reporting under the same key
+        @event.listens_for(engine, 'engine_disposed')
+        def keep_stats_key(engine, bind_key=bind_key):
+            engine.pool._stats_key = bind_key or 'primary'
+    
+    def dispose_in_child():
+        # Connections inherited from a preloading parent (gunicorn --preload) must not
+        # be shared; drop them without closing the parent's sockets
+        for engine in engines.values():
+            engine.dispose(close=False)
+        logging.info("Disposed inherited database connections after fork")
+    
+    os.register_at_fork(after_in_child=dispose_in_child)
+
+def get_pool_stats(engines):
+    """Current pool usage and cumulative counters per engine"""
+    result = {}
+    for bind_key, engine in engines.items():
+        pool = engine.pool
+        key = bind_key or 'primary'
+        with _lock:
+            counters = dict(_pool_stats(pool))
+        counters['wait_seconds_avg'] = counters['wait_seconds_total'] / counters['waits'] if counters['waits'] else 0.0
+        for gauge in ('size', 'checkedin', 'checkedout', 'overflow'):
+            if hasattr(pool, gauge):
+                counters[gauge] = getattr(pool, gauge)()
+        counters['pool_class'] = type(pool).__name__
+        result[key] = counters
+    return result
@@ -0,0 +1,126 @@
+import hashlib
+import re
+from datetime import timedelta
+from decimal import Decimal
+from flask import current_app
+from sqlalchemy import event, func, inspect, update
+from app import db
+from models import Transaction
+from utils import record_deletion
+
+FINGERPRINT_FIELDS = ('user_id', 'account_id', 'transaction_type', 'amount', 'description')
+
+def normalize_description(description):
+    """Lowercase letters and digits of a description, single-spaced, so case and punctuation do not matter"""
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', (description or '').lower()).split())
+
+def transaction_fingerprint(user_id, account_id, transaction_type, amount, description):
+    """Hash of everything two duplicates share except the date, which is a range on the index instead"""
+    key = '\x1f'.join((str(user_id), str(account_id), transaction_type or '',
+                       f'{Decimal(str(amount or 0)):.2f}', normalize_description(description)))
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+@event.listens_for(db.session, 'before_flush')
+def set_transaction_fingerprints(session, flush_context, instances):
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Transaction):
+            continue
+        if obj in session.dirty:
+            attrs = inspect(obj).attrs
+            if obj.fingerprint and not any(attrs[field].history.has_changes() for field in FINGERPRINT_FIELDS):
+                continue
+        obj.fingerprint = transaction_fingerprint(*(getattr(obj, field) for field in FINGERPRINT_FIELDS))
+
+def find_fingerprint_matches(fingerprints, start_date, end_date):
+    """Stored transactions with any of these fingerprints dated in [start_date, end_date]:
+    fingerprint -> [(transaction_date, id)], from one range scan per fingerprint on its index"""
+    matches = {}
+    if not fingerprints:
+        return matches
+    rows = db.session.query(Transaction.fingerprint, Transaction.transaction_date, Transaction.id).filter(
+        Transaction.fingerprint.in_(set(fingerprints)),
+        Transaction.transaction_date.between(start_date, end_date)
+    ).order_by(Transaction.transaction_date, Transaction.id)
+    for fingerprint, transaction_date, transaction_id in rows:
+        matches.setdefault(fingerprint, []).append((transaction_date, transaction_id))
+    return matches
+
+def find_duplicate_transaction(user_id, account_id, transaction_type, amount, description, transaction_date):
+    """The first stored transaction that looks like this one, dated within DUPLICATE_DATE_TOLERANCE_DAYS, or None"""
+    tolerance = current_app.config['DUPLICATE_DATE_TOLERANCE_DAYS']
+    if tolerance < 0:
+        return None
+    fingerprint = transaction_fingerprint(user_id, account_id, transaction_type, amount, description)
+    window = timedelta(days=tolerance)
+    matches = find_fingerprint_matches([fingerprint], transaction_date - window, transaction_date + window)
+    if fingerprint not in matches:
+        return None
+    return db.session.get(Transaction, matches[fingerprint][0][1])
+
+def fill_missing_fingerprints(batch_size=1000):
+    """Fingerprint transactions stored before fingerprints existed; returns the number filled"""
+    filled = 0
+    last_id = 0
+    while True:
+        rows = db.session.query(
+            Transaction.id, Transaction.updated_at, *(getattr(Transaction, field) for field in FINGERPRINT_FIELDS)
+        ).filter(Transaction.id > last_id, Transaction.fingerprint.is_(None)).order_by(Transaction.id).limit(batch_size).all()
+        if not rows:
+            return filled
+        # Bulk UPDATE by primary key: no flush, so data versions and derived data are untouched. updated_at
+        # is carried over, or its onupdate would make /api/sync clients download every row again.
+        db.session.execute(update(Transaction), [
+            {'id': row[0], 'updated_at': row[1], 'fingerprint': transaction_fingerprint(*row[2:])} for row in rows
+        ])
+        db.session.commit()
+        filled += len(rows)
+        last_id = rows[-1][0]
+
+def find_duplicate_groups(user_ids=None):
+    """Groups of stored transactions sharing a fingerprint, each dated within the tolerance of its group's first.
+
+    Only fingerprints that occur more than once are read back, found with one grouped query.
+    Returns lists of Transactions, oldest first.
+    """
+    tolerance = timedelta(days=max(current_app.config['DUPLICATE_DATE_TOLERANCE_DAYS'], 0))
+    repeated = db.session.query(Transaction.fingerprint).filter(Transaction.fingerprint.isnot(None))
+    if user_ids:
+        repeated = repeated.filter(Transaction.user_id.in_(user_ids))
+    repeated = repeated.group_by(Transaction.fingerprint).having(func.count() > 1)
+
+    groups = []
+    current = []
+    candidates = Transaction.query.filter(Transaction.fingerprint.in_(repeated.scalar_subquery()))\
+        .order_by(Transaction.fingerprint, Transaction.transaction_date, Transaction.id)
+    for transaction in candidates:
+        # Measured from the first row, so a daily repeat does not chain into one long group
+        if current and (transaction.fingerprint != current[0].fingerprint or
+                        transaction.transaction_date - current[0].transaction_date > tolerance):
+            if len(current) > 1:
+                groups.append(current)
+            current = []
+        current.append(transaction)
+    if len(current) > 1:
+        groups.append(current)
+    return groups
+
+def merge_duplicate_group(group, different_dates=False):
+    """Keep the first transaction of a group, moving the others' tags onto it, and delete the rest.
+
+    Transfers are skipped, since each leg has a counterpart in another group, and so are groups
+    spanning several dates unless different_dates, since those may be genuine repeats.
+    Returns the number deleted.
+    """
+    if any(transaction.transfer_id for transaction in group):
+        return 0
+    if not different_dates and len({transaction.transaction_date for transaction in group}) > 1:
+        return 0
+    kept, duplicates = group[0], group[1:]
+    for transaction in duplicates:
+        for tag in transaction.tags:
+            if tag not in kept.tags:
+                kept.tags.append(tag)
+        record_deletion(transaction.user_id, 'transactions', transaction.id)
+        db.session.delete(transaction)
+    db.session.commit()
+    return len(duplicates)
@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, DecimalField, SelectField, DateField, TextAreaField, BooleanField, HiddenField
-from wtforms.validators import DataRequired, Length, NumberRange, Optional
+from wtforms.validators import DataRequired, Length, NumberRange, Optional, ValidationError
 from decimal import Decimal
 
 class AccountForm(FlaskForm):
@@ -34,6 +34,18 @@ class TransactionForm(FlaskForm):
     ])
     notes = TextAreaField('Notes', validators=[Length(max=500)])
     tags = StringField('Tags (comma-separated)', validators=[Length(max=200)])
+    to_account_id = SelectField('To Account', coerce=int, validate_choice=False, validators=[Optional()])
+    allow_duplicate = BooleanField('Add anyway, this is not a duplicate')
+    
+    def validate_transaction_type(self, field):
+        if field.data != 'transfer':
+            return
+        if not self.to_account_id.data:
+            raise ValidationError('Choose the account to transfer to.')
+        if self.to_account_id.data == self.account_id.data:
+            raise ValidationError('A transfer needs two different accounts.')
+        if self.to_account_id.data not in {value for value, _ in self.account_id.choices}:
+            raise ValidationError('Not a valid destination account.')
 
 class BudgetForm(FlaskForm):
     category_id = SelectField('Category', coerce=int, validators=[DataRequired()])
@@ -48,8 +60,15 @@ class BudgetForm(FlaskForm):
 class SavingsGoalForm(FlaskForm):
     name = StringField('Goal Name', validators=[DataRequired(), Length(min=1, max=100)])
     target_amount = DecimalField('Target Amount', validators=[DataRequired(), NumberRange(min=0.01)], places=2)
+    current_amount = DecimalField('Already Saved', validators=[Optional(), NumberRange(min=0)], places=2, default=0)
     target_date = DateField('Target Date', validators=[Optional()])
+    account_id = SelectField('Linked Account', coerce=int, validators=[Optional()])
+    category_id = SelectField('Linked Category', coerce=int, validators=[Optional()])
     description = TextAreaField('Description', validators=[Length(max=500)])
+    
+    def validate_category_id(self, field):
+        if field.data and self.account_id.data:
+            raise ValidationError('Link the goal to an account or a category, not both.')
 
 class CategoryForm(FlaskForm):
     name = StringField('Category Name', validators=[DataRequired(), Length(min=1, max=50)])
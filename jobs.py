@@ -0,0 +1,258 @@
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import Job, JobSchedule
+
+# Registered task functions and periodic schedules: name -> function, name -> (interval, args)
+TASKS = {}
+PERIODIC = {}
+
+_stats_lock = threading.Lock()
+_stats = {}  # task name -> in-process counters of the workers in this process
+
+def task(name, max_attempts=None):
+    """Register a function as a task that enqueue(name, ...) can run in a worker"""
+    def decorator(func):
+        func.max_attempts = max_attempts
+        TASKS[name] = func
+        return func
+    return decorator
+
+def periodic(name, seconds, *args):
+    """Enqueue task `name` every `seconds` seconds while any worker runs"""
+    PERIODIC[name] = (seconds, args)
+
+def _config(key):
+    from app import app
+    return app.config[key]
+
+def enqueue(name, *args, delay=0, run_at=None, dedupe_key=None, max_attempts=None, connection=None):
+    """Queue a task, by default on the current session's transaction so it commits with the caller's writes.
+
+    With dedupe_key, a job with the same key that is still queued is moved to the
+    new run time instead of queuing another one, which debounces bursts of calls.
+    Pass `connection` to enqueue outside the session, e.g. from an after_commit hook.
+    """
+    conn = connection if connection is not None else db.session.connection()
+    jobs = Job.__table__
+    run_at = run_at or datetime.now() + timedelta(seconds=delay)
+
+    if dedupe_key:
+        updated = conn.execute(
+            update(jobs)
+            .where(jobs.c.dedupe_key == dedupe_key, jobs.c.status == 'queued')
+            .values(run_at=run_at, args=json.dumps(args))
+        ).rowcount
+        if updated:
+            return
+
+    conn.execute(insert(jobs).values(
+        name=name,
+        args=json.dumps(args),
+        status='queued',
+        run_at=run_at,
+        attempts=0,
+        max_attempts=max_attempts or getattr(TASKS.get(name), 'max_attempts', None) or _config('JOB_MAX_ATTEMPTS'),
+        dedupe_key=dedupe_key,
+        created_at=datetime.now()
+    ))
+
+def claim_job(worker_id):
+    """Mark the next due job as running for this worker and return it, or None when nothing is due"""
+    jobs = Job.__table__
+    for _ in range(3):
+        now = datetime.now()
+        with db.engine.begin() as conn:
+            query = select(jobs.c.id).where(jobs.c.status == 'queued', jobs.c.run_at <= now).order_by(
+                jobs.c.run_at, jobs.c.id
+            ).limit(1)
+            if conn.dialect.name == 'postgresql':
+                # Concurrent workers skip rows another worker is claiming instead of waiting on them
+                query = query.with_for_update(skip_locked=True)
+            job_id = conn.execute(query).scalar()
+            if job_id is None:
+                return None
+
+            # The status condition makes the claim safe where SKIP LOCKED is unavailable (SQLite)
+            claimed = conn.execute(
+                update(jobs)
+                .where(jobs.c.id == job_id, jobs.c.status == 'queued')
+                .values(status='running', locked_by=worker_id, locked_at=now, attempts=jobs.c.attempts + 1)
+                .returning(jobs.c.id, jobs.c.name, jobs.c.args, jobs.c.attempts, jobs.c.max_attempts)
+            ).first()
+            if claimed:
+                return claimed
+    return None
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter, capped at an hour"""
+    delay = min(_config('JOB_RETRY_BASE_SECONDS') * 2 ** (attempts - 1), 3600)
+    return delay * random.uniform(0.8, 1.2)
+
+def run_job(job):
+    """Run a claimed job and record the outcome: done, queued again for a retry, or failed"""
+    jobs = Job.__table__
+    started = time.monotonic()
+    error = None
+    try:
+        func = TASKS.get(job.name)
+        if func is None:
+            raise LookupError(f"Unknown task: {job.name}")
+        func(*json.loads(job.args))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        error = f"{type(e).__name__}: {str(e)}"[:2000]
+        logging.error(f"Job {job.id} ({job.name}) attempt {job.attempts} failed: {error}")
+    duration = time.monotonic() - started
+
+    now = datetime.now()
+    if error is None:
+        values = {'status': 'done', 'finished_at': now, 'last_error': None}
+        outcome = 'done'
+    elif job.attempts < job.max_attempts and job.name in TASKS:
+        values = {'status': 'queued', 'run_at': now + timedelta(seconds=retry_delay(job.attempts)), 'last_error': error}
+        outcome = 'retried'
+    else:
+        values = {'status': 'failed', 'finished_at': now, 'last_error': error}
+        outcome = 'failed'
+    with db.engine.begin() as conn:
+        conn.execute(update(jobs).where(jobs.c.id == job.id).values(locked_by=None, locked_at=None, **values))
+
+    with _stats_lock:
+        stats = _stats.setdefault(job.name, {'done': 0, 'retried': 0, 'failed': 0, 'seconds': 0.0})
+        stats[outcome] += 1
+        stats['seconds'] += duration
+
+def enqueue_periodic_jobs():
+    """Queue every periodic job whose time has come; the first worker to move next_run_at wins"""
+    schedules = JobSchedule.__table__
+    now = datetime.now()
+    with db.engine.begin() as conn:
+        known = set(conn.execute(select(schedules.c.name)).scalars())
+    for name in PERIODIC.keys() - known:
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(insert(schedules).values(name=name, next_run_at=now))
+        except IntegrityError:
+            pass  # another worker added it
+
+    for name, (seconds, args) in PERIODIC.items():
+        with db.engine.begin() as conn:
+            won = conn.execute(
+                update(schedules)
+                .where(schedules.c.name == name, schedules.c.next_run_at <= now)
+                .values(next_run_at=now + timedelta(seconds=seconds))
+            ).rowcount
+            if won:
+                enqueue(name, *args, dedupe_key=f'periodic:{name}', connection=conn)
+
+def requeue_stale_jobs():
+    """Put back jobs whose worker died mid-run; they count the interrupted attempt"""
+    jobs = Job.__table__
+    cutoff = datetime.now() - timedelta(seconds=_config('JOB_LOCK_TIMEOUT'))
+    with db.engine.begin() as conn:
+        return conn.execute(
+            update(jobs)
+            .where(jobs.c.status == 'running', jobs.c.locked_at < cutoff)
+            .values(status='queued', locked_by=None, locked_at=None, run_at=datetime.now())
+        ).rowcount
+
+def get_job_stats():
+    """Queue depth per task and status, age of the oldest due job, and this process's worker counters"""
+    jobs = Job.__table__
+    now = datetime.now()
+    with db.engine.connect() as conn:
+        counts = conn.execute(
+            select(jobs.c.name, jobs.c.status, func.count()).group_by(jobs.c.name, jobs.c.status)
+        ).all()
+        oldest_due = conn.execute(
+            select(func.min(jobs.c.run_at)).where(jobs.c.status == 'queued', jobs.c.run_at <= now)
+        ).scalar()
+
+    queue = {}
+    for name, status, count in counts:
+        queue.setdefault(name, {})[status] = count
+    with _stats_lock:
+        processed = {name: dict(stats) for name, stats in _stats.items()}
+    return {
+        'queue': queue,
+        'oldest_due_seconds': (now - oldest_due).total_seconds() if oldest_due else 0,
+        'processed': processed,
+    }
+
+class Worker:
+    """Runs jobs on `concurrency` threads and, from one of them, the periodic scheduler"""
+
+    def __init__(self, app, concurrency=1, poll_interval=1.0):
+        self.app = app
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def _loop(self, index):
+        last_tick = 0
+        while not self.stopping.is_set():
+            with self.app.app_context():
+                try:
+                    if index == 0 and time.monotonic() - last_tick >= self.poll_interval * 10:
+                        last_tick = time.monotonic()
+                        enqueue_periodic_jobs()
+                        requeue_stale_jobs()
+                    job = claim_job(f'{self.worker_id}:{index}')
+                    if job is not None:
+                        run_job(job)
+                except Exception as e:
+                    logging.error(f"Job worker error: {str(e)}")
+                    job = None
+                finally:
+                    db.session.remove()
+            if job is None:
+                self.stopping.wait(self.poll_interval)
+
+    def start(self):
+        for index in range(self.concurrency):
+            thread = threading.Thread(target=self._loop, args=(index,), name=f'job-worker-{index}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, *_):
+        self.stopping.set()
+
+    def run(self):
+        """Run until SIGINT/SIGTERM, letting running jobs finish"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.start()
+        while not self.stopping.is_set():
+            self.stopping.wait(1)
+        for thread in self.threads:
+            thread.join()
+
+_embedded = {}
+_embedded_lock = threading.Lock()
+
+def init_app(app):
+    """Start an in-process worker in each web process when JOB_WORKER_EMBEDDED is set"""
+    if not app.config['JOB_WORKER_EMBEDDED']:
+        return
+
+    @app.before_request
+    def start_embedded_worker():
+        # Per process, so it also starts in workers forked after app import
+        with _embedded_lock:
+            if os.getpid() not in _embedded:
+                worker = Worker(app, concurrency=1, poll_interval=app.config['JOB_POLL_INTERVAL'])
+                _embedded[os.getpid()] = worker
+                worker.start()
@@ -0,0 +1,398 @@
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import request
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+EXTERNAL_CALL_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_families = {}  # metric name -> (type, help, label names, buckets)
+_metrics = []
+_collectors = []  # functions returning (name, label values, value) read from other modules' counters
+
+def describe(name, kind, documentation, labelnames=(), buckets=None):
+    _families[name] = (kind, documentation, tuple(labelnames), buckets)
+
+class Counter:
+    """Per-process counter by label values. Recording holds a lock only to add to one dict entry."""
+    
+    def __init__(self, name, documentation, labelnames=()):
+        describe(name, 'counter', documentation, labelnames)
+        self.name = name
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def collect(self):
+        with self._lock:
+            return dict(self._values)
+
+class Histogram:
+    """Per-process histogram by label values: a count per bucket plus the sum of observations"""
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        describe(name, 'histogram', documentation, labelnames, buckets)
+        self.name = name
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+    
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)  # the last slot is +Inf
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+    
+    def collect(self):
+        with self._lock:
+            return {key: [list(counts), total] for key, (counts, total) in self._values.items()}
+
+def collector(f):
+    """Register a function yielding (name, label values, value) of described metrics at each snapshot"""
+    _collectors.append(f)
+    return f
+
+REQUESTS = Counter('http_requests_total', 'HTTP responses by route, method and status', ('route', 'method', 'status'))
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Time to build each HTTP response', ('route', 'method'))
+REQUEST_QUERIES = Histogram('http_request_db_queries', 'Database queries run by each HTTP request', ('route',),
+                            QUERY_COUNT_BUCKETS)
+QUERIES = Counter('db_queries_total', 'Database queries by route; "background" outside requests', ('route',))
+QUERY_SECONDS = Counter('db_query_seconds_total', 'Time spent in database queries by route', ('route',))
+EXTERNAL_CALL_SECONDS = Histogram('external_call_duration_seconds', 'Latency of calls to external services',
+                                  ('service', 'operation'), EXTERNAL_CALL_BUCKETS)
+EXTERNAL_CALL_ERRORS = Counter('external_call_errors_total', 'Failed calls to external services',
+                               ('service', 'operation'))
+
+# Request currently served by this thread: [route, started, queries, query seconds]
+_current_request = ContextVar('metrics_request', default=None)
+
+@contextmanager
+def track_call(service, operation):
+    """Time a call to an external service; an exception raised inside counts as an error"""
+    ensure_flusher()
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        EXTERNAL_CALL_ERRORS.inc(service=service, operation=operation)
+        raise
+    finally:
+        EXTERNAL_CALL_SECONDS.observe(time.perf_counter() - started, service=service, operation=operation)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._metrics_started
+    current = _current_request.get()
+    if current is not None:
+        current[2] += 1
+        current[3] += elapsed
+    else:
+        QUERIES.inc(route='background')
+        QUERY_SECONDS.inc(elapsed, route='background')
+
+# Snapshots: each process writes its values to METRICS_DIR/<pid>.json, and a scrape of any
+# worker merges them all. Counters of exited processes are folded into EXITED_FILE so totals
+# never go back while the directory only holds live processes; their gauges are dropped.
+EXITED_FILE = 'exited.json'
+LOCK_FILE = '.lock'
+_directory = None
+_flush_seconds = 10
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+_process_token = (None, None)  # (pid, token) telling this process's snapshots from a reused pid's
+
+def _token():
+    global _process_token
+    if _process_token[0] != os.getpid():
+        _process_token = (os.getpid(), uuid.uuid4().hex)
+    return _process_token[1]
+
+def _snapshot():
+    values = {metric.name: metric.collect() for metric in _metrics}
+    for f in _collectors:
+        for name, key, value in f():
+            values.setdefault(name, {})[tuple(str(part) for part in key)] = value
+    return {
+        'pid': os.getpid(),
+        'token': _token(),
+        'metrics': {name: [[list(key), value] for key, value in entries.items()] for name, entries in values.items()}
+    }
+
+def _write_json(name, data):
+    fd, temporary = tempfile.mkstemp(dir=_directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(temporary, os.path.join(_directory, name))
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_snapshot():
+    """Write this process's values for the next scrape, atomically"""
+    os.makedirs(_directory, exist_ok=True)
+    _write_json(f'{os.getpid()}.json', _snapshot())
+
+def _flush_periodically():
+    while True:
+        time.sleep(_flush_seconds)
+        try:
+            write_snapshot()
+        except OSError as e:
+            logging.warning(f"Could not write metrics snapshot: {str(e)}")
+
+def ensure_flusher():
+    """Start this process's snapshot thread, once per process so forked workers get their own"""
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _flusher_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+        threading.Thread(target=_flush_periodically, name='metrics-flush', daemon=True).start()
+        atexit.register(write_snapshot)
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _add_entries(target, kind, entries):
+    for key, value in entries:
+        key = tuple(key)
+        if kind != 'histogram':
+            target[key] = target.get(key, 0) + value
+        elif key in target:
+            counts, total = target[key]
+            target[key] = [[a + b for a, b in zip(counts, value[0])], total + value[1]]
+        else:
+            target[key] = value
+
+def _snapshot_paths():
+    return [path for path in glob.glob(os.path.join(_directory, '*.json'))
+            if os.path.basename(path) != EXITED_FILE]
+
+def _fold_exited():
+    """Add the counters of exited processes to EXITED_FILE and delete their snapshots.
+    
+    Called under the lock file, so concurrent scrapes fold each snapshot once. The tokens
+    of folded snapshots are kept until their file is gone, so a crash between writing
+    EXITED_FILE and deleting a snapshot never counts it twice.
+    """
+    exited = _read_json(os.path.join(_directory, EXITED_FILE)) or {'metrics': {}, 'folded': []}
+    snapshots = {path: _read_json(path) for path in _snapshot_paths()}
+    dead = {path: snapshot for path, snapshot in snapshots.items() if snapshot is not None
+            and snapshot['pid'] != os.getpid() and not _process_alive(snapshot['pid'])}
+    # Folded by a run that stopped before deleting them
+    stale = [path for path, snapshot in dead.items() if snapshot.get('token') in exited['folded']]
+    fresh = {path: snapshot for path, snapshot in dead.items() if path not in stale}
+    if fresh:
+        merged = {}
+        for snapshot in [exited, *fresh.values()]:
+            for name, entries in snapshot['metrics'].items():
+                family = _families.get(name)
+                if family is not None and family[0] != 'gauge':
+                    _add_entries(merged.setdefault(name, {}), family[0], entries)
+        # Tokens are only needed while their snapshot exists
+        on_disk = {snapshot.get('token') for snapshot in snapshots.values() if snapshot is not None}
+        exited = {
+            'metrics': {name: [[list(key), value] for key, value in entries.items()]
+                        for name, entries in merged.items()},
+            'folded': [token for token in exited['folded'] + [snapshot.get('token') for snapshot in fresh.values()]
+                       if token in on_disk]
+        }
+        _write_json(EXITED_FILE, exited)
+    for path in list(fresh) + stale:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def _merge_snapshots():
+    # Folding and reading share one lock, so a scrape never sees a snapshot deleted but not yet folded
+    with open(os.path.join(_directory, LOCK_FILE), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            _fold_exited()
+        except OSError as e:
+            logging.warning(f"Could not fold metrics of exited processes: {str(e)}")
+        return _read_snapshots()
+
+def _read_snapshots():
+    merged = {}
+    exited = _read_json(os.path.join(_directory, EXITED_FILE))
+    for path in _snapshot_paths():
+        snapshot = _read_json(path)
+        if snapshot is None:
+            continue
+        alive = snapshot['pid'] == os.getpid() or _process_alive(snapshot['pid'])
+        if exited is not None and not alive and snapshot.get('token') in exited['folded']:
+            continue
+        for name, entries in snapshot['metrics'].items():
+            family = _families.get(name)
+            if family is None or (family[0] == 'gauge' and not alive):
+                continue
+            _add_entries(merged.setdefault(name, {}), family[0], entries)
+    if exited is not None:
+        for name, entries in exited['metrics'].items():
+            family = _families.get(name)
+            if family is not None:
+                _add_entries(merged.setdefault(name, {}), family[0], entries)
+    return merged
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render():
+    """All processes' metrics in the Prometheus text exposition format"""
+    write_snapshot()
+    lines = []
+    for name, entries in sorted(_merge_snapshots().items()):
+        kind, documentation, labelnames, buckets = _families[name]
+        lines.append(f'# HELP {name} {documentation}')
+        lines.append(f'# TYPE {name} {kind}')
+        for key, value in sorted(entries.items()):
+            labels = dict(zip(labelnames, key))
+            if kind != 'histogram':
+                lines.append(f'{name}{_format_labels(labels)} {_format_number(value)}')
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip(buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(dict(labels, le=_format_number(bound)))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_number(total)}')
+            lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+def init_app(app, db):
+    """Time every request and count its database queries; snapshots go to METRICS_DIR"""
+    global _directory, _flush_seconds
+    _directory = app.config['METRICS_DIR']
+    _flush_seconds = app.config['METRICS_FLUSH_SECONDS']
+    
+    from sqlalchemy import event
+    for engine in db.engines.values():
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    
+    @app.before_request
+    def start_request_metrics():
+        ensure_flusher()
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        _current_request.set([route, time.perf_counter(), 0, 0.0])
+    
+    @app.after_request
+    def record_request_metrics(response):
+        current = _current_request.get()
+        if current is None:
+            return response
+        _current_request.set(None)
+        route, started, queries, query_seconds = current
+        REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method)
+        REQUEST_QUERIES.observe(queries, route=route)
+        QUERIES.inc(queries, route=route)
+        QUERY_SECONDS.inc(query_seconds, route=route)
+        return response
+    
+    _describe_collected(dict(db.engines))
+
+def _describe_collected(engines):
+    # Read from the counters other modules keep, at each snapshot
+    from cache import caches
+    from db_pool import get_pool_stats
+    import audio
+    import jobs
+    import replica
+    
+    describe('cache_requests_total', 'counter', 'In-process cache lookups by cache and result', ('cache', 'result'))
+    describe('cache_entries', 'gauge', 'Entries held by each in-process cache', ('cache',))
+    describe('db_pool_connections', 'gauge', 'Connections of each pool by state', ('pool', 'state'))
+    describe('db_pool_checkout_waits_total', 'counter', 'Connection checkouts', ('pool',))
+    describe('db_pool_checkout_wait_seconds_total', 'counter', 'Time spent waiting for connections', ('pool',))
+    describe('db_pool_events_total', 'counter', 'Checkout errors, pre-ping failures, invalidations', ('pool', 'event'))
+    describe('replica_reads_total', 'counter', 'Replica-eligible reads by where they were answered', ('outcome',))
+    describe('voice_requests_total', 'counter', 'Voice uploads by audio mode', ('mode',))
+    describe('voice_seconds_total', 'counter', 'Time spent on voice uploads by mode and stage', ('mode', 'stage'))
+    describe('jobs_processed_total', 'counter', 'Background jobs run by task and outcome', ('task', 'outcome'))
+    describe('job_seconds_total', 'counter', 'Time spent running background jobs by task', ('task',))
+    
+    @collector
+    def cache_metrics():
+        for name, cache in caches.items():
+            yield 'cache_requests_total', (name, 'hit'), cache.hits
+            yield 'cache_requests_total', (name, 'miss'), cache.misses
+            yield 'cache_entries', (name,), len(cache._entries)
+    
+    @collector
+    def pool_metrics():
+        for pool, stats in get_pool_stats(engines).items():
+            for state, gauge in (('size', 'size'), ('checked_out', 'checkedout'), ('checked_in', 'checkedin'),
+                                 ('overflow', 'overflow')):
+                if gauge in stats:
+                    yield 'db_pool_connections', (pool, state), max(stats[gauge], 0)
+            yield 'db_pool_checkout_waits_total', (pool,), stats['waits']
+            yield 'db_pool_checkout_wait_seconds_total', (pool,), stats['wait_seconds_total']
+            for counter in ('checkout_errors', 'pre_ping_failures', 'invalidations'):
+                yield 'db_pool_events_total', (pool, counter), stats[counter]
+    
+    @collector
+    def process_counters():
+        for outcome, count in replica.stats.items():
+            yield 'replica_reads_total', (outcome,), count
+        with audio._stats_lock:
+            voice = {mode: dict(stats) for mode, stats in audio._stats.items()}
+        for mode, stats in voice.items():
+            yield 'voice_requests_total', (mode,), stats['requests']
+            for stage in ('preprocess', 'transcribe', 'total'):
+                yield 'voice_seconds_total', (mode, stage), stats[f'{stage}_seconds']
+        with jobs._stats_lock:
+            processed = {task: dict(stats) for task, stats in jobs._stats.items()}
+        for task, stats in processed.items():
+            for outcome in ('done', 'retried', 'failed'):
+                yield 'jobs_processed_total', (task, outcome), stats[outcome]
+            yield 'job_seconds_total', (task,), stats['seconds']
@@ -0,0 +1,53 @@
+import logging
+from datetime import datetime
+from sqlalchemy import func, inspect, text
+from app import db
+
+def backfill_updated_at(conn, table):
+    """Set updated_at of rows that have none to their created_at; returns the rows changed"""
+    if 'updated_at' not in table.columns or 'created_at' not in table.columns:
+        return 0
+    backfilled = conn.execute(
+        table.update().where(table.c.updated_at.is_(None))
+        .values(updated_at=func.coalesce(table.c.created_at, datetime.now()))
+    ).rowcount
+    if backfilled:
+        logging.info(f"Set updated_at of {backfilled} rows of {table.name}")
+    return backfilled
+
+def add_missing_columns():
+    """Add columns declared on the models but missing from existing tables.
+    
+    db.create_all() only creates missing tables, so columns added to an existing
+    model are created here (nullable, without server defaults), together with any
+    declared indexes the table does not have yet. When updated_at is added, existing
+    rows get their created_at, so /api/sync watermarks find them when they change.
+    """
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    
+    with db.engine.begin() as conn:
+        preparer = conn.dialect.identifier_preparer
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            
+            present = {column['name'] for column in inspector.get_columns(table.name)}
+            missing = [column for column in table.columns if column.name not in present]
+            for column in missing:
+                conn.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    preparer.format_table(table),
+                    preparer.quote(column.name),
+                    column.type.compile(dialect=conn.dialect)
+                )))
+                logging.info(f"Added column {table.name}.{column.name}")
+            
+            # Only in the run adding the column, so later startups never scan the table
+            if 'updated_at' in [column.name for column in missing]:
+                backfill_updated_at(conn, table)
+            
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(conn)
+                    logging.info(f"Created index {index.name}")
@@ -1,8 +1,9 @@
 from datetime import datetime
+from itertools import chain
 from app import db
 from flask_dance.consumer.storage.sqla import OAuthConsumerMixin
 from flask_login import UserMixin
-from sqlalchemy import UniqueConstraint, Numeric
+from sqlalchemy import UniqueConstraint, Numeric, event, func, inspect, or_
 from decimal import Decimal
 
 # Mandatory for Replit Auth
@@ -13,6 +14,7 @@ class User(UserMixin, db.Model):
     first_name = db.Column(db.String, nullable=True)
     last_name = db.Column(db.String, nullable=True)
     profile_image_url = db.Column(db.String, nullable=True)
+    data_version = db.Column(db.Integer, default=0)  # bumped on every write to the user's financial data
     
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
@@ -24,6 +26,7 @@ class User(UserMixin, db.Model):
     categories = db.relationship('Category', backref='user', lazy=True, cascade='all, delete-orphan')
     goals = db.relationship('SavingsGoal', backref='user', lazy=True, cascade='all, delete-orphan')
     bills = db.relationship('Bill', backref='user', lazy=True, cascade='all, delete-orphan')
+    tags = db.relationship('Tag', backref='user', lazy=True, cascade='all, delete-orphan')
 
 # Mandatory for Replit Auth
 class OAuth(OAuthConsumerMixin, db.Model):
@@ -48,10 +51,20 @@ class Account(db.Model):
     currency = db.Column(db.String(3), default='USD')
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    
+    __table_args__ = (db.Index('ix_accounts_user_updated_at', 'user_id', 'updated_at'),)
     
     # Relationships
     transactions = db.relationship('Transaction', backref='account', lazy=True)
 
+# Running account balance at each month end, kept current by maintain_balance_checkpoints
+class AccountBalanceCheckpoint(db.Model):
+    __tablename__ = 'account_balance_checkpoints'
+    account_id = db.Column(db.Integer, db.ForeignKey('accounts.id', ondelete='CASCADE'), primary_key=True)
+    period_end = db.Column(db.Date, primary_key=True)
+    balance = db.Column(Numeric(14, 2), nullable=False)  # signed sum of transactions dated on or before period_end
+
 class Category(db.Model):
     __tablename__ = 'categories'
     id = db.Column(db.Integer, primary_key=True)
@@ -70,22 +83,92 @@ class Category(db.Model):
     transactions = db.relationship('Transaction', backref='category', lazy=True)
     budgets = db.relationship('Budget', backref='category', lazy=True)
 
+# Every (ancestor, descendant) pair of the category tree, including each category with itself
+class CategoryClosure(db.Model):
+    __tablename__ = 'category_closure'
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('categories.id', ondelete='CASCADE'), primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey('categories.id', ondelete='CASCADE'), primary_key=True)
+    depth = db.Column(db.Integer, nullable=False)  # 0 for the self row
+    ancestor_level = db.Column(db.Integer, nullable=False)  # 0 for top-level categories
+    
+    __table_args__ = (
+        db.Index('ix_category_closure_descendant', 'descendant_id', 'ancestor_level'),
+    )
+
+# Keyword -> category rule used to categorize transactions by description (see categorizer.py)
+class CategoryRule(db.Model):
+    __tablename__ = 'category_rules'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String, db.ForeignKey('users.id'))  # NULL for system rules
+    pattern = db.Column(db.String(100), nullable=False)  # normalized words matched anywhere in a description
+    category_id = db.Column(db.Integer, db.ForeignKey('categories.id', ondelete='CASCADE'), nullable=False)
+    source = db.Column(db.String(10), nullable=False, default='manual')  # manual, learned, system
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    
+    __table_args__ = (UniqueConstraint('user_id', 'pattern', name='uq_category_rule_user_pattern'),)
+
 class Transaction(db.Model):
     __tablename__ = 'transactions'
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String, db.ForeignKey('users.id'), nullable=False)
     account_id = db.Column(db.Integer, db.ForeignKey('accounts.id'), nullable=False)
     category_id = db.Column(db.Integer, db.ForeignKey('categories.id'))
-    amount = db.Column(Numeric(12, 2), nullable=False)
+    amount = db.Column(Numeric(12, 2), nullable=False)  # in the account's currency
+    base_amount = db.Column(Numeric(12, 2))  # amount in BASE_CURRENCY at the transaction_date rate
     description = db.Column(db.String(200))
     transaction_date = db.Column(db.Date, nullable=False)
     transaction_type = db.Column(db.String(10), nullable=False)  # income, expense, transfer
+    transfer_id = db.Column(db.String(32), index=True)  # shared by the two legs of a transfer
     payment_method = db.Column(db.String(20))  # cash, credit_card, debit_card, transfer
-    tags = db.Column(db.Text)  # JSON string for tags
+    legacy_tags = db.Column('tags', db.Text)  # Pre-normalization comma-separated tags, see `flask migrate-tags`
     notes = db.Column(db.Text)
     is_recurring = db.Column(db.Boolean, default=False)
+    idempotency_key = db.Column(db.String(64))  # client-supplied, makes batch API retries safe
+    fingerprint = db.Column(db.String(32))  # hash of user, account, type, amount and description (see duplicates.py)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    
+    __table_args__ = (
+        db.Index('ix_transactions_user_idempotency_key', 'user_id', 'idempotency_key', unique=True),
+        db.Index('ix_transactions_user_updated_at', 'user_id', 'updated_at'),
+        db.Index('ix_transactions_account_date', 'account_id', 'transaction_date'),
+        db.Index('ix_transactions_category_date', 'category_id', 'transaction_date'),
+        db.Index('ix_transactions_fingerprint_date', 'fingerprint', 'transaction_date'),
+    )
+    
+    # Relationships
+    tags = db.relationship('Tag', secondary='transaction_tags', backref='transactions', lazy='selectin')
+
+# Association table between transactions and tags
+transaction_tags = db.Table(
+    'transaction_tags',
+    db.Column('transaction_id', db.Integer, db.ForeignKey('transactions.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tags.id', ondelete='CASCADE'), primary_key=True),
+    # The primary key covers transaction -> tags; this covers tag -> transactions
+    db.Index('ix_transaction_tags_tag_id', 'tag_id', 'transaction_id'),
+)
+
+class Tag(db.Model):
+    __tablename__ = 'tags'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String, db.ForeignKey('users.id'), nullable=False)
+    name = db.Column(db.String(50), nullable=False)  # normalized: stripped, lowercase
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    
+    __table_args__ = (UniqueConstraint('user_id', 'name', name='uq_tag_user_name'),)
+
+class ExchangeRate(db.Model):
+    __tablename__ = 'exchange_rates'
+    id = db.Column(db.Integer, primary_key=True)
+    currency = db.Column(db.String(3), nullable=False)
+    rate_date = db.Column(db.Date, nullable=False)
+    rate = db.Column(Numeric(18, 8), nullable=False)  # units of BASE_CURRENCY per unit of currency
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    
+    # Also serves as the (currency, rate_date) lookup index
+    __table_args__ = (UniqueConstraint('currency', 'rate_date', name='uq_exchange_rate_currency_date'),)
 
 class Budget(db.Model):
     __tablename__ = 'budgets'
@@ -98,6 +181,51 @@ class Budget(db.Model):
     end_date = db.Column(db.Date)
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    
+    __table_args__ = (db.Index('ix_budgets_user_updated_at', 'user_id', 'updated_at'),)
+
+# Running spend of a budget in the current month, maintained on every expense write (see utils.maintain_budget_spend)
+class BudgetSpend(db.Model):
+    __tablename__ = 'budget_spend'
+    budget_id = db.Column(db.Integer, db.ForeignKey('budgets.id', ondelete='CASCADE'), primary_key=True)
+    period_start = db.Column(db.Date, primary_key=True)
+    spent = db.Column(Numeric(14, 2), nullable=False)  # base-currency expenses in the budget's category subtree
+    alerted_percent = db.Column(db.Integer, nullable=False, default=0)  # highest alert threshold already sent
+
+# Exponentially weighted statistics of a user's expenses in one category, kept by anomalies.py
+class CategorySpendStats(db.Model):
+    __tablename__ = 'category_spend_stats'
+    user_id = db.Column(db.String, db.ForeignKey('users.id'), primary_key=True)
+    category_id = db.Column(db.Integer, db.ForeignKey('categories.id', ondelete='CASCADE'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)  # expenses folded in
+    mean = db.Column(db.Float, nullable=False, default=0)  # of expense amounts, in BASE_CURRENCY
+    variance = db.Column(db.Float, nullable=False, default=0)
+    week_start = db.Column(db.Date)  # Monday of the week being accumulated
+    week_spent = db.Column(db.Float, nullable=False, default=0)
+    week_flagged = db.Column(db.Boolean, nullable=False, default=False)
+    weeks = db.Column(db.Integer, nullable=False, default=0)  # completed weeks folded in
+    weekly_mean = db.Column(db.Float, nullable=False, default=0)  # of weekly spend
+    weekly_variance = db.Column(db.Float, nullable=False, default=0)
+
+class SpendingAnomaly(db.Model):
+    __tablename__ = 'spending_anomalies'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String, db.ForeignKey('users.id'), nullable=False)
+    # No foreign key: a partitioned transactions table is keyed by (id, transaction_date), see partitions.py.
+    # Anomalies of deleted transactions are removed by anomalies.track_spending_anomalies and archive_year.
+    transaction_id = db.Column(db.Integer, nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('categories.id', ondelete='CASCADE'))
+    kind = db.Column(db.String(10), nullable=False)  # amount (one expense) or weekly (the week's spend so far)
+    amount = db.Column(Numeric(14, 2), nullable=False)
+    expected = db.Column(Numeric(14, 2), nullable=False)  # the weighted mean it was compared with
+    z_score = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    
+    __table_args__ = (
+        db.Index('ix_spending_anomalies_user_created', 'user_id', 'created_at'),
+        db.Index('ix_spending_anomalies_transaction', 'transaction_id'),
+    )
 
 class SavingsGoal(db.Model):
     __tablename__ = 'savings_goals'
@@ -105,11 +233,17 @@ class SavingsGoal(db.Model):
     user_id = db.Column(db.String, db.ForeignKey('users.id'), nullable=False)
     name = db.Column(db.String(100), nullable=False)
     target_amount = db.Column(Numeric(12, 2), nullable=False)
-    current_amount = db.Column(Numeric(12, 2), default=0)
+    current_amount = db.Column(Numeric(12, 2), default=0)  # saved before the goal was created, when linked
     target_date = db.Column(db.Date)
+    # Optionally linked: contributions are then derived from transactions (see get_goal_projections)
+    account_id = db.Column(db.Integer, db.ForeignKey('accounts.id', ondelete='SET NULL'))
+    category_id = db.Column(db.Integer, db.ForeignKey('categories.id', ondelete='SET NULL'))
     description = db.Column(db.Text)
     is_achieved = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    
+    __table_args__ = (db.Index('ix_savings_goals_user_updated_at', 'user_id', 'updated_at'),)
 
 class Bill(db.Model):
     __tablename__ = 'bills'
@@ -124,7 +258,308 @@ class Bill(db.Model):
     auto_pay = db.Column(db.Boolean, default=False)
     notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    
+    __table_args__ = (db.Index('ix_bills_user_updated_at', 'user_id', 'updated_at'),)
+
+# Record of a hard-deleted row, so /api/sync can report the deletion
+class SyncTombstone(db.Model):
+    __tablename__ = 'sync_tombstones'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String, db.ForeignKey('users.id'), nullable=False)
+    entity = db.Column(db.String(20), nullable=False)  # accounts, transactions, budgets, goals, bills
+    entity_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    
+    __table_args__ = (db.Index('ix_sync_tombstones_user_deleted_at', 'user_id', 'deleted_at'),)
+
+
+# Latest financial health score and its factors, one row per user
+class FinancialHealthScore(db.Model):
+    __tablename__ = 'financial_health_scores'
+    user_id = db.Column(db.String, db.ForeignKey('users.id'), primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+    budget_score = db.Column(db.Float, nullable=False)
+    savings_score = db.Column(db.Float, nullable=False)
+    net_worth_score = db.Column(db.Float, nullable=False)
+    data_version = db.Column(db.Integer, nullable=False)  # User.data_version the score was computed from
+    computed_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+# Last financial health score of each day, for trend display
+class FinancialHealthScoreHistory(db.Model):
+    __tablename__ = 'financial_health_score_history'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String, db.ForeignKey('users.id'), nullable=False)
+    score_date = db.Column(db.Date, nullable=False)
+    score = db.Column(db.Float, nullable=False)
+    budget_score = db.Column(db.Float, nullable=False)
+    savings_score = db.Column(db.Float, nullable=False)
+    net_worth_score = db.Column(db.Float, nullable=False)
+    
+    __table_args__ = (UniqueConstraint('user_id', 'score_date', name='uq_health_score_history_user_date'),)
+
+# A year of one user's transactions moved to a compressed file (see archive.py)
+class TransactionArchive(db.Model):
+    __tablename__ = 'transaction_archives'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String, db.ForeignKey('users.id'), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    path = db.Column(db.String(500), nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    archived_at = db.Column(db.DateTime, default=datetime.now)
+    
+    __table_args__ = (UniqueConstraint('user_id', 'year', name='uq_transaction_archive_user_year'),)
+
+# Balance change of an account over an archived year, so balances survive archiving
+class ArchivedAccountTotal(db.Model):
+    __tablename__ = 'archived_account_totals'
+    account_id = db.Column(db.Integer, db.ForeignKey('accounts.id', ondelete='CASCADE'), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    balance = db.Column(Numeric(14, 2), nullable=False)
+    base_balance = db.Column(Numeric(14, 2), nullable=False)
+
+# Server-side session data when SESSION_BACKEND is "db" (see session_store.py)
+class ServerSession(db.Model):
+    __tablename__ = 'server_sessions'
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+# Durable background jobs, claimed by `flask worker` (see jobs.py)
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)  # registered task name
+    args = db.Column(db.Text, nullable=False, default='[]')  # JSON list
+    status = db.Column(db.String(10), nullable=False, default='queued')  # queued, running, done, failed
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    dedupe_key = db.Column(db.String(200))  # a queued job with the same key is rescheduled instead of duplicated
+    last_error = db.Column(db.Text)
+    locked_by = db.Column(db.String(100))
+    locked_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    finished_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+        db.Index('ix_jobs_dedupe_key', 'dedupe_key', 'status'),
+    )
+
+# Next run of each periodic job; the conditional update on it keeps workers from enqueuing twice
+class JobSchedule(db.Model):
+    __tablename__ = 'job_schedules'
+    name = db.Column(db.String(100), primary_key=True)
+    next_run_at = db.Column(db.DateTime, nullable=False)
+
+# Users already processed by an interrupted `flask recompute` run, so it can resume (see recompute.py)
+class RecomputeProgress(db.Model):
+    __tablename__ = 'recompute_progress'
+    target = db.Column(db.String(30), primary_key=True)
+    user_id = db.Column(db.String, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    completed_at = db.Column(db.DateTime, default=datetime.now)
+
+# Models whose writes invalidate per-user derived data such as cached dashboard widgets
+VERSIONED_MODELS = (Account, Transaction, Tag, Category, Budget, SavingsGoal, Bill)
+
+@event.listens_for(db.session, 'after_flush')
+def bump_user_data_version(session, flush_context):
+    """Increment User.data_version for every user whose data changed in this flush"""
+    user_ids = {
+        obj.user_id for obj in chain(session.new, session.dirty, session.deleted)
+        if isinstance(obj, VERSIONED_MODELS) and obj.user_id
+    }
+    if user_ids:
+        session.connection().execute(
+            User.__table__.update()
+            .where(User.__table__.c.id.in_(user_ids))
+            .values(data_version=func.coalesce(User.__table__.c.data_version, 0) + 1)
+        )
+        # Picked up after commit to schedule recomputation of derived data
+        session.info.setdefault('changed_user_ids', set()).update(user_ids)
+
+@event.listens_for(db.session, 'after_flush')
+def maintain_category_closure(session, flush_context):
+    """Keep category_closure in step with inserted, re-parented and deleted categories"""
+    closure = CategoryClosure.__table__
+    new = [obj for obj in session.new if isinstance(obj, Category)]
+    moved = [obj for obj in session.dirty if isinstance(obj, Category)
+             and inspect(obj).attrs.parent_category_id.history.has_changes()]
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, Category)]
+    if not (new or moved or deleted):
+        return
+    
+    conn = session.connection()
+    
+    def ancestor_paths(category_id):
+        # (ancestor_id, depth, ancestor_level) rows for a category, including itself
+        if category_id is None:
+            return []
+        return conn.execute(
+            db.select(closure.c.ancestor_id, closure.c.depth, closure.c.ancestor_level)
+            .where(closure.c.descendant_id == category_id)
+        ).all()
+    
+    if deleted:
+        conn.execute(closure.delete().where(
+            or_(closure.c.ancestor_id.in_(deleted), closure.c.descendant_id.in_(deleted))
+        ))
+    
+    # Insert parents before children created in the same flush
+    pending = {obj.id: obj for obj in new}
+    while pending:
+        ready = [obj for obj in pending.values() if obj.parent_category_id not in pending]
+        for category in ready:
+            parent_paths = ancestor_paths(category.parent_category_id)
+            rows = [{'ancestor_id': category.id, 'descendant_id': category.id, 'depth': 0,
+                     'ancestor_level': len(parent_paths)}]
+            rows += [{'ancestor_id': path.ancestor_id, 'descendant_id': category.id, 'depth': path.depth + 1,
+                      'ancestor_level': path.ancestor_level} for path in parent_paths]
+            conn.execute(closure.insert(), rows)
+            del pending[category.id]
+    
+    for category in moved:
+        subtree = conn.execute(
+            db.select(closure.c.descendant_id, closure.c.depth).where(closure.c.ancestor_id == category.id)
+        ).all()
+        subtree_ids = [node.descendant_id for node in subtree]
+        old_level = conn.execute(
+            db.select(closure.c.ancestor_level).where(closure.c.ancestor_id == category.id, closure.c.depth == 0)
+        ).scalar() or 0
+        
+        # Detach the subtree from its old ancestors, then attach it under the new parent
+        conn.execute(closure.delete().where(
+            closure.c.descendant_id.in_(subtree_ids),
+            closure.c.ancestor_id.notin_(subtree_ids)
+        ))
+        parent_paths = ancestor_paths(category.parent_category_id)
+        if parent_paths:
+            conn.execute(closure.insert(), [
+                {'ancestor_id': path.ancestor_id, 'descendant_id': node.descendant_id,
+                 'depth': path.depth + 1 + node.depth, 'ancestor_level': path.ancestor_level}
+                for path in parent_paths for node in subtree
+            ])
+        level_shift = len(parent_paths) - old_level
+        if level_shift:
+            conn.execute(closure.update().where(closure.c.ancestor_id.in_(subtree_ids))
+                         .values(ancestor_level=closure.c.ancestor_level + level_shift))
+
+def signed_transaction_amount(transaction_type, amount, transfer_id):
+    """Effect of a transaction on its account balance.
+    
+    Transfer legs carry their sign in the amount (negative on the source account);
+    unpaired legacy transfers have no effect.
+    """
+    if amount is None:
+        return Decimal('0')
+    if transaction_type == 'income':
+        return Decimal(amount)
+    if transaction_type == 'expense':
+        return -Decimal(amount)
+    if transaction_type == 'transfer' and transfer_id:
+        return Decimal(amount)
+    return Decimal('0')
+
+def _load_previous_value(target, value, oldvalue, initiator):
+    pass
+
+def track_previous_values(model, fields):
+    """Load the stored value of these attributes before they are overwritten, so after_flush
+    listeners find it in the history even when an earlier commit expired the row"""
+    for field in fields:
+        event.listen(getattr(model, field), 'set', _load_previous_value, active_history=True)
+
+BALANCE_FIELDS = ('account_id', 'transaction_date', 'transaction_type', 'amount', 'transfer_id')
+track_previous_values(Transaction, BALANCE_FIELDS)
+
+@event.listens_for(db.session, 'after_flush')
+def maintain_balance_checkpoints(session, flush_context):
+    """Apply balance changes, including back-dated ones, to every later checkpoint of the account"""
+    deltas = {}  # (account_id, transaction_date) -> change in balance
+    
+    def add(values, sign):
+        account_id, transaction_date = values[0], values[1]
+        if account_id is None or transaction_date is None:
+            return
+        amount = signed_transaction_amount(*values[2:]) * sign
+        if amount:
+            key = (account_id, transaction_date)
+            deltas[key] = deltas.get(key, Decimal('0')) + amount
+    
+    for obj in session.new:
+        if isinstance(obj, Transaction):
+            add([getattr(obj, field) for field in BALANCE_FIELDS], 1)
+    for obj in session.deleted:
+        if isinstance(obj, Transaction):
+            add([getattr(obj, field) for field in BALANCE_FIELDS], -1)
+    for obj in session.dirty:
+        if not isinstance(obj, Transaction):
+            continue
+        attrs = inspect(obj).attrs
+        if not any(attrs[field].history.has_changes() for field in BALANCE_FIELDS):
+            continue
+        old = []
+        for field in BALANCE_FIELDS:
+            history = attrs[field].history
+            old.append(history.deleted[0] if history.deleted else getattr(obj, field))
+        add(old, -1)
+        add([getattr(obj, field) for field in BALANCE_FIELDS], 1)
+    
+    if not deltas:
+        return
+    checkpoints = AccountBalanceCheckpoint.__table__
+    conn = session.connection()
+    
+    # Rows dated before an account's first checkpoint month would leave a gap at the
+    # start of its history; drop those checkpoints and let them be rebuilt on demand
+    earliest = dict(conn.execute(
+        db.select(checkpoints.c.account_id, func.min(checkpoints.c.period_end))
+        .where(checkpoints.c.account_id.in_({account_id for account_id, _ in deltas}))
+        .group_by(checkpoints.c.account_id)
+    ).all())
+    stale = {account_id for account_id, transaction_date in deltas
+             if account_id in earliest and transaction_date < earliest[account_id].replace(day=1)}
+    if stale:
+        conn.execute(checkpoints.delete().where(checkpoints.c.account_id.in_(stale)))
+    
+    for (account_id, transaction_date), amount in deltas.items():
+        if account_id in stale:
+            continue
+        conn.execute(
+            checkpoints.update()
+            .where(checkpoints.c.account_id == account_id, checkpoints.c.period_end >= transaction_date)
+            .values(balance=checkpoints.c.balance + amount)
+        )
 
+def category_closure_rows(parents, category_ids):
+    """category_closure rows of the given categories, from a category id -> parent id map"""
+    rows = []
+    for category_id in category_ids:
+        # Walk up to the root; the path is ordered from the category itself upwards
+        path = [category_id]
+        while parents.get(path[-1]) is not None and parents[path[-1]] not in path:
+            path.append(parents[path[-1]])
+        for depth, ancestor_id in enumerate(path):
+            rows.append({'ancestor_id': ancestor_id, 'descendant_id': category_id, 'depth': depth,
+                         'ancestor_level': len(path) - 1 - depth})
+    return rows
+
+def rebuild_category_closure():
+    """Recreate category_closure from categories.parent_category_id"""
+    parents = dict(db.session.query(Category.id, Category.parent_category_id).all())
+    rows = category_closure_rows(parents, parents)
+    
+    db.session.execute(CategoryClosure.__table__.delete())
+    if rows:
+        db.session.execute(CategoryClosure.__table__.insert(), rows)
+    db.session.commit()
+    return len(rows)
+
+def init_category_closure():
+    """Populate category_closure for databases created before it existed"""
+    if Category.query.first() and not CategoryClosure.query.first():
+        rebuild_category_closure()
 
 # Initialize system categories
 def init_system_categories():
@@ -165,3 +600,40 @@ def init_system_categories():
             db.session.add(category)
     
     db.session.commit()
+
+# Keywords of the system categories, matched as whole words (see categorizer.py)
+SYSTEM_CATEGORY_RULES = {
+    'Food & Dining': ['restaurant', 'cafe', 'coffee', 'starbucks', 'mcdonalds', 'pizza', 'groceries', 'grocery',
+                      'supermarket', 'bakery', 'doordash', 'grubhub', 'uber eats', 'lunch', 'dinner', 'breakfast'],
+    'Transportation': ['gas', 'fuel', 'petrol', 'uber', 'lyft', 'taxi', 'parking', 'toll', 'metro', 'bus',
+                       'train ticket', 'car wash'],
+    'Shopping': ['amazon', 'walmart', 'target', 'ebay', 'clothing', 'shoes', 'electronics'],
+    'Entertainment': ['netflix', 'spotify', 'hulu', 'disney', 'cinema', 'movie', 'movies', 'concert', 'steam',
+                      'playstation', 'xbox'],
+    'Bills & Utilities': ['rent', 'electricity', 'electric bill', 'gas bill', 'water bill', 'internet', 'phone bill',
+                          'utility', 'utilities', 'insurance', 'mortgage'],
+    'Healthcare': ['pharmacy', 'doctor', 'dentist', 'hospital', 'clinic', 'medical', 'prescription', 'cvs',
+                   'walgreens'],
+    'Travel': ['hotel', 'airbnb', 'flight', 'airline', 'airlines', 'expedia', 'booking com', 'vacation'],
+    'Education': ['tuition', 'school', 'course', 'udemy', 'coursera', 'textbook', 'books'],
+    'Personal Care': ['haircut', 'salon', 'barber', 'spa', 'gym', 'fitness', 'cosmetics'],
+    'Home & Garden': ['home depot', 'lowes', 'ikea', 'hardware', 'garden', 'cleaning', 'furniture'],
+    'Salary': ['salary', 'payroll', 'paycheck', 'wages'],
+    'Freelance': ['freelance', 'upwork', 'fiverr', 'invoice'],
+    'Investments': ['dividend', 'dividends', 'interest', 'capital gain'],
+    'Business': ['client payment', 'sales revenue'],
+}
+
+def init_system_category_rules():
+    """Add system category rules that don't exist yet"""
+    categories = dict(db.session.query(Category.name, Category.id).filter_by(is_system=True, user_id=None).all())
+    existing = {pattern for (pattern,) in db.session.query(CategoryRule.pattern).filter(CategoryRule.user_id.is_(None))}
+    for name, patterns in SYSTEM_CATEGORY_RULES.items():
+        if name not in categories:
+            continue
+        for pattern in patterns:
+            if pattern not in existing:
+                db.session.add(CategoryRule(pattern=pattern, category_id=categories[name], source='system'))
+                existing.add(pattern)
+    
+    db.session.commit()
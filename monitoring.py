@@ -0,0 +1,21 @@
+import hmac
+import os
+from functools import wraps
+from flask import request, jsonify
+
+def require_internal_access(f):
+    """Allow only local requests, or ones presenting the METRICS_TOKEN bearer token"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = os.environ.get('METRICS_TOKEN')
+        if token:
+            supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+            allowed = hmac.compare_digest(supplied, token)
+        else:
+            allowed = request.remote_addr in ('127.0.0.1', '::1')
+        
+        if not allowed:
+            return jsonify({'success': False, 'message': 'Forbidden'}), 403
+        return f(*args, **kwargs)
+    
+    return decorated_function
@@ -0,0 +1,137 @@
+import logging
+from datetime import date
+from sqlalchemy import text
+from sqlalchemy.schema import AddConstraint, CreateIndex
+from app import db
+
+PARENT = 'transactions'
+DEFAULT_PARTITION = 'transactions_default'
+
+def partition_name(year):
+    return f'transactions_y{year}'
+
+def is_partitioned(conn):
+    """True when the transactions table is a PostgreSQL partitioned table"""
+    if conn.dialect.name != 'postgresql':
+        return False
+    return conn.execute(text(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:name)"
+    ), {'name': PARENT}).scalar() or False
+
+def partition_years(conn):
+    """Years that have their own partition"""
+    names = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(:name)"
+    ), {'name': PARENT}).scalars()
+    prefix = partition_name('')
+    return {int(name[len(prefix):]) for name in names if name.startswith(prefix) and name[len(prefix):].isdigit()}
+
+def create_partition(conn, year):
+    """Create the partition for one year, moving any of its rows out of the default partition"""
+    name = partition_name(year)
+    bounds = f"FROM ('{date(year, 1, 1)}') TO ('{date(year + 1, 1, 1)}')"
+    in_year = f"transaction_date >= '{date(year, 1, 1)}' AND transaction_date < '{date(year + 1, 1, 1)}'"
+    
+    has_default = conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {'name': DEFAULT_PARTITION}).scalar()
+    if has_default and conn.execute(text(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE {in_year})")).scalar():
+        # Postgres refuses to add a partition whose rows sit in the default partition
+        conn.execute(text(f"CREATE TABLE {name} (LIKE {PARENT} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+        conn.execute(text(f"INSERT INTO {name} SELECT * FROM {DEFAULT_PARTITION} WHERE {in_year}"))
+        conn.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE {in_year}"))
+        conn.execute(text(f"ALTER TABLE {PARENT} ATTACH PARTITION {name} FOR VALUES {bounds}"))
+    else:
+        conn.execute(text(f"CREATE TABLE {name} PARTITION OF {PARENT} FOR VALUES {bounds}"))
+    logging.info(f"Created partition {name}")
+
+def ensure_future_partitions(years_ahead=1):
+    """Create partitions for the current year and the next `years_ahead` years if missing.
+    
+    A no-op unless transactions is partitioned, so it is cheap to call at startup.
+    """
+    try:
+        with db.engine.begin() as conn:
+            if not is_partitioned(conn):
+                return
+            existing = partition_years(conn)
+            for year in range(date.today().year, date.today().year + years_ahead + 1):
+                if year not in existing:
+                    create_partition(conn, year)
+    except Exception as e:
+        # Another worker creating the same partition at startup is harmless
+        logging.warning(f"Could not create transaction partitions: {str(e)}")
+
+def partition_transactions(years_ahead=1):
+    """Convert the transactions table into one partitioned by year of transaction_date.
+    
+    PostgreSQL requires the partition key in every primary key and unique index,
+    so the primary key becomes (id, transaction_date) and the idempotency key is
+    unique per date (a retried batch item repeats its date). transaction_tags can
+    no longer reference transactions by id alone; its rows are removed by the ORM
+    when a transaction is deleted. Returns the number of rows copied.
+    """
+    from models import Transaction
+    table = Transaction.__table__
+    
+    with db.engine.begin() as conn:
+        if conn.dialect.name != 'postgresql':
+            raise RuntimeError('Partitioning needs PostgreSQL')
+        if is_partitioned(conn):
+            raise RuntimeError('transactions is already partitioned')
+        
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence(:name, 'id')"), {'name': PARENT}).scalar()
+        years = conn.execute(text(
+            f"SELECT EXTRACT(YEAR FROM MIN(transaction_date))::int, EXTRACT(YEAR FROM MAX(transaction_date))::int FROM {PARENT}"
+        )).one()
+        
+        conn.execute(text(f"ALTER TABLE {PARENT} RENAME TO transactions_unpartitioned"))
+        conn.execute(text(
+            f"CREATE TABLE {PARENT} (LIKE transactions_unpartitioned INCLUDING DEFAULTS) "
+            f"PARTITION BY RANGE (transaction_date)"
+        ))
+        first_year = years[0] or date.today().year
+        last_year = max(years[1] or first_year, date.today().year + years_ahead)
+        for year in range(first_year, last_year + 1):
+            create_partition(conn, year)
+        conn.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {PARENT} DEFAULT"))
+        
+        copied = conn.execute(text(f"INSERT INTO {PARENT} SELECT * FROM transactions_unpartitioned")).rowcount
+        
+        # Keep the id sequence when the old table (and the FK from transaction_tags) goes
+        if sequence:
+            conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY NONE"))
+        conn.execute(text("DROP TABLE transactions_unpartitioned CASCADE"))
+        if sequence:
+            conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {PARENT}.id"))
+        
+        # Keys and indexes are built after the copy, once the old table's names are free
+        conn.execute(text(f"ALTER TABLE {PARENT} ADD PRIMARY KEY (id, transaction_date)"))
+        for constraint in table.foreign_key_constraints:
+            conn.execute(AddConstraint(constraint))
+        for index in table.indexes:
+            if index.unique:
+                columns = ', '.join(column.name for column in index.columns)
+                conn.execute(text(f"CREATE UNIQUE INDEX {index.name} ON {PARENT} ({columns}, transaction_date)"))
+            else:
+                conn.execute(CreateIndex(index))
+    
+    logging.info(f"Partitioned {PARENT} ({copied} rows)")
+    return copied
+
+def detach_partition(conn, year, expected_rows=None):
+    """Detach and drop a year's partition; True if there was one.
+    
+    With expected_rows the partition is locked and kept (returning False) unless it
+    holds exactly that many rows, so rows added since they were read are not lost.
+    """
+    if not is_partitioned(conn) or year not in partition_years(conn):
+        return False
+    name = partition_name(year)
+    if expected_rows is not None:
+        conn.execute(text(f"LOCK TABLE {name} IN ACCESS EXCLUSIVE MODE"))
+        if conn.execute(text(f"SELECT COUNT(*) FROM {name}")).scalar() != expected_rows:
+            logging.warning(f"Keeping partition {name}: it has rows that were not archived")
+            return False
+    conn.execute(text(f"ALTER TABLE {PARENT} DETACH PARTITION {name}"))
+    conn.execute(text(f"DROP TABLE {name}"))
+    return True
@@ -0,0 +1,37 @@
+import threading
+import time
+
+class TokenBucketLimiter:
+    """Per-key token buckets holding up to `burst` tokens, refilled at `rate` tokens per second.
+    
+    Buckets live in process memory like cache.TTLCache, so with several worker
+    processes each enforces the limit separately.
+    """
+    
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = {}  # key -> (tokens, monotonic time of last update)
+        self._lock = threading.Lock()
+    
+    def try_acquire(self, key, tokens=1):
+        """Take tokens from key's bucket. Returns 0 on success, else the seconds until they are available"""
+        now = time.monotonic()
+        with self._lock:
+            available, updated = self._buckets.get(key, (self.burst, now))
+            available = min(self.burst, available + (now - updated) * self.rate)
+            if available >= tokens:
+                if key not in self._buckets and len(self._buckets) >= self.max_keys:
+                    self._prune(now)
+                self._buckets[key] = (available - tokens, now)
+                return 0
+            self._buckets[key] = (available, now)
+            return (tokens - available) / self.rate if self.rate else float('inf')
+    
+    def _prune(self, now):
+        # A bucket that has refilled completely behaves exactly like a missing one
+        self._buckets = {
+            key: (available, updated) for key, (available, updated) in self._buckets.items()
+            if available + (now - updated) * self.rate < self.burst
+        }
@@ -0,0 +1,82 @@
+from collections import namedtuple
+from app import db
+from models import Account, Budget, Category, Tag, Transaction, transaction_tags
+
+# Read-only rows for list and dashboard views. They are built from column projections with
+# the category and account joined in, so rendering a page never lazy-loads a relationship.
+# The nested refs keep attribute access such as `transaction.category.name` working.
+CategoryRef = namedtuple('CategoryRef', 'id name color icon')
+AccountRef = namedtuple('AccountRef', 'id name account_type currency')
+TagRef = namedtuple('TagRef', 'id name')
+TransactionRow = namedtuple('TransactionRow', 'id transaction_date description amount base_amount transaction_type '
+                                              'payment_method notes is_recurring transfer_id created_at '
+                                              'category account tags')
+BudgetRow = namedtuple('BudgetRow', 'id category_id amount period start_date end_date category')
+
+def _category_ref(row):
+    if row.category_id is None:
+        return None
+    return CategoryRef(row.category_id, row.category_name, row.category_color, row.category_icon)
+
+def transaction_row_query(*criteria):
+    """Query of the columns a TransactionRow is built from, filtered by criteria"""
+    return db.session.query(
+        Transaction.id,
+        Transaction.transaction_date,
+        Transaction.description,
+        Transaction.amount,
+        Transaction.base_amount,
+        Transaction.transaction_type,
+        Transaction.payment_method,
+        Transaction.notes,
+        Transaction.is_recurring,
+        Transaction.transfer_id,
+        Transaction.created_at,
+        Category.id.label('category_id'),
+        Category.name.label('category_name'),
+        Category.color.label('category_color'),
+        Category.icon.label('category_icon'),
+        Account.id.label('account_id'),
+        Account.name.label('account_name'),
+        Account.account_type,
+        Account.currency
+    ).join(Account, Account.id == Transaction.account_id)\
+    .outerjoin(Category, Category.id == Transaction.category_id)\
+    .filter(*criteria)
+
+def transaction_rows(rows):
+    """TransactionRows for the results of transaction_row_query, with all their tags read in one query"""
+    tags = {}
+    transaction_ids = [row.id for row in rows]
+    if transaction_ids:
+        tag_rows = db.session.query(transaction_tags.c.transaction_id, Tag.id, Tag.name)\
+            .join(Tag, Tag.id == transaction_tags.c.tag_id)\
+            .filter(transaction_tags.c.transaction_id.in_(transaction_ids))\
+            .order_by(Tag.name)
+        for transaction_id, tag_id, name in tag_rows:
+            tags.setdefault(transaction_id, []).append(TagRef(tag_id, name))
+    
+    return [TransactionRow(
+        row.id, row.transaction_date, row.description, row.amount, row.base_amount, row.transaction_type,
+        row.payment_method, row.notes, row.is_recurring, row.transfer_id, row.created_at,
+        _category_ref(row),
+        AccountRef(row.account_id, row.account_name, row.account_type, row.currency),
+        tuple(tags.get(row.id, ()))
+    ) for row in rows]
+
+def budget_rows(*criteria):
+    """BudgetRows matching criteria, with their category"""
+    rows = db.session.query(
+        Budget.id,
+        Budget.amount,
+        Budget.period,
+        Budget.start_date,
+        Budget.end_date,
+        Category.id.label('category_id'),
+        Category.name.label('category_name'),
+        Category.color.label('category_color'),
+        Category.icon.label('category_icon')
+    ).join(Category, Category.id == Budget.category_id).filter(*criteria).order_by(Budget.id).all()
+    return [BudgetRow(row.id, row.category_id, row.amount, row.period, row.start_date, row.end_date,
+                      _category_ref(row))
+            for row in rows]
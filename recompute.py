@@ -0,0 +1,222 @@
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime
+from decimal import Decimal
+from itertools import chain
+from sqlalchemy import func, or_
+from app import app, db
+from models import (Account, AccountBalanceCheckpoint, Budget, BudgetSpend, Category, CategoryClosure,
+                    FinancialHealthScore, RecomputeProgress, Transaction, User, category_closure_rows)
+from utils import (BASE_AMOUNT, signed_amount, get_archived_totals, ensure_balance_checkpoints, _checkpoint_horizon,
+                   base_amount_expression, reconvert_base_amounts, calculate_health_score_factors,
+                   refresh_financial_health_score, rebuild_budget_spend, month_range, _month_spent)
+
+def _account_ids(user_id):
+    return [account_id for (account_id,) in db.session.query(Account.id).filter(Account.user_id == user_id)]
+
+def recompute_balances(user_id):
+    """Rebuild a user's month-end balance checkpoints up to the last closed month"""
+    account_ids = _account_ids(user_id)
+    AccountBalanceCheckpoint.query.filter(AccountBalanceCheckpoint.account_id.in_(account_ids)).delete(
+        synchronize_session=False
+    )
+    db.session.commit()
+    for account_id in account_ids:
+        ensure_balance_checkpoints(account_id, _checkpoint_horizon(date.today()))
+    return AccountBalanceCheckpoint.query.filter(AccountBalanceCheckpoint.account_id.in_(account_ids)).count()
+
+def verify_balances(user_id):
+    diffs = []
+    for account_id in _account_ids(user_id):
+        checkpoints = AccountBalanceCheckpoint.query.filter_by(account_id=account_id).order_by(
+            AccountBalanceCheckpoint.period_end
+        ).all()
+        if not checkpoints:
+            continue
+        
+        # One grouped query per account, summed up in order alongside the checkpoints
+        daily = db.session.query(Transaction.transaction_date, func.sum(signed_amount())).filter(
+            Transaction.account_id == account_id,
+            Transaction.transaction_date <= checkpoints[-1].period_end
+        ).group_by(Transaction.transaction_date).all()
+        changes = sorted(chain(daily, get_archived_totals(account_id).items()))
+        running, index = Decimal('0'), 0
+        for checkpoint in checkpoints:
+            while index < len(changes) and changes[index][0] <= checkpoint.period_end:
+                running += Decimal(str(changes[index][1] or 0))
+                index += 1
+            if Decimal(str(checkpoint.balance)) != running:
+                diffs.append(f'account {account_id} at {checkpoint.period_end}: stored {checkpoint.balance}, '
+                             f'expected {running}')
+    return diffs
+
+def _expected_closure(user_id):
+    # A user's categories may sit under system categories, so both are needed for the paths
+    parents = dict(db.session.query(Category.id, Category.parent_category_id).filter(
+        or_(Category.user_id == user_id, Category.user_id.is_(None))
+    ).all())
+    category_ids = [category_id for (category_id,) in db.session.query(Category.id).filter(Category.user_id == user_id)]
+    return category_ids, category_closure_rows(parents, category_ids)
+
+def recompute_rollups(user_id):
+    """Rewrite the category_closure rows of a user's categories"""
+    category_ids, rows = _expected_closure(user_id)
+    closure = CategoryClosure.__table__
+    db.session.execute(closure.delete().where(closure.c.descendant_id.in_(category_ids)))
+    if rows:
+        db.session.execute(closure.insert(), rows)
+    db.session.commit()
+    return len(rows)
+
+def verify_rollups(user_id):
+    category_ids, rows = _expected_closure(user_id)
+    key = ('ancestor_id', 'descendant_id', 'depth', 'ancestor_level')
+    expected = {tuple(row[field] for field in key) for row in rows}
+    stored = set(db.session.query(
+        CategoryClosure.ancestor_id, CategoryClosure.descendant_id, CategoryClosure.depth, CategoryClosure.ancestor_level
+    ).filter(CategoryClosure.descendant_id.in_(category_ids)).all())
+    return [f'missing closure row {row}' for row in sorted(expected - stored)] + \
+           [f'unexpected closure row {row}' for row in sorted(stored - expected)]
+
+def recompute_scores(user_id):
+    """Recompute and store a user's financial health score"""
+    refresh_financial_health_score(user_id)
+    return 1
+
+def verify_scores(user_id):
+    stored = db.session.get(FinancialHealthScore, user_id)
+    if stored is None:
+        return ['no stored health score']
+    return [
+        f'{name}: stored {getattr(stored, name)}, expected {value}'
+        for name, value in calculate_health_score_factors(user_id).items()
+        if abs(getattr(stored, name) - value) > 1e-6
+    ]
+
+def recompute_base_amounts(user_id):
+    """Reconvert a user's stored base-currency amounts at the current exchange rates"""
+    return reconvert_base_amounts(user_id=user_id)
+
+def verify_base_amounts(user_id):
+    expected = base_amount_expression()
+    # Rows without a base amount predate currencies and count their amount as is
+    mismatches = db.session.query(Transaction.id, BASE_AMOUNT, expected).filter(
+        Transaction.user_id == user_id,
+        BASE_AMOUNT.is_distinct_from(expected)
+    ).order_by(Transaction.id).all()
+    return [f'transaction {transaction_id}: stored {stored}, expected {value}'
+            for transaction_id, stored, value in mismatches]
+
+def recompute_budget_spend(user_id):
+    """Rebuild the current month's running spend of a user's budgets"""
+    return rebuild_budget_spend(user_id)
+
+def verify_budget_spend(user_id):
+    period_start, period_end = month_range()
+    counters = db.session.query(Budget, BudgetSpend.spent).join(BudgetSpend, BudgetSpend.budget_id == Budget.id).filter(
+        Budget.user_id == user_id,
+        BudgetSpend.period_start == period_start
+    ).all()
+    conn = db.session.connection()
+    diffs = []
+    for budget, stored in counters:
+        expected = _month_spent(conn, user_id, budget.category_id, period_start, period_end)
+        if Decimal(str(stored)) != expected:
+            diffs.append(f'budget {budget.id}: stored {stored}, expected {expected}')
+    return diffs
+
+# Derived data `flask recompute` can rebuild or verify: name -> (recompute, verify), both per user.
+# recompute returns the number of rows written, verify a list of differences.
+TARGETS = {
+    'balances': (recompute_balances, verify_balances),
+    'rollups': (recompute_rollups, verify_rollups),
+    'scores': (recompute_scores, verify_scores),
+    'base-amounts': (recompute_base_amounts, verify_base_amounts),
+    'budget-spend': (recompute_budget_spend, verify_budget_spend),
+}
+
+_pace = 0  # minimum seconds per user in this worker process
+
+def _init_worker(pace):
+    global _pace
+    _pace = pace
+    # Inherited connections are dropped after fork (see db_pool), so each process opens its own
+    app.app_context().push()
+
+def _run_batch(target, user_ids, verify):
+    """Process one batch of users in a pool process: (users done, rows written, diffs, failures)"""
+    recompute_user, verify_user = TARGETS[target]
+    done, rows, diffs, failed = [], 0, {}, {}
+    for user_id in user_ids:
+        started = time.monotonic()
+        try:
+            if verify:
+                found = verify_user(user_id)
+                if found:
+                    diffs[user_id] = found
+            else:
+                rows += recompute_user(user_id)
+            done.append(user_id)
+        except Exception as e:
+            db.session.rollback()
+            failed[user_id] = f"{type(e).__name__}: {str(e)}"
+            logging.error(f"Recompute {target} failed for user {user_id}: {failed[user_id]}")
+        finally:
+            db.session.remove()
+        
+        # Throttle: keep this process to its share of the overall users per second
+        remaining = _pace - (time.monotonic() - started)
+        if remaining > 0:
+            time.sleep(remaining)
+    return done, rows, diffs, failed
+
+def run(target, user_ids=None, workers=4, batch_size=50, rate=0, verify=False, restart=False, echo=print):
+    """Recompute or verify `target` for the given (default all) users on a process pool.
+    
+    Batches go to whichever process is free. A full recompute run records finished
+    users in recompute_progress, so an interrupted run resumes where it stopped;
+    the progress is cleared once every user succeeded. `rate` caps users per second
+    across all processes. Returns a summary dict.
+    """
+    checkpointed = user_ids is None and not verify
+    if user_ids is None:
+        user_ids = [user_id for (user_id,) in db.session.query(User.id).order_by(User.id)]
+    if checkpointed:
+        if restart:
+            RecomputeProgress.query.filter_by(target=target).delete()
+            db.session.commit()
+        finished = {user_id for (user_id,) in db.session.query(RecomputeProgress.user_id).filter_by(target=target)}
+        if finished:
+            echo(f'Resuming: {len(finished)} users already done')
+        user_ids = [user_id for user_id in user_ids if user_id not in finished]
+    
+    batches = [user_ids[i:i + batch_size] for i in range(0, len(user_ids), batch_size)]
+    summary = {'users': 0, 'rows': 0, 'diffs': {}, 'failed': {}, 'seconds': 0.0}
+    started = time.monotonic()
+    pace = workers / rate if rate else 0
+    
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(pace,)) as executor:
+        futures = [executor.submit(_run_batch, target, batch, verify) for batch in batches]
+        for future in as_completed(futures):
+            done, rows, diffs, failed = future.result()
+            if checkpointed and done:
+                db.session.execute(RecomputeProgress.__table__.insert(), [
+                    {'target': target, 'user_id': user_id, 'completed_at': datetime.now()} for user_id in done
+                ])
+                db.session.commit()
+            
+            summary['users'] += len(done) + len(failed)
+            summary['rows'] += rows
+            summary['diffs'].update(diffs)
+            summary['failed'].update(failed)
+            elapsed = time.monotonic() - started
+            per_second = summary['users'] / elapsed if elapsed else 0
+            eta = (len(user_ids) - summary['users']) / per_second if per_second else 0
+            echo(f"{summary['users']}/{len(user_ids)} users, {per_second:.1f} users/s, ETA {eta:.0f}s")
+    
+    summary['seconds'] = time.monotonic() - started
+    if checkpointed and not summary['failed']:
+        RecomputeProgress.query.filter_by(target=target).delete()
+        db.session.commit()
+    return summary
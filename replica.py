@@ -0,0 +1,113 @@
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from flask import g
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, select
+from sqlalchemy.exc import OperationalError
+
+# Bind key of the optional read replica in SQLALCHEMY_BINDS
+REPLICA_BIND = 'replica'
+
+# Seconds to stop using the replica after a connection error
+REPLICA_RETRY_AFTER = 30
+
+_route_to_replica = ContextVar('route_to_replica', default=False)
+_replica_down_until = 0.0
+
+# Counters for monitoring how often reads actually reach the replica
+stats = {'replica_reads': 0, 'lag_fallbacks': 0, 'error_fallbacks': 0}
+
+class RoutingSession(Session):
+    """Session that sends reads to the replica inside use_replica(); everything else uses the primary"""
+    
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and _route_to_replica.get() and not self._flushing
+                and not getattr(clause, 'is_dml', False)):
+            engine = self._db.engines.get(REPLICA_BIND)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_session_written(session, flush_context):
+    # Once this request has written anything, keep its reads on the primary
+    session.info['has_writes'] = True
+
+def _replica_is_current(db, user_id):
+    """Whether the replica has caught up with the primary for this user's data.
+    
+    Compares User.data_version, which every write to the user's data bumps, so a
+    lagging replica never serves a user stale results of their own writes.
+    """
+    from models import User
+    
+    checked = g.setdefault('_replica_current', {})
+    if user_id not in checked:
+        query = select(User.data_version).where(User.id == user_id)
+        primary_version = db.session.execute(query).scalar() or 0
+        replica_version = db.session.execute(
+            query, bind_arguments={'bind': db.engines[REPLICA_BIND]}
+        ).scalar() or 0
+        checked[user_id] = replica_version >= primary_version
+    return checked[user_id]
+
+@contextmanager
+def use_replica(user_id):
+    """Route reads in this block to the replica when it is safe to do so.
+    
+    Falls back to the primary when no replica is configured, the session has
+    pending or committed writes (read-your-writes), the replica lags behind
+    for this user, or the replica recently failed.
+    """
+    from app import db
+    
+    session = db.session()
+    if (_route_to_replica.get()
+            or REPLICA_BIND not in db.engines
+            or time.monotonic() < _replica_down_until
+            or session.info.get('has_writes')
+            or session.new or session.dirty or session.deleted):
+        yield False
+        return
+    
+    if not _replica_is_current(db, user_id):
+        stats['lag_fallbacks'] += 1
+        yield False
+        return
+    
+    token = _route_to_replica.set(True)
+    try:
+        stats['replica_reads'] += 1
+        yield True
+    except OperationalError as e:
+        # Only reads are routed here, so replica_reads may retry this one on the primary
+        e.from_replica = True
+        raise
+    finally:
+        _route_to_replica.reset(token)
+
+def replica_reads(f):
+    """Run a read-only helper taking user_id as its first argument against the replica"""
+    @wraps(f)
+    def decorated_function(user_id, *args, **kwargs):
+        global _replica_down_until
+        from app import db
+        
+        try:
+            with use_replica(user_id):
+                return f(user_id, *args, **kwargs)
+        except OperationalError as e:
+            # Errors of the primary (lock timeouts, the lag check, reads while the replica lags) are the caller's
+            if not getattr(e, 'from_replica', False):
+                raise
+            # Replica unreachable or broken: back off and answer from the primary
+            logging.warning(f"Read replica failed, using primary: {str(e)}")
+            stats['error_fallbacks'] += 1
+            _replica_down_until = time.monotonic() + REPLICA_RETRY_AFTER
+            db.session.rollback()
+            return f(user_id, *args, **kwargs)
+    
+    return decorated_function
@@ -94,9 +94,9 @@ def make_replit_blueprint():
 
     @replit_bp.before_app_request
     def set_applocal_session():
+        # Only touch the session when the key is missing, so unchanged sessions are not re-saved
         if '_browser_session_key' not in session:
             session['_browser_session_key'] = uuid.uuid4().hex
-        session.modified = True
         g.browser_session_key = session['_browser_session_key']
         g.flask_dance_replit = replit_bp.session
 
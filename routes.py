@@ -1,79 +1,90 @@
-from flask import session, render_template, request, redirect, url_for, flash, jsonify
+from flask import session, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context
 from flask_login import current_user
+from sqlalchemy.exc import IntegrityError
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import RequestEntityTooLarge
 from datetime import datetime, date, timedelta
 from decimal import Decimal
+import csv
+import io
+import math
+import os
+import time
 from app import app, db
+from cache import TTLCache
+from dashboard import WIDGETS, UNCACHED_WIDGETS, widget_cache_key
 from replit_auth import require_login, make_replit_blueprint
-from models import Account, Transaction, Category, Budget, SavingsGoal, Bill, init_system_categories
+from monitoring import require_internal_access
+import metrics
+from read_models import transaction_row_query, transaction_rows
+from anomalies import get_spending_anomalies
+from timeseries import SERIES, DOWNSAMPLE_METHODS, data_range, get_daily_series, downsample, encode_series
+from duplicates import (transaction_fingerprint, find_fingerprint_matches, find_duplicate_transaction,
+                        normalize_description)
+from categorizer import CATEGORIZED_TYPES, get_matchers, categorize, learn_rules
+from db_pool import get_pool_stats
+from jobs import get_job_stats
+from models import (Account, Transaction, Category, CategoryRule, Budget, SavingsGoal, Bill, Tag,
+                    init_system_categories, init_category_closure, init_system_category_rules)
 from forms import AccountForm, TransactionForm, BudgetForm, SavingsGoalForm, CategoryForm, BillForm
 from utils import *
 
+# Per-process cache for dashboard widgets; keys embed the user's data version
+widget_cache = TTLCache(name='widgets')
+
 # Register Replit Auth blueprint
 app.register_blueprint(make_replit_blueprint(), url_prefix="/auth")
 
-# Initialize system categories on first run
+# Initialize system categories, their rules and the category tree on first run
 with app.app_context():
     init_system_categories()
+    init_system_category_rules()
+    init_category_closure()
 
 # Make session permanent
 @app.before_request
 def make_session_permanent():
-    session.permanent = True
+    # Assigning marks the session modified, so only do it once
+    if not session.permanent:
+        session.permanent = True
 
 @app.route('/')
 def index():
-    """Landing page for logged out users, dashboard for logged in users"""
+    """Landing page for logged out users, dashboard shell for logged in users.
+    
+    The shell renders immediately; each widget is fetched in parallel by the
+    browser from dashboard_widget, so the slowest one no longer blocks the page.
+    """
     if not current_user.is_authenticated:
         return render_template('landing.html')
     
-    # Dashboard data for logged in users
-    user_id = current_user.id
-    
-    # Get user accounts with balances
-    accounts = Account.query.filter_by(user_id=user_id, is_active=True).all()
-    account_data = []
-    total_balance = Decimal('0')
-    
-    for account in accounts:
-        balance = get_account_balance(account.id)
-        account.balance = balance  # Update balance
-        account_data.append(account)
-        if account.account_type in ['checking', 'savings', 'investment']:
-            total_balance += balance
-        elif account.account_type == 'credit':
-            total_balance -= abs(balance)
-    
-    # Get recent transactions
-    recent_transactions = get_recent_transactions(user_id)
-    
-    # Get monthly spending by category
-    monthly_spending = get_monthly_spending_by_category(user_id)
-    
-    # Get budget progress
-    budget_progress = get_budget_progress(user_id)
-    
-    # Get savings goals
-    savings_goals = get_savings_goals_progress(user_id)
-    
-    # Get upcoming bills
-    upcoming_bills = get_upcoming_bills(user_id)
-    
-    # Calculate financial health score
-    health_score = get_financial_health_score(user_id)
+    widget_urls = {name: url_for('dashboard_widget', name=name) for name in WIDGETS}
+    return render_template('dashboard.html', widget_urls=widget_urls)
+
+@app.route('/dashboard/widgets/<name>')
+@require_login
+def dashboard_widget(name):
+    """JSON data for a single dashboard widget, cached per user data version"""
+    build_widget = WIDGETS.get(name)
+    if not build_widget:
+        return jsonify({'success': False, 'message': f'Unknown widget: {name}'}), 404
     
-    # Get net worth data
-    net_worth_data = calculate_net_worth(user_id)
+    started = time.perf_counter()
+    if name in UNCACHED_WIDGETS:
+        data, cache_hit = build_widget(current_user), False
+    else:
+        data, cache_hit = widget_cache.get_or_set(
+            widget_cache_key(name, current_user),
+            lambda: build_widget(current_user),
+            app.config['WIDGET_CACHE_TTL']
+        )
+    duration_ms = (time.perf_counter() - started) * 1000
+    app.logger.debug(f"Dashboard widget {name}: {duration_ms:.1f}ms (cache {'hit' if cache_hit else 'miss'})")
     
-    return render_template('dashboard.html',
-                         accounts=account_data,
-                         total_balance=total_balance,
-                         recent_transactions=recent_transactions,
-                         monthly_spending=monthly_spending,
-                         budget_progress=budget_progress,
-                         savings_goals=savings_goals,
-                         upcoming_bills=upcoming_bills,
-                         health_score=health_score,
-                         net_worth_data=net_worth_data)
+    response = jsonify(data)
+    response.headers['Server-Timing'] = f'{name};dur={duration_ms:.1f};desc="cache {"hit" if cache_hit else "miss"}"'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 @app.route('/accounts')
 @require_login
@@ -92,6 +103,7 @@ def accounts():
 def add_account():
     """Add new account"""
     form = AccountForm()
+    form.currency.choices = get_currency_choices()
     
     if form.validate_on_submit():
         account = Account(
@@ -114,12 +126,16 @@ def edit_account(account_id):
     """Edit account"""
     account = Account.query.filter_by(id=account_id, user_id=current_user.id).first_or_404()
     form = AccountForm(obj=account)
+    form.currency.choices = get_currency_choices()
     
     if form.validate_on_submit():
+        currency_changed = account.currency != form.currency.data
         account.name = form.name.data
         account.account_type = form.account_type.data
         account.currency = form.currency.data
         db.session.commit()
+        if currency_changed:
+            reconvert_base_amounts(account_id=account.id)
         flash('Account updated successfully!', 'success')
         return redirect(url_for('accounts'))
     
@@ -146,16 +162,22 @@ def transactions():
     account_id = request.args.get('account_id', type=int)
     category_id = request.args.get('category_id', type=int)
     transaction_type = request.args.get('type')
+    tag_names = parse_tag_names(','.join(request.args.getlist('tag')))
     
-    # Build query
-    query = Transaction.query.filter_by(user_id=current_user.id)
+    # Build query over the listed columns only, with category and account names joined in
+    query = transaction_row_query(Transaction.user_id == current_user.id)
     
     if account_id:
-        query = query.filter_by(account_id=account_id)
+        query = query.filter(Transaction.account_id == account_id)
     if category_id:
-        query = query.filter_by(category_id=category_id)
+        query = query.filter(Transaction.category_id == category_id)
     if transaction_type:
-        query = query.filter_by(transaction_type=transaction_type)
+        query = query.filter(Transaction.transaction_type == transaction_type)
+    for tag_name in tag_names:
+        # Each tag narrows the results; resolved through the (user_id, name) and tag_id indexes
+        query = query.filter(Transaction.tags.any(
+            (Tag.user_id == current_user.id) & (Tag.name == tag_name)
+        ))
     
     # Paginate
     transactions_paginated = query.order_by(
@@ -164,6 +186,7 @@ def transactions():
     ).paginate(
         page=page, per_page=per_page, error_out=False
     )
+    transactions_paginated.items = transaction_rows(transactions_paginated.items)
     
     # Get filter options
     user_accounts = Account.query.filter_by(user_id=current_user.id, is_active=True).all()
@@ -174,7 +197,34 @@ def transactions():
     return render_template('transactions.html',
                          transactions=transactions_paginated,
                          accounts=user_accounts,
-                         categories=user_categories)
+                         categories=user_categories,
+                         tags=get_user_tags(current_user.id),
+                         selected_tags=tag_names)
+
+@app.route('/transactions/export')
+@require_login
+def export_transactions():
+    """CSV export of transactions, including archived years: ?start=&end="""
+    try:
+        start_date = date.fromisoformat(request.args['start']) if request.args.get('start') else None
+        end_date = date.fromisoformat(request.args['end']) if request.args.get('end') else None
+    except ValueError:
+        return jsonify({'success': False, 'message': 'start and end must be YYYY-MM-DD dates'}), 400
+    
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+        for count, row in enumerate(iter_transactions_for_export(current_user.id, start_date, end_date), 1):
+            writer.writerow(row)
+            if count % 500 == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=transactions.csv'})
 
 @app.route('/transactions/add', methods=['GET', 'POST'])
 @require_login
@@ -185,6 +235,7 @@ def add_transaction():
     # Populate choices
     user_accounts = Account.query.filter_by(user_id=current_user.id, is_active=True).all()
     form.account_id.choices = [(a.id, f"{a.name} ({a.account_type})") for a in user_accounts]
+    form.to_account_id.choices = form.account_id.choices
     
     user_categories = Category.query.filter(
         (Category.user_id == current_user.id) | (Category.is_system == True)
@@ -192,36 +243,54 @@ def add_transaction():
     form.category_id.choices = [(c.id, c.name) for c in user_categories]
     
     if form.validate_on_submit():
-        transaction = Transaction(
-            user_id=current_user.id,
-            account_id=form.account_id.data,
-            category_id=form.category_id.data,
-            transaction_type=form.transaction_type.data,
-            amount=form.amount.data,
-            description=form.description.data,
-            transaction_date=form.transaction_date.data,
-            payment_method=form.payment_method.data,
-            notes=form.notes.data,
-            tags=form.tags.data
+        # A resubmitted form or an entry made twice; a transfer is matched by its outgoing row
+        duplicate = None if form.allow_duplicate.data else find_duplicate_transaction(
+            current_user.id, form.account_id.data, form.transaction_type.data,
+            -form.amount.data if form.transaction_type.data == 'transfer' else form.amount.data,
+            form.description.data, form.transaction_date.data
         )
-        db.session.add(transaction)
-        db.session.commit()
+        if duplicate is not None:
+            flash(f'This looks like the transaction already recorded on {duplicate.transaction_date:%Y-%m-%d}. '
+                  f'Tick "Add anyway" to save it.', 'warning')
+            return render_template('forms/transaction_form.html', form=form, title='Add Transaction')
         
-        # Check budget limits and send notifications if exceeded
-        if form.transaction_type.data == 'expense' and form.category_id.data:
-            from utils import check_budget_limits_and_notify
-            try:
-                notifications_sent = check_budget_limits_and_notify(
-                    current_user.id,
-                    form.amount.data,
-                    form.category_id.data
-                )
-                if notifications_sent:
-                    flash(f'Transaction added. Budget alert emails sent for: {", ".join(notifications_sent)}', 'warning')
-                else:
-                    flash('Transaction added successfully!', 'success')
-            except Exception as e:
-                flash('Transaction added successfully!', 'success')
+        try:
+            if form.transaction_type.data == 'transfer':
+                for leg in save_transfer(
+                    current_user.id, form.account_id.data, form.to_account_id.data, form.amount.data,
+                    form.transaction_date.data, category_id=form.category_id.data,
+                    description=form.description.data, payment_method=form.payment_method.data, notes=form.notes.data
+                ):
+                    set_transaction_tags(leg, form.tags.data)
+                db.session.commit()
+                flash('Transfer added successfully!', 'success')
+                return redirect(url_for('transactions'))
+            
+            transaction = Transaction(
+                user_id=current_user.id,
+                account_id=form.account_id.data,
+                category_id=form.category_id.data,
+                transaction_type=form.transaction_type.data,
+                amount=form.amount.data,
+                description=form.description.data,
+                transaction_date=form.transaction_date.data,
+                payment_method=form.payment_method.data,
+                notes=form.notes.data
+            )
+            apply_base_amount(transaction)
+            set_transaction_tags(transaction, form.tags.data)
+            db.session.add(transaction)
+            db.session.commit()
+        except MissingExchangeRate as e:
+            # An account created before rates for its currency were imported
+            db.session.rollback()
+            flash(f'{e}. Import exchange rates for it before recording this transaction.', 'danger')
+            return render_template('forms/transaction_form.html', form=form, title='Add Transaction')
+        
+        # Budget thresholds crossed by this expense were detected and alerts queued in the same commit
+        notifications_sent = pop_budget_alerts()
+        if notifications_sent:
+            flash(f'Transaction added. Budget alert emails sent for: {", ".join(notifications_sent)}', 'warning')
         else:
             flash('Transaction added successfully!', 'success')
         
@@ -231,6 +300,12 @@ def add_transaction():
     if not form.transaction_date.data:
         form.transaction_date.data = date.today()
     
+    # A description in the URL, e.g. from a quick-add link, preselects the category the rules give it
+    if request.method == 'GET' and request.args.get('description'):
+        form.description.data = request.args['description']
+        form.category_id.data = categorize(current_user.id, form.description.data,
+                                           request.args.get('transaction_type', 'expense'))
+    
     return render_template('forms/transaction_form.html', form=form, title='Add Transaction')
 
 @app.route('/transactions/<int:transaction_id>/edit', methods=['GET', 'POST'])
@@ -239,10 +314,12 @@ def edit_transaction(transaction_id):
     """Edit transaction"""
     transaction = Transaction.query.filter_by(id=transaction_id, user_id=current_user.id).first_or_404()
     form = TransactionForm(obj=transaction)
+    outgoing, incoming = get_transfer_legs(transaction)
     
     # Populate choices
     user_accounts = Account.query.filter_by(user_id=current_user.id, is_active=True).all()
     form.account_id.choices = [(a.id, f"{a.name} ({a.account_type})") for a in user_accounts]
+    form.to_account_id.choices = form.account_id.choices
     
     user_categories = Category.query.filter(
         (Category.user_id == current_user.id) | (Category.is_system == True)
@@ -250,19 +327,52 @@ def edit_transaction(transaction_id):
     form.category_id.choices = [(c.id, c.name) for c in user_categories]
     
     if form.validate_on_submit():
-        transaction.account_id = form.account_id.data
-        transaction.category_id = form.category_id.data
-        transaction.transaction_type = form.transaction_type.data
-        transaction.amount = form.amount.data
-        transaction.description = form.description.data
-        transaction.transaction_date = form.transaction_date.data
-        transaction.payment_method = form.payment_method.data
-        transaction.notes = form.notes.data
-        transaction.tags = form.tags.data
-        db.session.commit()
+        try:
+            if form.transaction_type.data == 'transfer':
+                for leg in save_transfer(
+                    current_user.id, form.account_id.data, form.to_account_id.data, form.amount.data,
+                    form.transaction_date.data, transaction=transaction, category_id=form.category_id.data,
+                    description=form.description.data, payment_method=form.payment_method.data, notes=form.notes.data
+                ):
+                    set_transaction_tags(leg, form.tags.data)
+                db.session.commit()
+                flash('Transfer updated successfully!', 'success')
+                return redirect(url_for('transactions'))
+            
+            # No longer a transfer: keep this row and drop its counterpart
+            for leg in (outgoing, incoming):
+                if leg is not None and leg.id != transaction.id:
+                    record_deletion(current_user.id, 'transactions', leg.id)
+                    db.session.delete(leg)
+            transaction.transfer_id = None
+            
+            transaction.account_id = form.account_id.data
+            transaction.category_id = form.category_id.data
+            transaction.transaction_type = form.transaction_type.data
+            transaction.amount = form.amount.data
+            transaction.description = form.description.data
+            transaction.transaction_date = form.transaction_date.data
+            transaction.payment_method = form.payment_method.data
+            transaction.notes = form.notes.data
+            set_transaction_tags(transaction, form.tags.data)
+            apply_base_amount(transaction)
+            db.session.commit()
+        except MissingExchangeRate as e:
+            # Nothing of the edit is kept
+            db.session.rollback()
+            flash(f'{e}. Import exchange rates for it before saving this transaction.', 'danger')
+            return render_template('forms/transaction_form.html', form=form, title='Edit Transaction')
         flash('Transaction updated successfully!', 'success')
         return redirect(url_for('transactions'))
     
+    if request.method == 'GET':
+        form.tags.data = format_tags(transaction)
+        # A transfer is edited from the source side, whichever leg was opened
+        if outgoing is not None and incoming is not None:
+            form.account_id.data = outgoing.account_id
+            form.to_account_id.data = incoming.account_id
+            form.amount.data = -outgoing.amount
+    
     return render_template('forms/transaction_form.html', form=form, title='Edit Transaction')
 
 @app.route('/transactions/<int:transaction_id>/delete', methods=['POST'])
@@ -270,7 +380,11 @@ def edit_transaction(transaction_id):
 def delete_transaction(transaction_id):
     """Delete transaction"""
     transaction = Transaction.query.filter_by(id=transaction_id, user_id=current_user.id).first_or_404()
-    db.session.delete(transaction)
+    # Deleting either leg of a transfer deletes both
+    legs = {leg for leg in get_transfer_legs(transaction) if leg is not None} | {transaction}
+    for leg in legs:
+        record_deletion(current_user.id, 'transactions', leg.id)
+        db.session.delete(leg)
     db.session.commit()
     flash('Transaction deleted successfully!', 'success')
     return redirect(url_for('transactions'))
@@ -279,11 +393,10 @@ def delete_transaction(transaction_id):
 @require_login
 def budgets():
     """Budget management page"""
-    user_budgets = Budget.query.filter_by(user_id=current_user.id, is_active=True).all()
     budget_progress = get_budget_progress(current_user.id)
     
     return render_template('budgets.html', 
-                         budgets=user_budgets,
+                         budgets=[bp['budget'] for bp in budget_progress],
                          budget_progress=budget_progress)
 
 @app.route('/budgets/add', methods=['GET', 'POST'])
@@ -362,18 +475,31 @@ def goals():
     user_goals = get_savings_goals_progress(current_user.id)
     return render_template('goals.html', goals=user_goals)
 
+def set_goal_link_choices(form):
+    """Accounts and categories a goal can be linked to; 0 leaves it unlinked"""
+    user_accounts = Account.query.filter_by(user_id=current_user.id, is_active=True).all()
+    form.account_id.choices = [(0, 'Not linked')] + [(a.id, f"{a.name} ({a.account_type})") for a in user_accounts]
+    user_categories = Category.query.filter(
+        (Category.user_id == current_user.id) | (Category.is_system == True)
+    ).all()
+    form.category_id.choices = [(0, 'Not linked')] + [(c.id, c.name) for c in user_categories]
+
 @app.route('/goals/add', methods=['GET', 'POST'])
 @require_login
 def add_goal():
     """Add new savings goal"""
     form = SavingsGoalForm()
+    set_goal_link_choices(form)
     
     if form.validate_on_submit():
         goal = SavingsGoal(
             user_id=current_user.id,
             name=form.name.data,
             target_amount=form.target_amount.data,
+            current_amount=form.current_amount.data or 0,
             target_date=form.target_date.data,
+            account_id=form.account_id.data or None,
+            category_id=form.category_id.data or None,
             description=form.description.data
         )
         db.session.add(goal)
@@ -389,11 +515,15 @@ def edit_goal(goal_id):
     """Edit savings goal"""
     goal = SavingsGoal.query.filter_by(id=goal_id, user_id=current_user.id).first_or_404()
     form = SavingsGoalForm(obj=goal)
+    set_goal_link_choices(form)
     
     if form.validate_on_submit():
         goal.name = form.name.data
         goal.target_amount = form.target_amount.data
+        goal.current_amount = form.current_amount.data or 0
         goal.target_date = form.target_date.data
+        goal.account_id = form.account_id.data or None
+        goal.category_id = form.category_id.data or None
         goal.description = form.description.data
         db.session.commit()
         flash('Savings goal updated successfully!', 'success')
@@ -406,6 +536,7 @@ def edit_goal(goal_id):
 def delete_goal(goal_id):
     """Delete savings goal"""
     goal = SavingsGoal.query.filter_by(id=goal_id, user_id=current_user.id).first_or_404()
+    record_deletion(current_user.id, 'goals', goal.id)
     db.session.delete(goal)
     db.session.commit()
     flash('Savings goal deleted successfully!', 'success')
@@ -415,20 +546,48 @@ def delete_goal(goal_id):
 @require_login
 def reports():
     """Financial reports page"""
+    # Get the custom range report chosen in the page controls
+    try:
+        report = get_report(current_user.id, **report_args_from_request())
+    except ValueError as e:
+        flash(str(e), 'danger')
+        report = None
+    
     # Get monthly income/expense trend
     monthly_trend = get_monthly_income_expense_trend(current_user.id)
     
     # Get spending by category for current month
     monthly_spending = get_monthly_spending_by_category(current_user.id)
     
+    # Get spending by tag for current month
+    tag_spending = get_spending_by_tag(current_user.id)
+    
     # Get net worth data
     net_worth_data = calculate_net_worth(current_user.id)
     
     return render_template('reports.html',
+                         report=report,
+                         report_buckets=REPORT_BUCKETS,
+                         report_dimensions=list(REPORT_DIMENSIONS),
                          monthly_trend=monthly_trend,
                          monthly_spending=monthly_spending,
+                         tag_spending=tag_spending,
                          net_worth_data=net_worth_data)
 
+def report_args_from_request():
+    """Parse report range, bucket and grouping from the query string, defaulting to the last 12 months"""
+    today = date.today()
+    start = request.args.get('start')
+    end = request.args.get('end')
+    return {
+        'start_date': date.fromisoformat(start) if start else add_months(date(today.year, today.month, 1), -11),
+        'end_date': date.fromisoformat(end) if end else today,
+        'bucket': request.args.get('bucket', 'month'),
+        'group_by': [name for name in request.args.get('group_by', '').split(',') if name],
+        'compare_previous_year': request.args.get('compare') == 'yoy',
+        'category_level': request.args.get('category_level', type=int),
+    }
+
 @app.route('/profile')
 @require_login
 def profile():
@@ -439,8 +598,8 @@ def profile():
 @app.route('/api/spending-chart')
 @require_login
 def spending_chart_data():
-    """API endpoint for spending chart data"""
-    monthly_spending = get_monthly_spending_by_category(current_user.id)
+    """API endpoint for spending chart data; ?level=0 rolls up to top-level categories"""
+    monthly_spending = get_monthly_spending_by_category(current_user.id, level=request.args.get('level', type=int))
     
     labels = [item[0] for item in monthly_spending]
     data = [float(item[2]) for item in monthly_spending]
@@ -468,11 +627,460 @@ def income_expense_trend_data():
         'expense': expense_data
     })
 
+@app.route('/api/timeseries')
+@require_login
+def timeseries_data():
+    """API endpoint for daily series over any range, downsampled server-side:
+    ?series=spending,income,net_worth,balance&account_id=&start=&end=&points=500&method=lttb|minmax&format=columnar"""
+    series = [name.strip() for name in request.args.get('series', 'spending,income').split(',') if name.strip()]
+    unknown = [name for name in series if name not in SERIES]
+    if not series or unknown:
+        return jsonify({'success': False, 'message': f'series must be some of {", ".join(SERIES)}'}), 400
+    method = request.args.get('method', 'lttb')
+    if method not in DOWNSAMPLE_METHODS:
+        return jsonify({'success': False, 'message': f'method must be one of {", ".join(DOWNSAMPLE_METHODS)}'}), 400
+    try:
+        end_date = date.fromisoformat(request.args['end']) if request.args.get('end') else date.today()
+        start_date = (date.fromisoformat(request.args['start']) if request.args.get('start')
+                      else end_date - timedelta(days=364))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'start and end must be YYYY-MM-DD dates'}), 400
+    if start_date > end_date:
+        return jsonify({'success': False, 'message': 'start must not be after end'}), 400
+    account = None
+    if 'balance' in series:
+        account = Account.query.filter_by(id=request.args.get('account_id', type=int),
+                                          user_id=current_user.id).first_or_404()
+    points = min(max(request.args.get('points', 500, type=int), 3), app.config['TIMESERIES_MAX_POINTS'])
+    columnar = request.args.get('format') == 'columnar'
+    # The range actually computed, and returned as start and end, is bounded whatever is asked
+    start_date, end_date = data_range(current_user.id, start_date, end_date, app.config['TIMESERIES_MAX_DAYS'])
+    
+    daily = get_daily_series(current_user.id, start_date, end_date, series, account.id if account else None)
+    response = {
+        'start': start_date.isoformat(),
+        'end': end_date.isoformat(),
+        'method': method,
+        'series': {
+            name: encode_series(start_date, values, downsample(values, points, method), columnar)
+            for name, values in daily.items()
+        }
+    }
+    if account is not None:
+        response['currency'] = account.currency
+    return jsonify(response)
+
+@app.route('/api/health-score/history')
+@require_login
+def health_score_history_data():
+    """API endpoint for the daily financial health score trend"""
+    history = get_health_score_history(current_user.id, request.args.get('days', 90, type=int))
+    return jsonify({
+        'labels': [entry.score_date.isoformat() for entry in history],
+        'score': [entry.score for entry in history],
+        'budget_score': [entry.budget_score for entry in history],
+        'savings_score': [entry.savings_score for entry in history],
+        'net_worth_score': [entry.net_worth_score for entry in history]
+    })
+
+@app.route('/api/reports')
+@require_login
+def report_data():
+    """API endpoint for custom reports: ?start=&end=&bucket=&group_by=category,account&compare=yoy"""
+    try:
+        report = get_report(current_user.id, **report_args_from_request())
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    return jsonify(report)
+
+@app.route('/api/spending-by-tag')
+@require_login
+def spending_by_tag_data():
+    """API endpoint for spending by tag"""
+    start_date = request.args.get('start', type=date.fromisoformat)
+    end_date = request.args.get('end', type=date.fromisoformat)
+    tag_spending = get_spending_by_tag(current_user.id, start_date, end_date)
+    
+    return jsonify({
+        'labels': [item.name for item in tag_spending],
+        'data': [float(item.total) for item in tag_spending],
+        'counts': [item.count for item in tag_spending]
+    })
+
+@app.route('/api/accounts/<int:account_id>/balance')
+@require_login
+def account_balance_data(account_id):
+    """API endpoint for an account's balance at the end of a day: ?as_of=YYYY-MM-DD (default today)"""
+    account = Account.query.filter_by(id=account_id, user_id=current_user.id).first_or_404()
+    try:
+        as_of = date.fromisoformat(request.args['as_of']) if request.args.get('as_of') else date.today()
+    except ValueError:
+        return jsonify({'success': False, 'message': 'as_of must be a YYYY-MM-DD date'}), 400
+    
+    return jsonify({
+        'account_id': account.id,
+        'currency': account.currency,
+        'as_of': as_of.isoformat(),
+        'balance': float(get_balance_as_of(account.id, as_of))
+    })
+
+@app.route('/api/accounts/<int:account_id>/balance-history')
+@require_login
+def account_balance_history_data(account_id):
+    """API endpoint for month-end balances: ?start=&end= (default the last 12 months)"""
+    account = Account.query.filter_by(id=account_id, user_id=current_user.id).first_or_404()
+    try:
+        end_date = date.fromisoformat(request.args['end']) if request.args.get('end') else date.today()
+        start_date = (date.fromisoformat(request.args['start']) if request.args.get('start')
+                      else add_months(end_date.replace(day=1), -11))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'start and end must be YYYY-MM-DD dates'}), 400
+    if start_date > end_date:
+        return jsonify({'success': False, 'message': 'start must not be after end'}), 400
+    # Longer ranges keep their last BALANCE_HISTORY_MAX_MONTHS months
+    max_months = app.config['BALANCE_HISTORY_MAX_MONTHS']
+    if (end_date.year - start_date.year) * 12 + end_date.month - start_date.month >= max_months:
+        start_date = add_months(end_date.replace(day=1), 1 - max_months)
+    
+    history = get_balance_history(account.id, start_date, end_date)
+    return jsonify({
+        'account_id': account.id,
+        'currency': account.currency,
+        'labels': [day.isoformat() for day, _ in history],
+        'data': [float(balance) for _, balance in history]
+    })
+
+@app.route('/api/transactions/batch', methods=['POST'])
+@require_login
+def batch_add_transactions():
+    """Add many transactions in one database transaction, e.g. an offline queue from the mobile app.
+    
+    Expects {"transactions": [{...TransactionForm fields..., "idempotency_key": "..."}]}.
+    Items are validated with the same rules as TransactionForm. Items whose
+    idempotency_key was already stored are reported as duplicates instead of
+    being inserted again, so a whole batch can be retried safely. Items matching
+    a stored or earlier item's account, type, amount and description within
+    DUPLICATE_DATE_TOLERANCE_DAYS are reported as possible_duplicate unless they
+    set "allow_duplicate": true. Income and expenses without a category_id get
+    the one the category rules give their description, returned in the result.
+    """
+    payload = request.get_json(silent=True) or {}
+    items = payload.get('transactions')
+    max_items = app.config['BATCH_MAX_TRANSACTIONS']
+    
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'message': 'Expected a non-empty "transactions" list'}), 400
+    if len(items) > max_items:
+        return jsonify({'success': False, 'message': f'At most {max_items} transactions per batch'}), 400
+    
+    # Choices are the same for every item, so look them up once
+    user_accounts = Account.query.filter_by(user_id=current_user.id, is_active=True).all()
+    account_choices = [(a.id, a.name) for a in user_accounts]
+    user_categories = Category.query.filter(
+        (Category.user_id == current_user.id) | (Category.is_system == True)
+    ).all()
+    category_choices = [(c.id, c.name) for c in user_categories]
+    matchers = get_matchers(current_user.id)
+    
+    # Resolve all idempotency keys with one indexed lookup
+    keys = [item.get('idempotency_key') for item in items if isinstance(item, dict) and item.get('idempotency_key')]
+    seen_keys = {}  # key -> stored transaction id, or the Transaction created earlier in this batch
+    if keys:
+        seen_keys = dict(db.session.query(Transaction.idempotency_key, Transaction.id).filter(
+            Transaction.user_id == current_user.id,
+            Transaction.idempotency_key.in_(keys)
+        ).all())
+    
+    # Fingerprints of stored lookalikes, with one indexed lookup over the batch's date range
+    tolerance = timedelta(days=app.config['DUPLICATE_DATE_TOLERANCE_DAYS'])
+    candidates = set()  # fingerprints of items whose fields parse
+    candidate_dates = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            amount = Decimal(str(item['amount']))
+            fingerprint = transaction_fingerprint(
+                current_user.id, int(item['account_id']), item['transaction_type'],
+                -amount if item['transaction_type'] == 'transfer' else amount, item.get('description')
+            )
+            transaction_date = date.fromisoformat(item['transaction_date'])
+        except (KeyError, TypeError, ValueError, ArithmeticError):
+            continue
+        candidates.add(fingerprint)
+        candidate_dates.append(transaction_date)
+    fingerprint_matches = {}
+    prefetched = None  # (first, last) date of the lookup
+    if candidates and tolerance.days >= 0:
+        prefetched = (min(candidate_dates) - tolerance, max(candidate_dates) + tolerance)
+        fingerprint_matches = find_fingerprint_matches(candidates, *prefetched)
+    
+    results = []
+    created = []
+    pending_ids = []  # (result, transaction) pairs whose id is only known after the commit
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results.append({'index': index, 'status': 'invalid', 'errors': {'item': ['Expected an object']}})
+            continue
+        
+        key = item.get('idempotency_key')
+        if key is not None and (not isinstance(key, str) or len(key) > 64):
+            results.append({'index': index, 'status': 'invalid',
+                            'errors': {'idempotency_key': ['Must be a string of at most 64 characters']}})
+            continue
+        if key and key in seen_keys:
+            result = {'index': index, 'status': 'duplicate', 'idempotency_key': key}
+            if isinstance(seen_keys[key], Transaction):
+                pending_ids.append((result, seen_keys[key]))
+            else:
+                result['id'] = seen_keys[key]
+            results.append(result)
+            continue
+        
+        suggested = None
+        if not item.get('category_id') and item.get('transaction_type') in CATEGORIZED_TYPES:
+            suggested = categorize(current_user.id, item.get('description'), item['transaction_type'], matchers)
+            if suggested is not None:
+                item = dict(item, category_id=suggested)
+        
+        form = TransactionForm(
+            formdata=MultiDict({name: str(value) for name, value in item.items() if value is not None}),
+            meta={'csrf': False}
+        )
+        form.account_id.choices = account_choices
+        form.to_account_id.choices = account_choices
+        form.category_id.choices = category_choices
+        if not form.validate():
+            results.append({'index': index, 'status': 'invalid', 'errors': form.errors})
+            continue
+        
+        # Stored rows and rows created earlier in this batch that look the same; "allow_duplicate": true overrides
+        fingerprint = transaction_fingerprint(
+            current_user.id, form.account_id.data, form.transaction_type.data,
+            -form.amount.data if form.transaction_type.data == 'transfer' else form.amount.data, form.description.data
+        )
+        window = (form.transaction_date.data - tolerance, form.transaction_date.data + tolerance)
+        if tolerance.days >= 0 and (fingerprint not in candidates or
+                                    window[0] < prefetched[0] or window[1] > prefetched[1]):
+            for match_fingerprint, matches in find_fingerprint_matches([fingerprint], *window).items():
+                known = fingerprint_matches.setdefault(match_fingerprint, [])
+                known.extend(match for match in matches if match not in known)
+        lookalike = next((match for match in fingerprint_matches.get(fingerprint, ())
+                          if abs(match[0] - form.transaction_date.data) <= tolerance), None)
+        if lookalike is not None and item.get('allow_duplicate') is not True:
+            result = {'index': index, 'status': 'possible_duplicate'}
+            if isinstance(lookalike[1], Transaction):
+                pending_ids.append((result, lookalike[1]))
+            else:
+                result['id'] = lookalike[1]
+            results.append(result)
+            continue
+        
+        if form.transaction_type.data == 'transfer':
+            try:
+                legs = save_transfer(
+                    current_user.id, form.account_id.data, form.to_account_id.data, form.amount.data,
+                    form.transaction_date.data, category_id=form.category_id.data,
+                    description=form.description.data, payment_method=form.payment_method.data, notes=form.notes.data
+                )
+            except MissingExchangeRate as e:
+                results.append({'index': index, 'status': 'invalid', 'errors': {'account_id': [str(e)]}})
+                continue
+            for leg in legs:
+                set_transaction_tags(leg, form.tags.data)
+            # The key identifies the transfer through its outgoing row
+            transaction = legs[0]
+            transaction.idempotency_key = key or None
+            created.extend(legs)
+        else:
+            transaction = Transaction(
+                user_id=current_user.id,
+                account_id=form.account_id.data,
+                category_id=form.category_id.data,
+                transaction_type=form.transaction_type.data,
+                amount=form.amount.data,
+                description=form.description.data,
+                transaction_date=form.transaction_date.data,
+                payment_method=form.payment_method.data,
+                notes=form.notes.data,
+                idempotency_key=key or None
+            )
+            try:
+                apply_base_amount(transaction)
+            except MissingExchangeRate as e:
+                # Reported before the tags are set, so nothing of this item joins the session
+                results.append({'index': index, 'status': 'invalid', 'errors': {'account_id': [str(e)]}})
+                continue
+            set_transaction_tags(transaction, form.tags.data)
+            db.session.add(transaction)
+            created.append(transaction)
+        
+        fingerprint_matches.setdefault(fingerprint, []).append((form.transaction_date.data, transaction))
+        result = {'index': index, 'status': 'created'}
+        if suggested is not None:
+            result['category_id'] = suggested
+        if key:
+            seen_keys[key] = transaction
+            result['idempotency_key'] = key
+        results.append(result)
+        pending_ids.append((result, transaction))
+    
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent retry stored one of the keys first; nothing from this batch was kept
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'Conflicting concurrent batch, please retry'}), 409
+    
+    for result, transaction in pending_ids:
+        result['id'] = transaction.id
+    
+    # Queued while the batch was committed, once per budget threshold crossed
+    budget_alerts = pop_budget_alerts()
+    
+    return jsonify({
+        'success': True,
+        'created': len(created),
+        'duplicates': sum(1 for r in results if r['status'] == 'duplicate'),
+        'possible_duplicates': sum(1 for r in results if r['status'] == 'possible_duplicate'),
+        'invalid': sum(1 for r in results if r['status'] == 'invalid'),
+        'budget_alerts': budget_alerts,
+        'results': results
+    })
+
+@app.route('/api/sync')
+@require_login
+def sync_changes():
+    """Delta sync: accounts, transactions, budgets, goals and bills changed since a watermark.
+    
+    Call without `since` for a full snapshot, then pass the returned `token` back
+    as `since` to receive only what was created, updated or deleted in between.
+    """
+    since = None
+    token = request.args.get('since')
+    if token:
+        try:
+            since = decode_sync_token(token)
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Invalid sync token'}), 400
+    
+    changes, watermark = get_changes_since(current_user.id, since)
+    
+    return jsonify({
+        'token': encode_sync_token(watermark),
+        'full': since is None,
+        'changes': changes
+    })
+
+@app.route('/api/anomalies')
+@require_login
+def spending_anomalies():
+    """Expenses flagged as unusual for their category, newest first: ?since=<ISO datetime>&limit="""
+    try:
+        since = datetime.fromisoformat(request.args['since']) if request.args.get('since') else None
+    except ValueError:
+        return jsonify({'success': False, 'message': 'since must be an ISO datetime'}), 400
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    
+    return jsonify({
+        'anomalies': [{
+            'id': anomaly.id,
+            'kind': anomaly.kind,
+            'transaction_id': anomaly.transaction_id,
+            'transaction_date': anomaly.transaction_date.isoformat(),
+            'description': anomaly.description,
+            'category': anomaly.category,
+            'amount': float(anomaly.amount),
+            'expected': float(anomaly.expected),
+            'z_score': round(anomaly.z_score, 2),
+            'flagged_at': anomaly.created_at.isoformat()
+        } for anomaly in get_spending_anomalies(current_user.id, since, limit)]
+    })
+
+@app.route('/api/suggest-category')
+@require_login
+def suggest_category():
+    """Category the rules give a description, e.g. to preselect it in the transaction form:
+    ?description=&transaction_type=expense"""
+    transaction_type = request.args.get('transaction_type', 'expense')
+    category_id = categorize(current_user.id, request.args.get('description', ''), transaction_type)
+    category = db.session.get(Category, category_id) if category_id else None
+    return jsonify({
+        'category_id': category_id,
+        'category': category.name if category else None
+    })
+
+@app.route('/api/category-rules')
+@require_login
+def category_rules():
+    """The user's categorization rules, followed by the system rules"""
+    rules = db.session.query(CategoryRule, Category.name).join(
+        Category, Category.id == CategoryRule.category_id
+    ).filter(
+        (CategoryRule.user_id == current_user.id) | (CategoryRule.user_id.is_(None))
+    ).order_by(CategoryRule.user_id.is_(None), CategoryRule.pattern)
+    return jsonify({
+        'rules': [{
+            'id': rule.id,
+            'pattern': rule.pattern,
+            'category_id': rule.category_id,
+            'category': category_name,
+            'source': rule.source
+        } for rule, category_name in rules]
+    })
+
+@app.route('/api/category-rules', methods=['POST'])
+@require_login
+def save_category_rule():
+    """Add a rule, or change the category of the user's rule with the same words:
+    {"pattern": "...", "category_id": ...}"""
+    payload = request.get_json(silent=True) or {}
+    pattern = normalize_description(str(payload.get('pattern') or ''))
+    if not pattern or len(pattern) > 100:
+        return jsonify({'success': False, 'message': 'pattern must have 1 to 100 letters or digits'}), 400
+    category = Category.query.filter(
+        Category.id == payload.get('category_id'),
+        (Category.user_id == current_user.id) | (Category.is_system == True)
+    ).first()
+    if category is None:
+        return jsonify({'success': False, 'message': 'Unknown category'}), 400
+    
+    rule = CategoryRule.query.filter_by(user_id=current_user.id, pattern=pattern).first()
+    if rule is None:
+        rule = CategoryRule(user_id=current_user.id, pattern=pattern)
+        db.session.add(rule)
+    rule.category_id = category.id
+    rule.source = 'manual'
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # The same rule saved concurrently
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'Conflicting concurrent update, please retry'}), 409
+    return jsonify({'success': True, 'id': rule.id, 'pattern': rule.pattern, 'category_id': rule.category_id})
+
+@app.route('/api/category-rules/<int:rule_id>', methods=['DELETE'])
+@require_login
+def delete_category_rule(rule_id):
+    """Delete one of the user's rules"""
+    rule = CategoryRule.query.filter_by(id=rule_id, user_id=current_user.id).first_or_404()
+    db.session.delete(rule)
+    db.session.commit()
+    return jsonify({'success': True})
+
+@app.route('/api/category-rules/learn', methods=['POST'])
+@require_login
+def learn_category_rules():
+    """Add rules for merchants the user keeps putting in the same category"""
+    return jsonify({'success': True, 'learned': learn_rules(current_user.id)})
+
 # Voice Assistant Routes
 @app.route('/voice-transaction', methods=['POST'])
 @require_login
 def voice_transaction():
     """Process voice input for transaction"""
+    # Refuse oversized bodies before they are parsed; the slack covers the other form fields
+    request.max_content_length = app.config['VOICE_MAX_UPLOAD_BYTES'] + 64 * 1024
     try:
         if 'audio' not in request.files:
             return jsonify({'success': False, 'message': 'No audio file provided'})
@@ -482,24 +1090,27 @@ def voice_transaction():
             return jsonify({'success': False, 'message': 'No audio file selected'})
         
         # Import voice assistant functions
-        from voice_assistant import transcribe_audio, process_voice_transaction
+        from voice_assistant import handle_voice_upload, VoiceRateLimited
+        from audio import AudioRejected
         
-        # Transcribe the audio
-        transcription_result = transcribe_audio(audio_file)
-        
-        if not transcription_result['success']:
-            return jsonify(transcription_result)
-        
-        transcript = transcription_result['transcript']
-        
-        # Process the transcript to extract transaction details
-        result = process_voice_transaction(current_user.id, transcript)
-        
-        # Add transcript to response for debugging
-        result['transcript'] = transcript
+        # Transcribe the audio and extract transaction details, once per distinct recording
+        try:
+            result = handle_voice_upload(current_user.id, audio_file)
+        except AudioRejected as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        except VoiceRateLimited as e:
+            response = jsonify({
+                'success': False,
+                'message': 'Too many voice requests. Please wait a moment and try again.'
+            })
+            response.status_code = 429
+            response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+            return response
         
         return jsonify(result)
         
+    except RequestEntityTooLarge:
+        return jsonify({'success': False, 'message': 'The recording is too large'}), 413
     except Exception as e:
         return jsonify({
             'success': False,
@@ -515,6 +1126,31 @@ def voice_suggestions():
         'suggestions': get_voice_assistant_suggestions()
     })
 
+@app.route('/metrics')
+@require_internal_access
+def metrics_endpoint():
+    """Request, database, external call, cache and job metrics of all worker processes, for Prometheus"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/internal/pool-stats')
+@require_internal_access
+def pool_stats():
+    """Live connection pool usage for tuning worker and pool sizes"""
+    return jsonify({'pid': os.getpid(), 'pools': get_pool_stats(db.engines)})
+
+@app.route('/internal/job-stats')
+@require_internal_access
+def job_stats():
+    """Background job queue depth and this process's worker counters"""
+    return jsonify({'pid': os.getpid(), **get_job_stats()})
+
+@app.route('/internal/voice-stats')
+@require_internal_access
+def voice_stats():
+    """Upload sizes and latencies of voice requests in this process, with and without audio preprocessing"""
+    from audio import get_audio_stats
+    return jsonify({'pid': os.getpid(), **get_audio_stats()})
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('404.html'), 404
@@ -0,0 +1,192 @@
+import json
+import os
+import secrets
+import tempfile
+from datetime import datetime
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from werkzeug.datastructures import CallbackDict
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session whose data lives in a store; the cookie only carries its signed ID"""
+    
+    def __init__(self, initial=None, sid=None, new=False, expires_at=None):
+        def on_update(self):
+            self.modified = True
+        
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.expires_at = expires_at
+        self.modified = False
+        self.loaded_user_id = self.get('_user_id')
+
+class DatabaseSessionStore:
+    """Sessions in the server_sessions table, on their own connection so a save
+    never commits the request's pending ORM changes"""
+    
+    def __init__(self, db):
+        self.db = db
+    
+    @property
+    def table(self):
+        from models import ServerSession
+        return ServerSession.__table__
+    
+    def load(self, sid):
+        with self.db.engine.connect() as conn:
+            row = conn.execute(
+                select(self.table.c.data, self.table.c.expires_at).where(self.table.c.id == sid)
+            ).first()
+        return (row.data, row.expires_at) if row else None
+    
+    def save(self, sid, data, expires_at):
+        values = {'data': data, 'expires_at': expires_at}
+        with self.db.engine.begin() as conn:
+            result = conn.execute(update(self.table).where(self.table.c.id == sid).values(**values))
+            if result.rowcount:
+                return
+            try:
+                with conn.begin_nested():
+                    conn.execute(insert(self.table).values(id=sid, **values))
+            except IntegrityError:
+                # A concurrent request created the row first
+                conn.execute(update(self.table).where(self.table.c.id == sid).values(**values))
+    
+    def delete(self, sid):
+        with self.db.engine.begin() as conn:
+            conn.execute(delete(self.table).where(self.table.c.id == sid))
+    
+    def sweep(self, now=None):
+        """Delete expired sessions; returns how many were removed"""
+        with self.db.engine.begin() as conn:
+            result = conn.execute(delete(self.table).where(self.table.c.expires_at < (now or datetime.now())))
+        return result.rowcount
+
+class FileSessionStore:
+    """Sessions as files in a local directory, shared by the worker processes of one host"""
+    
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+    
+    def _path(self, sid):
+        return os.path.join(self.directory, sid)
+    
+    def load(self, sid):
+        try:
+            with open(self._path(sid)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return record['data'], datetime.fromisoformat(record['expires_at'])
+    
+    def save(self, sid, data, expires_at):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'data': data, 'expires_at': expires_at.isoformat()}, f)
+        os.replace(tmp_path, self._path(sid))
+    
+    def delete(self, sid):
+        try:
+            os.remove(self._path(sid))
+        except FileNotFoundError:
+            pass
+    
+    def sweep(self, now=None):
+        """Delete expired session files; returns how many were removed"""
+        now = now or datetime.now()
+        removed = 0
+        for name in os.listdir(self.directory):
+            if name.startswith('.tmp-'):
+                continue
+            record = self.load(name)
+            if record is None or record[1] < now:
+                self.delete(name)
+                removed += 1
+        return removed
+
+class ServerSideSessionInterface(SessionInterface):
+    """Keeps session data server-side and writes it (and the cookie) only when needed.
+    
+    A request that does not change the session costs one store lookup and sends
+    no Set-Cookie header. The expiry slides forward once less than half of the
+    session lifetime remains.
+    """
+    serializer = TaggedJSONSerializer()
+    
+    def __init__(self, store):
+        self.store = store
+    
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='server-side-session')
+    
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+        
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            record = self.store.load(sid) if sid else None
+            if record and record[1] > datetime.now():
+                return ServerSideSession(self.serializer.loads(record[0]), sid=sid, expires_at=record[1])
+        
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+    
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        
+        if not session:
+            if not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        
+        now = datetime.now()
+        lifetime = app.permanent_session_lifetime
+        refresh_due = session.expires_at is None or session.expires_at - now < lifetime / 2
+        
+        # Rotate the ID when the logged-in user changes, to prevent session fixation
+        rotate = not session.new and session.get('_user_id') != session.loaded_user_id
+        if rotate:
+            self.store.delete(session.sid)
+            session.sid = secrets.token_urlsafe(32)
+        
+        if not (session.new or session.modified or refresh_due or rotate):
+            return
+        
+        expires_at = now + lifetime
+        self.store.save(session.sid, self.serializer.dumps(dict(session)), expires_at)
+        
+        # The cookie only changes for a new ID or a new expiry
+        if session.new or rotate or (session.permanent and refresh_due):
+            response.set_cookie(
+                name,
+                self._signer(app).sign(session.sid.encode()).decode(),
+                expires=expires_at if session.permanent else None,
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+        response.vary.add('Cookie')
+
+def init_app(app, db):
+    """Install the session backend chosen by the SESSION_BACKEND setting"""
+    backend = app.config.get('SESSION_BACKEND', 'cookie')
+    if backend == 'db':
+        app.session_interface = ServerSideSessionInterface(DatabaseSessionStore(db))
+    elif backend == 'filesystem':
+        app.session_interface = ServerSideSessionInterface(FileSessionStore(app.config['SESSION_FILE_DIR']))
+    elif backend != 'cookie':
+        raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
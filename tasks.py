@@ -0,0 +1,39 @@
+from datetime import date, datetime, timedelta
+from app import app, db
+from jobs import task, periodic
+from metrics import track_call
+from models import Job
+
+@task('refresh_health_score')
+def refresh_health_score(user_id):
+    from utils import refresh_financial_health_score
+    refresh_financial_health_score(user_id)
+
+@task('send_budget_alert', max_attempts=8)
+def send_budget_alert(email, budget_info, spent, budget_amount):
+    from email_service import send_budget_alert_email
+    budget_info = dict(budget_info, start_date=date.fromisoformat(budget_info['start_date']))
+    with track_call('email', 'budget_alert'):
+        if not send_budget_alert_email(email, budget_info, spent, budget_amount):
+            raise RuntimeError(f"Budget alert email to {email} was not sent")
+
+@task('sweep_sessions')
+def sweep_sessions():
+    store = getattr(app.session_interface, 'store', None)
+    if store is not None:
+        store.sweep()
+
+@task('create_partitions')
+def create_partitions():
+    import partitions
+    partitions.ensure_future_partitions(app.config['TRANSACTION_PARTITIONS_AHEAD'])
+
+@task('purge_finished_jobs')
+def purge_finished_jobs():
+    cutoff = datetime.now() - timedelta(days=app.config['JOB_RETENTION_DAYS'])
+    Job.query.filter(Job.status.in_(['done', 'failed']), Job.finished_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+
+periodic('sweep_sessions', 3600)
+periodic('create_partitions', 86400)
+periodic('purge_finished_jobs', 86400)
@@ -0,0 +1,72 @@
+import os
+import tempfile
+from datetime import date, timedelta
+from decimal import Decimal
+
+import pytest
+
+# app.py configures the database when it is imported
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db'))
+os.environ.setdefault('SESSION_SECRET', 'test')
+os.environ.setdefault('REPL_ID', 'test')
+
+from app import app, db  # noqa: E402
+from models import Account, Category, CategorySpendStats, Transaction, User  # noqa: E402
+from anomalies import _ewma_update, backfill_stats  # noqa: E402
+
+AMOUNTS = [
+    [42.0],
+    [10.0, 30.0],
+    [12.5, 80.0, 7.25, 19.0, 19.0, 250.0, 3.0],
+    [5.0] * 6 + [500.0],
+]
+
+def _replay(amounts, alpha):
+    mean, variance = 0.0, 0.0
+    for count, amount in enumerate(amounts):
+        mean, variance = _ewma_update(mean, variance, count, amount, alpha)
+    return mean, variance
+
+def _weighted_sums(amounts, alpha):
+    """The sums backfill_stats computes in SQL, for amounts oldest first"""
+    n = len(amounts)
+    weighted = []
+    for i, amount in enumerate(amounts):
+        age = n - 1 - i
+        weight = (1 - alpha) ** age if age == n - 1 else alpha * (1 - alpha) ** age
+        weighted.append((weight, amount))
+    mean = sum(weight * amount for weight, amount in weighted)
+    variance = sum(weight * (amount - mean) ** 2 for weight, amount in weighted)
+    return mean, variance
+
+@pytest.mark.parametrize('alpha', [0.05, 0.2, 0.5, 0.9])
+@pytest.mark.parametrize('amounts', AMOUNTS)
+def test_weighted_sums_match_running_update(amounts, alpha):
+    mean, variance = _replay(amounts, alpha)
+    expected_mean, expected_variance = _weighted_sums(amounts, alpha)
+    assert mean == pytest.approx(expected_mean)
+    assert variance == pytest.approx(expected_variance)
+
+@pytest.mark.parametrize('amounts', AMOUNTS)
+def test_backfill_matches_running_update(amounts):
+    with app.app_context():
+        user = User(id=f'anomalies-{len(amounts)}-{amounts[-1]}')
+        account = Account(user=user, name='Checking', account_type='checking')
+        category = Category(user_id=user.id, name='Groceries', type='expense')
+        db.session.add_all((user, account, category))
+        db.session.flush()
+        start = date.today() - timedelta(days=len(amounts))
+        db.session.add_all(
+            Transaction(user_id=user.id, account=account, category_id=category.id, amount=Decimal(str(amount)),
+                        description='Groceries', transaction_date=start + timedelta(days=i),
+                        transaction_type='expense', payment_method='card')
+            for i, amount in enumerate(amounts)
+        )
+        db.session.commit()
+
+        assert backfill_stats([user.id]) == 1
+        stats = db.session.get(CategorySpendStats, (user.id, category.id))
+        mean, variance = _replay(amounts, app.config['ANOMALY_ALPHA'])
+        assert stats.count == len(amounts)
+        assert stats.mean == pytest.approx(mean)
+        assert stats.variance == pytest.approx(variance, abs=1e-9)
@@ -0,0 +1,222 @@
+from array import array
+from datetime import date, timedelta
+from itertools import accumulate
+from sqlalchemy import func
+from app import db
+from models import Account, ArchivedAccountTotal, Transaction, signed_transaction_amount
+from utils import BASE_AMOUNT, signed_amount
+from archive import get_archived_years, iter_archived_transactions
+from replica import replica_reads
+
+SERIES = ('spending', 'income', 'net_worth', 'balance')
+DOWNSAMPLE_METHODS = ('lttb', 'minmax')
+ASSET_TYPES = ('checking', 'savings', 'investment')
+
+def _zeros(days):
+    return array('d', bytes(8 * days))
+
+def _archived_rows(user_id, start_date, end_date):
+    """Archived transactions from the start of start_date's year to end_date, if any of those years is archived"""
+    if not any(start_date.year <= year <= end_date.year for year in get_archived_years(user_id)):
+        return []
+    return list(iter_archived_transactions(user_id, date(start_date.year, 1, 1), end_date))
+
+def _daily_flows(user_id, start_date, end_date, archived_rows):
+    """Expense and income totals in BASE_CURRENCY of every day in the range, from one grouped query"""
+    days = (end_date - start_date).days + 1
+    flows = {'expense': _zeros(days), 'income': _zeros(days)}
+    for day, transaction_type, total in db.session.query(
+        Transaction.transaction_date, Transaction.transaction_type, func.sum(BASE_AMOUNT)
+    ).filter(
+        Transaction.user_id == user_id,
+        Transaction.transaction_type.in_(flows),
+        Transaction.transaction_date.between(start_date, end_date)
+    ).group_by(Transaction.transaction_date, Transaction.transaction_type):
+        flows[transaction_type][(day - start_date).days] += float(total or 0)
+    for row in archived_rows:
+        if row['transaction_type'] in flows and row['transaction_date'] >= start_date:
+            amount = row['base_amount'] if row['base_amount'] is not None else row['amount']
+            flows[row['transaction_type']][(row['transaction_date'] - start_date).days] += float(amount)
+    return flows['expense'], flows['income']
+
+def data_range(user_id, start_date, end_date, max_days):
+    """The part of [start_date, end_date] worth computing: from the user's first transaction (live or
+    archived) to the later of their last one and today, and at most max_days ending at its end.
+    
+    Before the first transaction every series is zero and after the last it is flat, so only
+    the axis changes, while the work no longer grows with the requested range.
+    """
+    first, last = db.session.query(func.min(Transaction.transaction_date), func.max(Transaction.transaction_date))\
+        .filter(Transaction.account_id.in_(db.session.query(Account.id).filter(Account.user_id == user_id))).one()
+    archived_years = get_archived_years(user_id)
+    if archived_years:
+        first = min(first or date.max, date(min(archived_years), 1, 1))
+        last = max(last or date.min, date(max(archived_years), 12, 31))
+    today = date.today()
+    first = min(first or today, today)
+    last = max(last or today, today)
+    
+    if end_date < first:
+        start_date = end_date
+    elif start_date > last:
+        end_date = start_date
+    else:
+        start_date, end_date = max(start_date, first), min(end_date, last)
+    start_date = max(start_date, end_date - timedelta(days=max_days - 1))
+    return start_date, end_date
+
+def _daily_balances(account_groups, start_date, end_date, in_base_currency, archived_rows):
+    """End-of-day balance of each group of accounts on every day in the range.
+    
+    account_groups maps account ids to the group their balance is added into. The opening
+    balances and the daily changes come from two grouped queries; archived years before the
+    range count as their stored totals, and rows of archived years in it are read.
+    """
+    days = (end_date - start_date).days + 1
+    amount = BASE_AMOUNT if in_base_currency else Transaction.amount
+    account_ids = list(account_groups)
+    opening = dict.fromkeys(account_groups.values(), 0.0)
+    changes = {group: _zeros(days) for group in opening}
+    
+    for account_id, total in db.session.query(Transaction.account_id, func.sum(signed_amount(amount))).filter(
+        Transaction.account_id.in_(account_ids),
+        Transaction.transaction_date < start_date
+    ).group_by(Transaction.account_id):
+        opening[account_groups[account_id]] += float(total or 0)
+    archived_total = ArchivedAccountTotal.base_balance if in_base_currency else ArchivedAccountTotal.balance
+    for account_id, total in db.session.query(ArchivedAccountTotal.account_id, func.sum(archived_total)).filter(
+        ArchivedAccountTotal.account_id.in_(account_ids),
+        ArchivedAccountTotal.year < start_date.year
+    ).group_by(ArchivedAccountTotal.account_id):
+        opening[account_groups[account_id]] += float(total or 0)
+    
+    for account_id, day, total in db.session.query(
+        Transaction.account_id, Transaction.transaction_date, func.sum(signed_amount(amount))
+    ).filter(
+        Transaction.account_id.in_(account_ids),
+        Transaction.transaction_date.between(start_date, end_date)
+    ).group_by(Transaction.account_id, Transaction.transaction_date):
+        changes[account_groups[account_id]][(day - start_date).days] += float(total or 0)
+    for row in archived_rows:
+        group = account_groups.get(row['account_id'])
+        if group is None:
+            continue
+        value = row['base_amount'] if in_base_currency and row['base_amount'] is not None else row['amount']
+        change = float(signed_transaction_amount(row['transaction_type'], value, row['transfer_id']))
+        if row['transaction_date'] < start_date:
+            opening[group] += change
+        else:
+            changes[group][(row['transaction_date'] - start_date).days] += change
+    
+    return {group: array('d', accumulate(changes[group], initial=opening[group]))[1:] for group in opening}
+
+@replica_reads
+def get_daily_series(user_id, start_date, end_date, series, account_id=None):
+    """Value of each requested series on every day from start_date to end_date, as arrays of floats.
+    
+    spending and income are day totals and net_worth the end-of-day net worth, as in
+    calculate_net_worth, all in BASE_CURRENCY; balance is the end-of-day balance of
+    account_id in its own currency.
+    """
+    days = (end_date - start_date).days + 1
+    archived_rows = _archived_rows(user_id, start_date, end_date)
+    result = {}
+    
+    if 'spending' in series or 'income' in series:
+        spending, income = _daily_flows(user_id, start_date, end_date, archived_rows)
+        result.update(spending=spending, income=income)
+    
+    if 'net_worth' in series:
+        accounts = dict(db.session.query(Account.id, Account.account_type).filter(
+            Account.user_id == user_id,
+            Account.is_active == True
+        ).all())
+        # Assets add up before the sum is taken, so they cost one array whatever their number;
+        # each credit account counts as abs() of its own balance, so it keeps its own
+        groups = {account: 'assets' if account_type in ASSET_TYPES else account
+                  for account, account_type in accounts.items() if account_type in ASSET_TYPES + ('credit',)}
+        balances = _daily_balances(groups, start_date, end_date, True, archived_rows)
+        net_worth = balances.pop('assets', None) or _zeros(days)
+        for debt in balances.values():
+            net_worth = array('d', (total - abs(balance) for total, balance in zip(net_worth, debt)))
+        result['net_worth'] = net_worth
+    
+    if 'balance' in series:
+        result['balance'] = _daily_balances({account_id: account_id}, start_date, end_date, False, archived_rows)[account_id]
+    
+    return {name: values for name, values in result.items() if name in series}
+
+def lttb(values, threshold):
+    """Indices of `threshold` points of an evenly spaced series chosen by Largest-Triangle-Three-Buckets.
+    
+    The first and last points are kept. The points between are split into threshold - 2
+    buckets, each keeping the point that forms the largest triangle with the point kept
+    before it and the average of the next bucket, which preserves the visual shape.
+    """
+    n = len(values)
+    threshold = max(threshold, 3)
+    if threshold >= n:
+        return list(range(n))
+    # Bucket averages in constant time from prefix sums
+    prefix = array('d', accumulate(values, initial=0.0))
+    every = (n - 2) / (threshold - 2)
+    
+    indices = [0]
+    previous = 0
+    for bucket in range(threshold - 2):
+        next_start = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, n)
+        next_x = (next_start + next_end - 1) / 2
+        next_y = (prefix[next_end] - prefix[next_start]) / (next_end - next_start)
+        
+        previous_y = values[previous]
+        chosen, largest = None, -1.0
+        for index in range(int(bucket * every) + 1, next_start):
+            # Twice the triangle's area; the factor does not change which point wins
+            area = abs((previous - next_x) * (values[index] - previous_y) - (previous - index) * (next_y - previous_y))
+            if area > largest:
+                chosen, largest = index, area
+        indices.append(chosen)
+        previous = chosen
+    
+    indices.append(n - 1)
+    return indices
+
+def min_max(values, threshold):
+    """Indices of the lowest and highest point of each of threshold // 2 equal buckets, in order.
+    
+    Unlike LTTB this never drops a spike, which suits day totals such as spending.
+    """
+    n = len(values)
+    if threshold >= n:
+        return list(range(n))
+    buckets = max(threshold // 2, 1)
+    every = n / buckets
+    
+    indices = []
+    for bucket in range(buckets):
+        start, end = int(bucket * every), int((bucket + 1) * every)
+        if start >= end:
+            continue
+        chunk = values[start:end]
+        low, high = start + chunk.index(min(chunk)), start + chunk.index(max(chunk))
+        indices.extend(sorted({low, high}))
+    return indices
+
+def downsample(values, points, method='lttb'):
+    """Indices of at most `points` points of a series picked by the method (lttb or minmax)"""
+    return min_max(values, points) if method == 'minmax' else lttb(values, points)
+
+def encode_series(start_date, values, indices, columnar=False):
+    """Chart data for the points at `indices`: ISO labels and values, or with columnar, the day
+    offsets between consecutive points (the first from start_date) and values"""
+    data = [round(values[index], 2) for index in indices]
+    if not columnar:
+        return {
+            'labels': [date.fromordinal(start_date.toordinal() + index).isoformat() for index in indices],
+            'data': data
+        }
+    return {
+        'day_deltas': [index - previous for previous, index in zip([0] + indices[:-1], indices)],
+        'values': data
+    }
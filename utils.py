@@ -1,77 +1,273 @@
 from datetime import datetime, date, timedelta
-from decimal import Decimal
-from sqlalchemy import func, and_, extract
-from models import Transaction, Budget, Account, Category, SavingsGoal, Bill, User
+from decimal import Decimal, ROUND_HALF_UP, ROUND_CEILING
+from flask import current_app
+from sqlalchemy import func, and_, or_, extract, select, case, cast, event, inspect
+from sqlalchemy.exc import IntegrityError
+from models import (Transaction, Budget, Account, Category, SavingsGoal, Bill, User, Tag, transaction_tags, ExchangeRate,
+                    SyncTombstone, FinancialHealthScore, FinancialHealthScoreHistory, CategoryClosure,
+                    AccountBalanceCheckpoint, ArchivedAccountTotal, BudgetSpend, track_previous_values)
 from app import db
+from read_models import transaction_row_query, transaction_rows, budget_rows
+from replica import replica_reads
+from jobs import enqueue
+from archive import get_archived_years, iter_archived_transactions
+from cache import TTLCache
+import base64
 import calendar
+import json
+import uuid
+from itertools import chain
 
-def get_account_balance(account_id):
+# Amount in the base currency. Rows written before base amounts existed were all
+# in the base currency, so they fall back to the raw amount.
+BASE_AMOUNT = func.coalesce(Transaction.base_amount, Transaction.amount)
+
+def signed_amount(amount=Transaction.amount):
+    """SQL version of models.signed_transaction_amount: a transaction's effect on its account balance"""
+    return case(
+        (Transaction.transaction_type == 'income', amount),
+        (Transaction.transaction_type == 'expense', -amount),
+        (and_(Transaction.transaction_type == 'transfer', Transaction.transfer_id.isnot(None)), amount),
+        else_=0
+    )
+
+def get_account_balance(account_id, in_base_currency=False):
     """Calculate the current balance of an account based on transactions"""
-    income = db.session.query(func.sum(Transaction.amount)).filter(
-        and_(
-            Transaction.account_id == account_id,
-            Transaction.transaction_type == 'income'
+    amount = BASE_AMOUNT if in_base_currency else Transaction.amount
+    balance = db.session.query(func.sum(signed_amount(amount))).filter(
+        Transaction.account_id == account_id
+    ).scalar()
+    return Decimal(str(balance or 0)) + sum(get_archived_totals(account_id, in_base_currency).values(), Decimal('0'))
+
+def get_archived_totals(account_id, in_base_currency=False):
+    """Balance change of each archived year of an account, keyed by the year's last day"""
+    column = ArchivedAccountTotal.base_balance if in_base_currency else ArchivedAccountTotal.balance
+    return {
+        date(year, 12, 31): Decimal(str(total))
+        for year, total in db.session.query(ArchivedAccountTotal.year, column).filter(
+            ArchivedAccountTotal.account_id == account_id
         )
-    ).scalar() or Decimal('0')
+    }
+
+def month_end(day):
+    """Last day of the month containing `day`"""
+    return day.replace(day=calendar.monthrange(day.year, day.month)[1])
+
+def _sum_account_range(account_id, after=None, through=None):
+    """Signed sum of an account's transactions dated after `after` and on or before `through`.
     
-    expenses = db.session.query(func.sum(Transaction.amount)).filter(
-        and_(
-            Transaction.account_id == account_id,
-            Transaction.transaction_type == 'expense'
-        )
-    ).scalar() or Decimal('0')
+    Archived years count as a single change on their last day.
+    """
+    query = db.session.query(func.sum(signed_amount())).filter(Transaction.account_id == account_id)
+    if after is not None:
+        query = query.filter(Transaction.transaction_date > after)
+    if through is not None:
+        query = query.filter(Transaction.transaction_date <= through)
+    archived = sum((total for year_end, total in get_archived_totals(account_id).items()
+                    if (after is None or year_end > after) and (through is None or year_end <= through)), Decimal('0'))
+    return Decimal(str(query.scalar() or 0)) + archived
+
+def ensure_balance_checkpoints(account_id, through):
+    """Create any missing month-end checkpoints of an account up to the month end `through`.
+    
+    Existing checkpoints are kept current by models.maintain_balance_checkpoints, so
+    this only fills months past the latest one, with a single grouped query.
+    """
+    latest = AccountBalanceCheckpoint.query.filter_by(account_id=account_id).order_by(
+        AccountBalanceCheckpoint.period_end.desc()
+    ).first()
+    archived = get_archived_totals(account_id)
+    if latest:
+        if latest.period_end >= through:
+            return
+        start, running = latest.period_end + timedelta(days=1), Decimal(str(latest.balance))
+    else:
+        first_date = db.session.query(func.min(Transaction.transaction_date)).filter(
+            Transaction.account_id == account_id
+        ).scalar()
+        first_date = min(filter(None, [first_date, *archived]), default=None)
+        if first_date is None or first_date > through:
+            return
+        start, running = first_date.replace(day=1), Decimal('0')
+    
+    daily = db.session.query(
+        Transaction.transaction_date,
+        func.sum(signed_amount())
+    ).filter(
+        Transaction.account_id == account_id,
+        Transaction.transaction_date >= start,
+        Transaction.transaction_date <= through
+    ).group_by(Transaction.transaction_date).all()
+    by_month = {}
+    for day, total in chain(daily, archived.items()):
+        if start <= day <= through:
+            by_month[month_end(day)] = by_month.get(month_end(day), Decimal('0')) + Decimal(str(total or 0))
     
-    return income - expenses
+    rows = []
+    period_end = month_end(start)
+    while period_end <= through:
+        running += by_month.get(period_end, Decimal('0'))
+        rows.append({'account_id': account_id, 'period_end': period_end, 'balance': running})
+        period_end = month_end(period_end + timedelta(days=1))
+    
+    try:
+        db.session.execute(AccountBalanceCheckpoint.__table__.insert(), rows)
+        db.session.commit()
+    except IntegrityError:
+        # Another request filled the same months first
+        db.session.rollback()
+
+def _checkpoint_horizon(as_of):
+    """Latest month end worth checkpointing for a lookup on `as_of`: the one before it, never in the future"""
+    if as_of.replace(day=1) == date.min:
+        return date.min
+    before_as_of = as_of.replace(day=1) - timedelta(days=1)
+    last_closed = date.today().replace(day=1) - timedelta(days=1)
+    return min(before_as_of, last_closed)
+
+def get_balance_as_of(account_id, as_of):
+    """Account balance at the end of `as_of`: the latest checkpoint plus at most a month or so of rows"""
+    ensure_balance_checkpoints(account_id, _checkpoint_horizon(as_of))
+    checkpoint = AccountBalanceCheckpoint.query.filter(
+        AccountBalanceCheckpoint.account_id == account_id,
+        AccountBalanceCheckpoint.period_end <= as_of
+    ).order_by(AccountBalanceCheckpoint.period_end.desc()).first()
+    
+    if checkpoint is None:
+        return _sum_account_range(account_id, through=as_of)
+    return Decimal(str(checkpoint.balance)) + _sum_account_range(account_id, checkpoint.period_end, as_of)
+
+def get_balance_history(account_id, start_date, end_date):
+    """Month-end balances between two dates plus the balance on `end_date`, as (date, balance) pairs"""
+    ensure_balance_checkpoints(account_id, _checkpoint_horizon(end_date))
+    checkpoints = dict(db.session.query(
+        AccountBalanceCheckpoint.period_end,
+        AccountBalanceCheckpoint.balance
+    ).filter(
+        AccountBalanceCheckpoint.account_id == account_id,
+        AccountBalanceCheckpoint.period_end >= start_date,
+        AccountBalanceCheckpoint.period_end <= end_date
+    ).all())
+    
+    # Month ends without a checkpoint come before the account's first transaction, where the balance
+    # does not change, or after the latest checkpoint; both carry forward the balance from one lookup,
+    # the later ones adding their months' rows from one grouped query
+    last_checkpoint = max(checkpoints, default=None)
+    later_changes = None
+    history = []
+    balance = previous = None
+    period_end = month_end(start_date)
+    while period_end < end_date:
+        if period_end in checkpoints:
+            balance = Decimal(str(checkpoints[period_end]))
+        elif balance is None:
+            balance = get_balance_as_of(account_id, period_end)
+        elif last_checkpoint is None or period_end > last_checkpoint:
+            if later_changes is None:
+                later_changes = _monthly_changes(account_id, previous, end_date)
+            balance += later_changes.get(period_end, Decimal('0'))
+        history.append((period_end, balance))
+        previous = period_end
+        period_end = month_end(period_end + timedelta(days=1))
+    history.append((end_date, get_balance_as_of(account_id, end_date)))
+    return history
 
-def get_monthly_spending_by_category(user_id, month=None, year=None):
-    """Get spending breakdown by category for a given month"""
-    if not month:
-        month = datetime.now().month
-    if not year:
-        year = datetime.now().year
+def _monthly_changes(account_id, after, through):
+    """Change of an account's balance in each month after `after` through `through`, by month end"""
+    daily = db.session.query(
+        Transaction.transaction_date,
+        func.sum(signed_amount())
+    ).filter(
+        Transaction.account_id == account_id,
+        Transaction.transaction_date > after,
+        Transaction.transaction_date <= through
+    ).group_by(Transaction.transaction_date).all()
+    changes = {}
+    for day, total in chain(daily, get_archived_totals(account_id).items()):
+        if after < day <= through:
+            changes[month_end(day)] = changes.get(month_end(day), Decimal('0')) + Decimal(str(total or 0))
+    return changes
+
+def month_range(month=None, year=None):
+    """First day of the given (default current) month and first day of the next one"""
+    today = date.today()
+    first_day = date(year or today.year, month or today.month, 1)
+    return first_day, add_months(first_day, 1)
+
+def category_rollup_condition(level):
+    """Closure rows mapping each category to its ancestor at `level` (0 = top level).
+    
+    Categories shallower than `level` map to themselves.
+    """
+    return or_(
+        CategoryClosure.ancestor_level == level,
+        and_(CategoryClosure.depth == 0, CategoryClosure.ancestor_level < level)
+    )
+
+@replica_reads
+def get_monthly_spending_by_category(user_id, month=None, year=None, level=None):
+    """Get spending breakdown by category for a given month.
+    
+    With `level`, spending rolls up to the categories at that tree level
+    (0 = top-level parents) instead of the categories used on transactions.
+    """
+    start_date, end_date = month_range(month, year)
     
     query = db.session.query(
         Category.name,
         Category.color,
-        func.sum(Transaction.amount).label('total')
-    ).join(Transaction).filter(
+        func.sum(BASE_AMOUNT).label('total')
+    )
+    if level is None:
+        query = query.join(Transaction, Transaction.category_id == Category.id)
+    else:
+        query = query.join(CategoryClosure, and_(
+            CategoryClosure.ancestor_id == Category.id,
+            category_rollup_condition(level)
+        )).join(Transaction, Transaction.category_id == CategoryClosure.descendant_id)
+    
+    query = query.filter(
         and_(
             Transaction.user_id == user_id,
             Transaction.transaction_type == 'expense',
-            extract('month', Transaction.transaction_date) == month,
-            extract('year', Transaction.transaction_date) == year
+            Transaction.transaction_date >= start_date,
+            Transaction.transaction_date < end_date
         )
     ).group_by(Category.id, Category.name, Category.color)
     
     return query.all()
 
 def get_budget_progress(user_id, month=None, year=None):
-    """Get budget progress for the current or specified month"""
-    if not month:
-        month = datetime.now().month
-    if not year:
-        year = datetime.now().year
-    
-    # Get all active budgets for the user
-    budgets = Budget.query.filter(
+    """Get budget progress for the current or specified month.
+    
+    A budget on a parent category counts spending in all of its subcategories.
+    """
+    start_date, end_date = month_range(month, year)
+    
+    # Get all active budgets for the user, with their category names
+    budgets = budget_rows(Budget.user_id == user_id, Budget.is_active == True)
+    if not budgets:
+        return []
+    
+    # Spending per budgeted category, including descendants, in one grouped query
+    spent_by_category = dict(db.session.query(
+        CategoryClosure.ancestor_id,
+        func.sum(BASE_AMOUNT)
+    ).join(Transaction, Transaction.category_id == CategoryClosure.descendant_id).filter(
         and_(
-            Budget.user_id == user_id,
-            Budget.is_active == True
+            CategoryClosure.ancestor_id.in_({budget.category_id for budget in budgets}),
+            Transaction.user_id == user_id,
+            Transaction.transaction_type == 'expense',
+            Transaction.transaction_date >= start_date,
+            Transaction.transaction_date < end_date
         )
-    ).all()
+    ).group_by(CategoryClosure.ancestor_id).all())
     
     budget_progress = []
     for budget in budgets:
-        # Calculate spent amount for this category in the current month
-        spent = db.session.query(func.sum(Transaction.amount)).filter(
-            and_(
-                Transaction.user_id == user_id,
-                Transaction.category_id == budget.category_id,
-                Transaction.transaction_type == 'expense',
-                extract('month', Transaction.transaction_date) == month,
-                extract('year', Transaction.transaction_date) == year
-            )
-        ).scalar() or Decimal('0')
+        spent = spent_by_category.get(budget.category_id) or Decimal('0')
+        if not isinstance(spent, Decimal):
+            spent = Decimal(str(spent))
         
         progress_percent = float((spent / budget.amount) * 100) if budget.amount > 0 else 0
         
@@ -86,22 +282,23 @@ def get_budget_progress(user_id, month=None, year=None):
     return budget_progress
 
 def get_recent_transactions(user_id, limit=10):
-    """Get recent transactions for a user"""
-    return Transaction.query.filter(Transaction.user_id == user_id)\
-        .order_by(Transaction.transaction_date.desc(), Transaction.created_at.desc())\
-        .limit(limit).all()
+    """Get recent transactions for a user, as TransactionRows"""
+    return transaction_rows(transaction_row_query(Transaction.user_id == user_id)
+                            .order_by(Transaction.transaction_date.desc(), Transaction.created_at.desc())
+                            .limit(limit).all())
 
+@replica_reads
 def get_monthly_income_expense_trend(user_id, months=12):
-    """Get monthly income vs expense trend for the last N months"""
+    """Get monthly income vs expense trend for the last N calendar months, including this one"""
     end_date = date.today()
-    start_date = end_date - timedelta(days=30 * months)
+    start_date = add_months(date(end_date.year, end_date.month, 1), -(months - 1))
     
     # Get monthly aggregates
     query = db.session.query(
         extract('year', Transaction.transaction_date).label('year'),
         extract('month', Transaction.transaction_date).label('month'),
         Transaction.transaction_type,
-        func.sum(Transaction.amount).label('total')
+        func.sum(BASE_AMOUNT).label('total')
     ).filter(
         and_(
             Transaction.user_id == user_id,
@@ -123,13 +320,337 @@ def get_monthly_income_expense_trend(user_id, months=12):
     
     return monthly_data
 
+def add_months(day, months):
+    """Shift a date by whole calendar months, clamping to the last day of the month"""
+    month_index = day.year * 12 + day.month - 1 + months
+    year, month = divmod(month_index, 12)
+    month += 1
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+REPORT_BUCKETS = ('day', 'week', 'month', 'quarter', 'year')
+
+# Grouping dimensions for get_report: output key -> columns to select and group by
+REPORT_DIMENSIONS = {
+    'category': (Category.name, Category.id),
+    'account': (Account.name, Account.id),
+    'payment_method': (Transaction.payment_method,),
+    'type': (Transaction.transaction_type,),
+}
+
+def _bucket_start(bucket, column):
+    """SQL expression truncating a date column to the start of its bucket"""
+    if db.engine.dialect.name == 'postgresql':
+        return cast(func.date_trunc(bucket, column), db.Date)
+    
+    # SQLite has no date_trunc; weeks start on Monday as in Postgres
+    if bucket == 'day':
+        return func.date(column)
+    if bucket == 'week':
+        return func.date(column, 'weekday 0', '-6 days')
+    if bucket == 'month':
+        return func.strftime('%Y-%m-01', column)
+    if bucket == 'quarter':
+        quarter_month = (func.cast(func.strftime('%m', column), db.Integer) - 1) // 3 * 3 + 1
+        return func.printf('%s-%02d-01', func.strftime('%Y', column), quarter_month)
+    return func.strftime('%Y-01-01', column)
+
+def _bucket_start_date(bucket, day):
+    """Python version of _bucket_start, for rows read from archive files"""
+    if bucket == 'day':
+        return day
+    if bucket == 'week':
+        return day - timedelta(days=day.weekday())
+    if bucket == 'month':
+        return day.replace(day=1)
+    if bucket == 'quarter':
+        return date(day.year, (day.month - 1) // 3 * 3 + 1, 1)
+    return date(day.year, 1, 1)
+
+def _archived_report_entries(user_id, ranges, start_date, bucket, group_by, category_level):
+    """get_report entries for archived transactions in any of the (start, end) ranges"""
+    category_names = dict(db.session.query(Category.id, Category.name).filter(
+        (Category.user_id == user_id) | (Category.is_system == True)
+    ).all())
+    if category_level is not None:
+        rollup = dict(db.session.query(CategoryClosure.descendant_id, CategoryClosure.ancestor_id).filter(
+            category_rollup_condition(category_level)
+        ).all())
+        category_names = {category_id: category_names.get(rollup.get(category_id)) for category_id in category_names}
+    account_names = dict(db.session.query(Account.id, Account.name).filter(Account.user_id == user_id).all())
+    dimension_values = {
+        'category': lambda row: category_names.get(row['category_id']),
+        'account': lambda row: account_names.get(row['account_id']),
+        'payment_method': lambda row: row['payment_method'],
+        'type': lambda row: row['transaction_type'],
+    }
+    
+    first_day = min(start for start, _ in ranges)
+    last_day = max(end for _, end in ranges)
+    for row in iter_archived_transactions(user_id, first_day, last_day):
+        day = row['transaction_date']
+        if row['transaction_type'] not in ('income', 'expense') or \
+                not any(start <= day <= end for start, end in ranges):
+            continue
+        amount = float(row['base_amount'] if row['base_amount'] is not None else row['amount'])
+        values = (amount, 0.0, 1) if row['transaction_type'] == 'income' else (0.0, amount, 1)
+        dimensions = tuple(dimension_values[name](row) for name in group_by)
+        yield _bucket_start_date(bucket, day), day >= start_date, dimensions, values
+
+def _shift_year(day, bucket, years):
+    # Weeks shift by 52 weeks so that week starts stay aligned
+    if bucket == 'week':
+        return day + timedelta(weeks=52 * years)
+    return add_months(day, 12 * years)
+
+@replica_reads
+def get_report(user_id, start_date, end_date, bucket='month', group_by=(), compare_previous_year=False,
+               category_level=None):
+    """Income, expense and net per time bucket and grouping dimensions, in one aggregate query.
+    
+    With category_level, the category dimension rolls up to the categories at
+    that tree level (0 = top-level parents).
+    
+    With compare_previous_year, the query also covers the same range a year
+    earlier and each row gets a 'previous' entry from that part of the result,
+    instead of running a second scan.
+    """
+    if bucket not in REPORT_BUCKETS:
+        raise ValueError(f"Unknown bucket: {bucket}")
+    unknown = set(group_by) - set(REPORT_DIMENSIONS)
+    if unknown:
+        raise ValueError(f"Unknown grouping: {', '.join(sorted(unknown))}")
+    if start_date > end_date:
+        raise ValueError("Start date must not be after end date")
+    
+    bucket_start = _bucket_start(bucket, Transaction.transaction_date).label('bucket')
+    # Rows before start_date can only come from the previous-year range
+    in_current = case((Transaction.transaction_date >= start_date, 1), else_=0).label('in_current')
+    dimension_columns = [column for name in group_by for column in REPORT_DIMENSIONS[name]]
+    
+    ranges = [(start_date, end_date)]
+    if compare_previous_year:
+        ranges.append((_shift_year(start_date, bucket, -1), _shift_year(end_date, bucket, -1)))
+    in_range = or_(*(and_(Transaction.transaction_date >= start, Transaction.transaction_date <= end)
+                     for start, end in ranges))
+    
+    query = db.session.query(
+        bucket_start,
+        in_current,
+        *dimension_columns,
+        func.sum(case((Transaction.transaction_type == 'income', BASE_AMOUNT), else_=0)).label('income'),
+        func.sum(case((Transaction.transaction_type == 'expense', BASE_AMOUNT), else_=0)).label('expense'),
+        func.count(Transaction.id).label('count')
+    ).select_from(Transaction)
+    if 'category' in group_by and category_level is not None:
+        query = query.outerjoin(CategoryClosure, and_(
+            CategoryClosure.descendant_id == Transaction.category_id,
+            category_rollup_condition(category_level)
+        )).outerjoin(Category, Category.id == CategoryClosure.ancestor_id)
+    elif 'category' in group_by:
+        query = query.outerjoin(Category, Category.id == Transaction.category_id)
+    if 'account' in group_by:
+        query = query.join(Account, Account.id == Transaction.account_id)
+    
+    results = query.filter(
+        and_(
+            Transaction.user_id == user_id,
+            Transaction.transaction_type.in_(['income', 'expense']),
+            in_range
+        )
+    ).group_by(bucket_start, in_current, *dimension_columns).order_by(bucket_start).all()
+    
+    # Position of each dimension's display column in the result rows
+    positions = [2 + dimension_columns.index(REPORT_DIMENSIONS[name][0]) for name in group_by]
+    
+    entries = [(
+        result.bucket if isinstance(result.bucket, date) else date.fromisoformat(result.bucket),
+        result.in_current,
+        tuple(result[position] for position in positions),
+        (float(result.income or 0), float(result.expense or 0), result.count)
+    ) for result in results]
+    
+    # Long ranges reaching into archived years read those years from the archive files
+    archived_years = get_archived_years(user_id)
+    if any(start.year <= year <= end.year for start, end in ranges for year in archived_years):
+        entries = chain(entries, _archived_report_entries(user_id, ranges, start_date, bucket, group_by, category_level))
+    
+    def add(merged, values):
+        return tuple(a + b for a, b in zip(merged or (0.0, 0.0, 0), values))
+    
+    current = {}
+    by_bucket = {}  # all rows of both ranges, for previous-year lookups
+    for bucket_date, is_current, dimensions, values in entries:
+        key = (bucket_date, dimensions)
+        if is_current:
+            current[key] = add(current.get(key), values)
+        # A bucket straddling start_date has a row in each range
+        by_bucket[key] = add(by_bucket.get(key), values)
+    
+    def measures(values):
+        income, expense, count = values
+        return {'income': income, 'expense': expense, 'net': income - expense, 'count': count}
+    
+    rows = []
+    for (bucket_date, dimensions), values in sorted(current.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+        row = {'bucket': bucket_date.isoformat()}
+        row.update(zip(group_by, dimensions))
+        row.update(measures(values))
+        if compare_previous_year:
+            previous = by_bucket.get((_shift_year(bucket_date, bucket, -1), dimensions))
+            row['previous'] = measures(previous) if previous else None
+        rows.append(row)
+    
+    return {
+        'start': start_date.isoformat(),
+        'end': end_date.isoformat(),
+        'bucket': bucket,
+        'group_by': list(group_by),
+        'currency': get_base_currency(),
+        'rows': rows
+    }
+
+# Projections are plain values keyed by the user's data_version, so any write invalidates them
+goal_projection_cache = TTLCache(max_entries=5000, name='goal_projections')
+
+DAYS_PER_MONTH = Decimal('30.4375')
+
+def _bucket_date(value):
+    """A _bucket_start value as a date: Postgres returns a date, SQLite ISO text"""
+    return value if isinstance(value, date) else date.fromisoformat(str(value)[:10])
+
+def get_goal_contributions(user_id, goals, since):
+    """Monthly contributions to linked goals from the month `since` on: goal id -> {month start: amount}.
+    
+    An account-linked goal counts the account's net balance change, a category-linked goal
+    the base amounts of transactions in the category and its subcategories. Each kind is one
+    grouped query using the (account_id, transaction_date) or (category_id, transaction_date) index.
+    """
+    month = _bucket_start('month', Transaction.transaction_date)
+    account_ids = {goal.account_id for goal in goals if goal.account_id}
+    category_ids = {goal.category_id for goal in goals if goal.category_id and not goal.account_id}
+    
+    by_account = {}
+    if account_ids:
+        rows = db.session.query(Transaction.account_id, month, func.sum(signed_amount(BASE_AMOUNT))).filter(
+            Transaction.user_id == user_id,
+            Transaction.account_id.in_(account_ids),
+            Transaction.transaction_date >= since
+        ).group_by(Transaction.account_id, month)
+        for account_id, month_start, total in rows:
+            by_account.setdefault(account_id, {})[_bucket_date(month_start)] = Decimal(str(total or 0))
+    
+    by_category = {}
+    if category_ids:
+        rows = db.session.query(CategoryClosure.ancestor_id, month, func.sum(BASE_AMOUNT))\
+            .join(Transaction, Transaction.category_id == CategoryClosure.descendant_id).filter(
+                CategoryClosure.ancestor_id.in_(category_ids),
+                Transaction.user_id == user_id,
+                Transaction.transaction_date >= since
+            ).group_by(CategoryClosure.ancestor_id, month)
+        for category_id, month_start, total in rows:
+            by_category.setdefault(category_id, {})[_bucket_date(month_start)] = Decimal(str(total or 0))
+    
+    return {
+        goal.id: by_account.get(goal.account_id, {}) if goal.account_id else by_category.get(goal.category_id, {})
+        for goal in goals if goal.account_id or goal.category_id
+    }
+
+def _contribution_rate(history):
+    """Least-squares slope of the cumulative amount saved over a run of monthly contributions"""
+    cumulative, total = [], Decimal('0')
+    for amount in history:
+        total += amount
+        cumulative.append(total)
+    n = len(cumulative)
+    if n == 1:
+        return cumulative[0]
+    
+    # Closed form over month indexes 0..n-1, so a fit costs one pass whatever the history length
+    mean_x = Decimal(n - 1) / 2
+    mean_y = sum(cumulative) / n
+    covariance = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(cumulative))
+    variance = sum((x - mean_x) ** 2 for x in range(n))
+    return covariance / variance
+
+def _goal_projection(goal, contributions, today, months):
+    """Amount saved, contribution rate and completion estimates for one goal"""
+    start_month = (goal.created_at.date() if goal.created_at else today).replace(day=1)
+    saved = Decimal(str(goal.current_amount or 0)) + sum(
+        (amount for month, amount in contributions.items() if month >= start_month), Decimal('0')
+    )
+    remaining = Decimal(str(goal.target_amount)) - saved
+    
+    # Completed months only, zero-filled, so the current partial month does not drag the rate down
+    current_month = today.replace(day=1)
+    history_start = max(start_month, add_months(current_month, -months))
+    history = []
+    month = history_start
+    while month < current_month:
+        history.append(contributions.get(month, Decimal('0')))
+        month = add_months(month, 1)
+    
+    monthly_rate = None
+    if goal.account_id or goal.category_id:
+        if history:
+            monthly_rate = _contribution_rate(history).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+        elif contributions.get(current_month):
+            monthly_rate = contributions[current_month]
+    
+    projected_date = None
+    if remaining > 0 and monthly_rate and monthly_rate > 0:
+        days = remaining / monthly_rate * DAYS_PER_MONTH
+        projected_date = today + timedelta(days=int(days.to_integral_value(rounding=ROUND_CEILING)))
+    
+    required_rate = None
+    if goal.target_date and remaining > 0:
+        months_left = Decimal((goal.target_date - today).days) / DAYS_PER_MONTH
+        required_rate = (remaining / months_left if months_left >= 1 else remaining).quantize(
+            Decimal('0.01'), rounding=ROUND_HALF_UP
+        )
+    
+    on_track = None
+    if remaining <= 0:
+        on_track = True
+    elif required_rate is not None and monthly_rate is not None:
+        on_track = monthly_rate >= required_rate
+    
+    return {
+        'saved_amount': saved,
+        'monthly_rate': monthly_rate,
+        'projected_completion_date': projected_date,
+        'required_monthly_rate': required_rate,
+        'on_track': on_track
+    }
+
+def get_goal_projections(user_id, goals):
+    """Projections for a user's goals, keyed by goal id and cached until the user's data changes"""
+    data_version = db.session.query(User.data_version).filter(User.id == user_id).scalar() or 0
+    today = date.today()
+    months = current_app.config['GOAL_PROJECTION_MONTHS']
+    
+    def compute():
+        since = min((goal.created_at.date() if goal.created_at else today) for goal in goals).replace(day=1)
+        contributions = get_goal_contributions(user_id, goals, since)
+        return {goal.id: _goal_projection(goal, contributions.get(goal.id, {}), today, months) for goal in goals}
+    
+    projections, _ = goal_projection_cache.get_or_set(
+        ('goal_projections', user_id, data_version, today), compute,
+        current_app.config['GOAL_PROJECTION_CACHE_SECONDS']
+    )
+    return projections
+
 def get_savings_goals_progress(user_id):
-    """Get savings goals with progress calculation"""
+    """Get savings goals with progress calculation and projected completion"""
     goals = SavingsGoal.query.filter(SavingsGoal.user_id == user_id).all()
+    if not goals:
+        return []
+    projections = get_goal_projections(user_id, goals)
     
     goals_with_progress = []
     for goal in goals:
-        progress_percent = float((goal.current_amount / goal.target_amount) * 100) if goal.target_amount > 0 else 0
+        projection = projections[goal.id]
+        saved = projection['saved_amount']
+        progress_percent = float((saved / goal.target_amount) * 100) if goal.target_amount > 0 else 0
         
         days_remaining = None
         if goal.target_date:
@@ -137,9 +658,14 @@ def get_savings_goals_progress(user_id):
         
         goals_with_progress.append({
             'goal': goal,
+            'saved_amount': saved,
             'progress_percent': progress_percent,
             'days_remaining': days_remaining,
-            'remaining_amount': goal.target_amount - goal.current_amount
+            'remaining_amount': goal.target_amount - saved,
+            'monthly_rate': projection['monthly_rate'],
+            'projected_completion_date': projection['projected_completion_date'],
+            'required_monthly_rate': projection['required_monthly_rate'],
+            'on_track': projection['on_track']
         })
     
     return goals_with_progress
@@ -156,20 +682,32 @@ def get_upcoming_bills(user_id, days_ahead=30):
         )
     ).order_by(Bill.due_date).all()
 
+@replica_reads
 def calculate_net_worth(user_id):
-    """Calculate user's net worth based on all accounts"""
-    accounts = Account.query.filter(
+    """Calculate user's net worth in the base currency based on all accounts"""
+    # One grouped query for all accounts instead of two SUMs per account
+    balances = db.session.query(
+        Account.id,
+        Account.account_type,
+        func.coalesce(func.sum(signed_amount(BASE_AMOUNT)), 0).label('balance')
+    ).outerjoin(Transaction, Transaction.account_id == Account.id).filter(
         and_(
             Account.user_id == user_id,
             Account.is_active == True
         )
-    ).all()
+    ).group_by(Account.id, Account.account_type).all()
+    archived = dict(db.session.query(
+        ArchivedAccountTotal.account_id,
+        func.sum(ArchivedAccountTotal.base_balance)
+    ).join(Account, Account.id == ArchivedAccountTotal.account_id).filter(
+        Account.user_id == user_id
+    ).group_by(ArchivedAccountTotal.account_id).all())
     
     assets = Decimal('0')
     liabilities = Decimal('0')
     
-    for account in accounts:
-        balance = get_account_balance(account.id)
+    for account in balances:
+        balance = Decimal(str(account.balance)) + Decimal(str(archived.get(account.id) or 0))
         if account.account_type in ['checking', 'savings', 'investment']:
             assets += balance
         elif account.account_type == 'credit':
@@ -181,87 +719,503 @@ def calculate_net_worth(user_id):
         'net_worth': assets - liabilities
     }
 
+def get_base_currency():
+    """Currency that aggregates are reported in"""
+    return current_app.config.get('BASE_CURRENCY', 'USD')
+
+def get_currency_choices():
+    """Currencies an account can use: the base currency plus any with imported rates"""
+    base_currency = get_base_currency()
+    currencies = {base_currency}
+    currencies.update(row.currency for row in db.session.query(ExchangeRate.currency).distinct())
+    return [(currency, currency) for currency in sorted(currencies)]
+
+class MissingExchangeRate(ValueError):
+    """A currency has no exchange rates, e.g. an account created before any were imported"""
+    def __init__(self, currency):
+        super().__init__(f"No exchange rate available for {currency}")
+        self.currency = currency
+
+def get_exchange_rate(currency, on_date):
+    """Get the rate converting `currency` to the base currency on a given date.
+    
+    Uses the latest rate on or before the date, falling back to the earliest later
+    rate for dates before the rate history starts. Returns None if the currency has
+    no rates at all.
+    """
+    if not currency or currency == get_base_currency():
+        return Decimal('1')
+    
+    rate = db.session.query(ExchangeRate.rate).filter(
+        and_(
+            ExchangeRate.currency == currency,
+            ExchangeRate.rate_date <= on_date
+        )
+    ).order_by(ExchangeRate.rate_date.desc()).limit(1).scalar()
+    
+    if rate is None:
+        rate = db.session.query(ExchangeRate.rate).filter(
+            ExchangeRate.currency == currency
+        ).order_by(ExchangeRate.rate_date).limit(1).scalar()
+    
+    return rate
+
+def convert_to_base(amount, currency, on_date):
+    """Convert an amount to the base currency using the rate on a given date"""
+    rate = get_exchange_rate(currency, on_date)
+    if rate is None:
+        raise MissingExchangeRate(currency)
+    return (Decimal(amount) * Decimal(rate)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+def apply_base_amount(transaction):
+    """Store the base-currency amount on a transaction; call on every write.
+    
+    Raises MissingExchangeRate when the account's currency has no rates.
+    """
+    account = db.session.get(Account, transaction.account_id)
+    transaction.base_amount = convert_to_base(
+        transaction.amount,
+        account.currency if account else None,
+        transaction.transaction_date
+    )
+
+def get_transfer_legs(transaction):
+    """(outgoing, incoming) rows of the transfer a transaction belongs to; either may be None"""
+    outgoing = incoming = None
+    if transaction.transfer_id:
+        for leg in Transaction.query.filter_by(user_id=transaction.user_id, transfer_id=transaction.transfer_id):
+            if leg.amount < 0:
+                outgoing = leg
+            else:
+                incoming = leg
+    return outgoing, incoming
+
+def save_transfer(user_id, from_account_id, to_account_id, amount, transaction_date, transaction=None, **fields):
+    """Create or update a transfer as two linked 'transfer' rows, so both balances move.
+    
+    The source account gets -amount and the destination +amount, converted through
+    the base currency when the accounts' currencies differ. `transaction` is an
+    existing row being edited; its counterpart is updated or created. Other keyword
+    arguments (description, category_id, ...) are set on both rows.
+    Raises MissingExchangeRate before adding either row when a currency has no rates.
+    Returns (outgoing, incoming).
+    """
+    outgoing, incoming = get_transfer_legs(transaction) if transaction is not None else (None, None)
+    if transaction is not None and not transaction.transfer_id:
+        outgoing = transaction
+    transfer_id = (transaction.transfer_id if transaction is not None else None) or uuid.uuid4().hex
+    outgoing = outgoing or Transaction(user_id=user_id)
+    incoming = incoming or Transaction(user_id=user_id)
+    
+    from_account = db.session.get(Account, from_account_id)
+    to_account = db.session.get(Account, to_account_id)
+    amount = Decimal(amount)
+    incoming_amount = amount
+    if from_account.currency != to_account.currency:
+        to_rate = get_exchange_rate(to_account.currency, transaction_date)
+        if to_rate is None:
+            raise MissingExchangeRate(to_account.currency)
+        incoming_amount = (convert_to_base(amount, from_account.currency, transaction_date) / Decimal(to_rate)).quantize(
+            Decimal('0.01'), rounding=ROUND_HALF_UP)
+    
+    for leg, account_id, leg_amount in ((outgoing, from_account_id, -amount), (incoming, to_account_id, incoming_amount)):
+        leg.account_id = account_id
+        leg.amount = leg_amount
+        leg.transaction_type = 'transfer'
+        leg.transfer_id = transfer_id
+        leg.transaction_date = transaction_date
+        for name, value in fields.items():
+            setattr(leg, name, value)
+        apply_base_amount(leg)
+    db.session.add_all((outgoing, incoming))
+    return outgoing, incoming
+
+def import_exchange_rates(rows):
+    """Insert or update exchange rates from (rate_date, currency, rate) rows.
+    
+    Returns the number of rows written and, per currency, the earliest date that
+    changed so stored base amounts can be re-converted from there.
+    """
+    rows = [(rate_date, currency.upper(), Decimal(rate)) for rate_date, currency, rate in rows]
+    if not rows:
+        return 0, {}
+    
+    existing = {
+        (rate.currency, rate.rate_date): rate
+        for rate in ExchangeRate.query.filter(
+            ExchangeRate.currency.in_({currency for _, currency, _ in rows})
+        ).all()
+    }
+    
+    written = 0
+    changed_since = {}
+    for rate_date, currency, value in rows:
+        rate = existing.get((currency, rate_date))
+        if rate is None:
+            rate = ExchangeRate(currency=currency, rate_date=rate_date, rate=value)
+            db.session.add(rate)
+            existing[(currency, rate_date)] = rate
+        elif rate.rate == value:
+            continue
+        else:
+            rate.rate = value
+        written += 1
+        if currency not in changed_since or rate_date < changed_since[currency]:
+            changed_since[currency] = rate_date
+    
+    db.session.commit()
+    return written, changed_since
+
+def base_amount_expression():
+    """SQL expression for a transaction's amount in the base currency at the current rates"""
+    # Always correlated to the transaction row being updated, even when nested
+    account_currency = select(Account.currency).where(
+        Account.id == Transaction.account_id
+    ).correlate_except(Account).scalar_subquery()
+    
+    rate_on_or_before = select(ExchangeRate.rate).where(
+        and_(
+            ExchangeRate.currency == account_currency,
+            ExchangeRate.rate_date <= Transaction.transaction_date
+        )
+    ).order_by(ExchangeRate.rate_date.desc()).limit(1).scalar_subquery()
+    
+    earliest_rate = select(ExchangeRate.rate).where(
+        ExchangeRate.currency == account_currency
+    ).order_by(ExchangeRate.rate_date).limit(1).scalar_subquery()
+    
+    rate = case(
+        (func.coalesce(account_currency, get_base_currency()) == get_base_currency(), 1),
+        else_=func.coalesce(rate_on_or_before, earliest_rate)
+    )
+    return func.round(Transaction.amount * rate, 2)
+
+def reconvert_base_amounts(currency=None, since=None, account_id=None, user_id=None):
+    """Recompute stored base amounts in one set-based UPDATE, e.g. after rates are corrected.
+    
+    Optionally limited to accounts in one currency, to a single account or user and
+    to transactions on or after a date. Returns the number of transactions updated.
+    """
+    filters = []
+    if currency:
+        filters.append(Transaction.account_id.in_(select(Account.id).where(Account.currency == currency)))
+    if account_id:
+        filters.append(Transaction.account_id == account_id)
+    if user_id:
+        filters.append(Transaction.user_id == user_id)
+    if since:
+        filters.append(Transaction.transaction_date >= since)
+    
+    statement = db.update(Transaction).where(*filters).values(base_amount=base_amount_expression())
+    result = db.session.execute(statement.execution_options(synchronize_session=False))
+    
+    invalidate_derived_data(select(Transaction.user_id).where(*filters).distinct())
+    db.session.commit()
+    return result.rowcount
+
+def invalidate_derived_data(user_ids):
+    """Bulk updates of transactions bypass the flush hooks, so after one bump these users' data
+    versions and drop their running budget spend, which is rebuilt from their rows on the next write"""
+    db.session.execute(db.update(User).where(
+        User.id.in_(user_ids)
+    ).values(data_version=func.coalesce(User.data_version, 0) + 1).execution_options(synchronize_session=False))
+    db.session.execute(BudgetSpend.__table__.delete().where(
+        BudgetSpend.__table__.c.budget_id.in_(select(Budget.id).where(Budget.user_id.in_(user_ids)))
+    ))
+
 def format_currency(amount, currency='USD'):
     """Format amount as currency"""
     if currency == 'USD':
         return f"${amount:,.2f}"
     return f"{amount:,.2f} {currency}"
 
-def get_financial_health_score(user_id):
-    """Calculate a simple financial health score based on various factors"""
-    score = 0
+def calculate_health_score_factors(user_id):
+    """Calculate a simple financial health score and the factors it is made of"""
     max_score = 100
+    budget_score = 0
+    savings_score = 0
+    net_worth_score = 0
     
     # Factor 1: Budget adherence (40 points)
     budget_progress = get_budget_progress(user_id)
     if budget_progress:
         over_budget_count = sum(1 for bp in budget_progress if bp['is_over_budget'])
         budget_score = max(0, 40 - (over_budget_count * 10))
-        score += budget_score
     
     # Factor 2: Savings goals progress (30 points)
     goals_progress = get_savings_goals_progress(user_id)
     if goals_progress:
         avg_progress = sum(gp['progress_percent'] for gp in goals_progress) / len(goals_progress)
         savings_score = min(30, avg_progress * 0.3)
-        score += savings_score
     
     # Factor 3: Net worth positivity (30 points)
     net_worth_data = calculate_net_worth(user_id)
     if net_worth_data['net_worth'] > 0:
-        score += 30
+        net_worth_score = 30
     elif net_worth_data['net_worth'] > -1000:  # Small negative is ok
-        score += 15
+        net_worth_score = 15
     
-    return min(max_score, score)
+    return {
+        'score': float(min(max_score, budget_score + savings_score + net_worth_score)),
+        'budget_score': float(budget_score),
+        'savings_score': float(savings_score),
+        'net_worth_score': float(net_worth_score)
+    }
 
-def check_budget_limits_and_notify(user_id, new_transaction_amount=None, category_id=None):
-    """Check if any budget limits are exceeded and send email notifications"""
-    from email_service import send_budget_alert_email
+def get_financial_health_score(user_id):
+    """Calculate a simple financial health score based on various factors"""
+    return calculate_health_score_factors(user_id)['score']
+
+def refresh_financial_health_score(user_id):
+    """Recompute and store a user's health score, and record it as today's history entry"""
+    # Read the version first, so writes made during the computation leave the score stale
+    data_version = db.session.query(User.data_version).filter(User.id == user_id).scalar() or 0
+    factors = calculate_health_score_factors(user_id)
     
-    # Get current budget progress
-    budget_progress = get_budget_progress(user_id)
+    stored = db.session.get(FinancialHealthScore, user_id)
+    if stored is None:
+        stored = FinancialHealthScore(user_id=user_id)
+        db.session.add(stored)
+    for name, value in factors.items():
+        setattr(stored, name, value)
+    stored.data_version = data_version
+    
+    history = FinancialHealthScoreHistory.query.filter_by(user_id=user_id, score_date=date.today()).first()
+    if history is None:
+        history = FinancialHealthScoreHistory(user_id=user_id, score_date=date.today())
+        db.session.add(history)
+    for name, value in factors.items():
+        setattr(history, name, value)
+    
+    db.session.commit()
+    return stored
+
+def schedule_health_score_refresh(*user_ids):
+    """Queue a recomputation of each user's health score once their writes settle"""
+    delay = current_app.config['HEALTH_SCORE_DEBOUNCE_SECONDS']
+    # On its own connection: callers are after_commit hooks and read-only requests
+    with db.engine.begin() as conn:
+        for user_id in user_ids:
+            enqueue('refresh_health_score', user_id, delay=delay, dedupe_key=f'health_score:{user_id}',
+                    connection=conn)
+
+def get_stored_health_score(user_id, data_version=None):
+    """Read the precomputed health score row, computing it only if none exists yet.
+    
+    A score older than data_version is still returned, and a refresh is scheduled.
+    """
+    stored = db.session.get(FinancialHealthScore, user_id)
+    if stored is None:
+        return refresh_financial_health_score(user_id)
+    if data_version is not None and stored.data_version < data_version:
+        schedule_health_score_refresh(user_id)
+    return stored
+
+def get_health_score_history(user_id, days=90):
+    """Daily health scores for the last N days, oldest first"""
+    return FinancialHealthScoreHistory.query.filter(
+        and_(
+            FinancialHealthScoreHistory.user_id == user_id,
+            FinancialHealthScoreHistory.score_date >= date.today() - timedelta(days=days)
+        )
+    ).order_by(FinancialHealthScoreHistory.score_date).all()
+
+@event.listens_for(db.session, 'after_commit')
+def schedule_derived_data_refresh(session):
+    """Recompute derived data for users whose transactions, budgets, goals or accounts changed"""
+    user_ids = session.info.pop('changed_user_ids', ())
+    if user_ids:
+        schedule_health_score_refresh(*user_ids)
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_changed_users(session):
+    session.info.pop('changed_user_ids', None)
+    session.info.pop('budget_alerts', None)
+
+def _alert_level(spent, budget_amount):
+    """Highest BUDGET_ALERT_THRESHOLDS percentage of the budget that spent has reached, or 0"""
+    if not budget_amount or budget_amount <= 0:
+        return 0
+    return max((percent for percent in current_app.config['BUDGET_ALERT_THRESHOLDS']
+                if spent * 100 >= Decimal(str(budget_amount)) * percent), default=0)
+
+def _month_spent(conn, user_id, category_id, start_date, end_date):
+    """Base-currency expenses of a month in a category and its subcategories"""
+    spent = conn.execute(
+        select(func.sum(BASE_AMOUNT))
+        .select_from(Transaction)
+        .join(CategoryClosure, CategoryClosure.descendant_id == Transaction.category_id)
+        .where(
+            CategoryClosure.ancestor_id == category_id,
+            Transaction.user_id == user_id,
+            Transaction.transaction_type == 'expense',
+            Transaction.transaction_date >= start_date,
+            Transaction.transaction_date < end_date
+        )
+    ).scalar()
+    return Decimal(str(spent or 0))
+
+def _insert_ignoring_conflicts(conn, table, values):
+    """INSERT that does nothing when the primary key exists; returns the number of rows inserted"""
+    if conn.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif conn.dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return conn.execute(table.insert().values(**values)).rowcount
+    return conn.execute(insert(table).values(**values).on_conflict_do_nothing()).rowcount
+
+def _add_budget_spend(conn, user_id, budget, period_start, period_end, change):
+    """Add change to a budget's running spend for the month, creating it on the month's first write.
+    
+    Returns the (spent, alerted_percent) row after the change.
+    """
+    spend = BudgetSpend.__table__
+    add = spend.update().where(spend.c.budget_id == budget.id, spend.c.period_start == period_start).values(
+        spent=spend.c.spent + change
+    ).returning(spend.c.spent, spend.c.alerted_percent)
+    row = conn.execute(add).first()
+    if row is not None:
+        return row
+    
+    # Built from the month's rows, this write included; earlier months are no longer needed
+    spent = _month_spent(conn, user_id, budget.category_id, period_start, period_end)
+    alerted = _alert_level(spent - change, budget.amount)
+    conn.execute(spend.delete().where(spend.c.budget_id == budget.id, spend.c.period_start < period_start))
+    if _insert_ignoring_conflicts(conn, spend, {'budget_id': budget.id, 'period_start': period_start,
+                                                'spent': spent, 'alerted_percent': alerted}):
+        return spent, alerted
+    # Another transaction created it first, without this write
+    return conn.execute(add).first()
+
+def _queue_budget_alert(conn, session, user_id, budget, spent, percent):
+    email = conn.execute(select(User.email).where(User.id == user_id)).scalar()
+    category_name = conn.execute(select(Category.name).where(Category.id == budget.category_id)).scalar()
+    session.info.setdefault('budget_alerts', []).append(category_name)
+    if not email:
+        return
+    budget_info = {
+        'category_name': category_name,
+        'period': budget.period,
+        'start_date': budget.start_date.isoformat(),
+        'threshold_percent': percent
+    }
+    # Sent by a worker (tasks.send_budget_alert), which retries failed sends
+    enqueue('send_budget_alert', email, budget_info, float(spent), float(budget.amount), connection=conn)
+
+BUDGET_SPEND_FIELDS = ('user_id', 'category_id', 'transaction_date', 'transaction_type', 'amount', 'base_amount')
+track_previous_values(Transaction, BUDGET_SPEND_FIELDS)
+
+@event.listens_for(db.session, 'after_flush')
+def maintain_budget_spend(session, flush_context):
+    """Apply this month's expense writes to the running spend of the affected budgets and
+    queue an alert when one crosses a threshold, atomically with the write.
+    
+    Each write touches only the budgets on its category and the category's ancestors,
+    so the cost does not grow with the number of budgets a user has.
+    """
+    period_start, period_end = month_range()
+    spend = BudgetSpend.__table__
+    deltas = {}  # (user_id, category_id) -> change in this month's spending
+    stale = []  # conditions on budget_spend rows that no longer match their budget
     
-    # If a new transaction was just added, update the relevant budget progress
-    if new_transaction_amount and category_id:
-        for bp in budget_progress:
-            if bp['budget'].category_id == category_id:
-                bp['spent'] += new_transaction_amount
-                bp['progress_percent'] = float((bp['spent'] / bp['budget'].amount) * 100)
-                bp['is_over_budget'] = bp['spent'] > bp['budget'].amount
-                break
-    
-    # Check for budget overages and send notifications
-    user = User.query.get(user_id)
-    if not user or not user.email:
+    def add(values, sign):
+        user_id, category_id, transaction_date, transaction_type, amount, base_amount = values
+        if transaction_type != 'expense' or category_id is None or transaction_date is None:
+            return
+        if not period_start <= transaction_date < period_end:
+            return
+        change = Decimal(str(base_amount if base_amount is not None else amount or 0)) * sign
+        if change:
+            deltas[user_id, category_id] = deltas.get((user_id, category_id), Decimal('0')) + change
+    
+    for obj in session.new:
+        if isinstance(obj, Transaction):
+            add([getattr(obj, field) for field in BUDGET_SPEND_FIELDS], 1)
+    for obj in session.deleted:
+        if isinstance(obj, Transaction):
+            add([getattr(obj, field) for field in BUDGET_SPEND_FIELDS], -1)
+        elif isinstance(obj, Budget):
+            stale.append(spend.c.budget_id == obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, Transaction):
+            attrs = inspect(obj).attrs
+            if not any(attrs[field].history.has_changes() for field in BUDGET_SPEND_FIELDS):
+                continue
+            old = []
+            for field in BUDGET_SPEND_FIELDS:
+                history = attrs[field].history
+                old.append(history.deleted[0] if history.deleted else getattr(obj, field))
+            add(old, -1)
+            add([getattr(obj, field) for field in BUDGET_SPEND_FIELDS], 1)
+        elif isinstance(obj, Budget):
+            attrs = inspect(obj).attrs
+            if any(attrs[field].history.has_changes() for field in ('category_id', 'amount', 'is_active')):
+                stale.append(spend.c.budget_id == obj.id)
+        elif isinstance(obj, Category) and inspect(obj).attrs.parent_category_id.history.has_changes():
+            # The subtree a budget covers changed; drop the owner's counters (all of them for system categories)
+            owned = select(Budget.id)
+            if obj.user_id:
+                owned = owned.where(Budget.user_id == obj.user_id)
+            stale.append(spend.c.budget_id.in_(owned))
+    
+    if not (deltas or stale):
         return
+    conn = session.connection()
+    for condition in stale:
+        conn.execute(spend.delete().where(condition))
     
-    notifications_sent = []
-    for bp in budget_progress:
-        if bp['is_over_budget']:
-            # Check if we've already sent a notification for this budget this month
-            # In a real app, you'd store notification history in the database
-            budget_info = {
-                'category_name': bp['budget'].category.name,
-                'period': bp['budget'].period,
-                'start_date': bp['budget'].start_date
-            }
-            
-            try:
-                success = send_budget_alert_email(
-                    user.email,
-                    budget_info,
-                    float(bp['spent']),
-                    float(bp['budget'].amount)
-                )
-                
-                if success:
-                    notifications_sent.append(budget_info['category_name'])
-                    
-            except Exception as e:
-                print(f"Error sending budget notification: {str(e)}")
+    # Summed per budget first: a counter created lazily is read from every row of this flush,
+    # so it must take all of the flush's changes to it at once
+    budget_changes = {}  # budget id -> [user_id, budget, change]
+    for (user_id, category_id), change in deltas.items():
+        budgets = conn.execute(
+            select(Budget.id, Budget.category_id, Budget.amount, Budget.period, Budget.start_date)
+            .join(CategoryClosure, CategoryClosure.ancestor_id == Budget.category_id)
+            .where(
+                CategoryClosure.descendant_id == category_id,
+                Budget.user_id == user_id,
+                Budget.is_active == True
+            )
+        ).all()
+        for budget in budgets:
+            budget_changes.setdefault(budget.id, [user_id, budget, Decimal('0')])[2] += change
     
-    return notifications_sent
+    for user_id, budget, change in budget_changes.values():
+        if not change:
+            continue
+        spent, alerted = _add_budget_spend(conn, user_id, budget, period_start, period_end, change)
+        spent = Decimal(str(spent))
+        level = _alert_level(spent, budget.amount)
+        if level == alerted:
+            continue
+        # Falling back below a threshold re-arms it; crossing one upwards alerts once
+        conn.execute(spend.update().where(
+            spend.c.budget_id == budget.id, spend.c.period_start == period_start
+        ).values(alerted_percent=level))
+        if level > alerted and level > _alert_level(spent - change, budget.amount):
+            _queue_budget_alert(conn, session, user_id, budget, spent, level)
+
+def pop_budget_alerts():
+    """Names of the categories whose budget alerts were queued by this session's writes"""
+    return db.session.info.pop('budget_alerts', [])
+
+def rebuild_budget_spend(user_id):
+    """Recompute the current month's running spend of a user's active budgets, without sending alerts"""
+    period_start, period_end = month_range()
+    spend = BudgetSpend.__table__
+    conn = db.session.connection()
+    budgets = Budget.query.filter_by(user_id=user_id, is_active=True).all()
+    conn.execute(spend.delete().where(spend.c.budget_id.in_(select(Budget.id).where(Budget.user_id == user_id))))
+    rows = []
+    for budget in budgets:
+        spent = _month_spent(conn, user_id, budget.category_id, period_start, period_end)
+        rows.append({'budget_id': budget.id, 'period_start': period_start, 'spent': spent,
+                     'alerted_percent': _alert_level(spent, budget.amount)})
+    if rows:
+        conn.execute(spend.insert(), rows)
+    db.session.commit()
+    return len(rows)
 
 def get_budget_overage_summary(user_id):
     """Get summary of budget overages for the current month"""
@@ -287,3 +1241,216 @@ def get_budget_overage_summary(user_id):
         'total_overage': total_overage,
         'categories_over_budget': len(overages)
     }
+
+def parse_tag_names(raw_tags):
+    """Split a comma-separated (or legacy JSON list) tag string into normalized, unique tag names"""
+    if not raw_tags:
+        return []
+    
+    raw_tags = raw_tags.strip()
+    if raw_tags.startswith('['):
+        try:
+            parts = [str(part) for part in json.loads(raw_tags)]
+        except ValueError:
+            parts = raw_tags.strip('[]').split(',')
+    else:
+        parts = raw_tags.split(',')
+    
+    names = []
+    for part in parts:
+        name = part.strip().strip('"\'#').strip().lower()[:50]
+        if name and name not in names:
+            names.append(name)
+    return names
+
+def get_or_create_tags(user_id, names):
+    """Return Tag rows for the given normalized names, creating the missing ones"""
+    if not names:
+        return []
+    
+    existing = {tag.name: tag for tag in Tag.query.filter(
+        and_(
+            Tag.user_id == user_id,
+            Tag.name.in_(names)
+        )
+    ).all()}
+    
+    tags = []
+    for name in names:
+        tag = existing.get(name)
+        if not tag:
+            tag = Tag(user_id=user_id, name=name)
+            db.session.add(tag)
+            existing[name] = tag
+        tags.append(tag)
+    return tags
+
+def set_transaction_tags(transaction, raw_tags):
+    """Replace a transaction's tags with the ones parsed from a comma-separated string"""
+    transaction.tags = get_or_create_tags(transaction.user_id, parse_tag_names(raw_tags))
+
+def format_tags(transaction):
+    """Render a transaction's tags back to the comma-separated form used by TransactionForm"""
+    return ', '.join(tag.name for tag in transaction.tags)
+
+def get_user_tags(user_id):
+    """Get all tags for a user, alphabetically"""
+    return Tag.query.filter_by(user_id=user_id).order_by(Tag.name).all()
+
+EXPORT_FIELDS = ('date', 'description', 'type', 'amount', 'currency', 'category', 'account', 'payment_method',
+                 'tags', 'notes')
+
+def iter_transactions_for_export(user_id, start_date=None, end_date=None):
+    """Rows for a transaction export, oldest first: archived years from their files, then the table"""
+    category_names = dict(db.session.query(Category.id, Category.name).filter(
+        (Category.user_id == user_id) | (Category.is_system == True)
+    ).all())
+    accounts = {account.id: account for account in Account.query.filter_by(user_id=user_id)}
+    
+    def export_row(values, tags):
+        account = accounts.get(values['account_id'])
+        return {
+            'date': values['transaction_date'].isoformat(),
+            'description': values['description'],
+            'type': values['transaction_type'],
+            'amount': values['amount'],
+            'currency': account.currency if account else None,
+            'category': category_names.get(values['category_id']),
+            'account': account.name if account else None,
+            'payment_method': values['payment_method'],
+            'tags': ', '.join(tags),
+            'notes': values['notes'],
+        }
+    
+    for row in iter_archived_transactions(user_id, start_date, end_date):
+        yield export_row(row, row['tags'])
+    
+    query = Transaction.query.filter(Transaction.user_id == user_id)
+    if start_date:
+        query = query.filter(Transaction.transaction_date >= start_date)
+    if end_date:
+        query = query.filter(Transaction.transaction_date <= end_date)
+    for transaction in query.order_by(Transaction.transaction_date, Transaction.id).yield_per(500):
+        values = {field: getattr(transaction, field) for field in (
+            'transaction_date', 'description', 'transaction_type', 'amount', 'account_id', 'category_id',
+            'payment_method', 'notes')}
+        yield export_row(values, [tag.name for tag in transaction.tags])
+
+@replica_reads
+def get_spending_by_tag(user_id, start_date=None, end_date=None):
+    """Get expense totals per tag, aggregated in the database"""
+    if not start_date:
+        today = date.today()
+        start_date = date(today.year, today.month, 1)
+    if not end_date:
+        end_date = date.today()
+    
+    query = db.session.query(
+        Tag.name,
+        func.count(Transaction.id).label('count'),
+        func.sum(BASE_AMOUNT).label('total')
+    ).join(transaction_tags, transaction_tags.c.tag_id == Tag.id)\
+    .join(Transaction, Transaction.id == transaction_tags.c.transaction_id)\
+    .filter(
+        and_(
+            Tag.user_id == user_id,
+            Transaction.transaction_type == 'expense',
+            Transaction.transaction_date >= start_date,
+            Transaction.transaction_date <= end_date
+        )
+    ).group_by(Tag.id, Tag.name)\
+    .order_by(func.sum(BASE_AMOUNT).desc())
+    
+    return query.all()
+
+# Entities returned by /api/sync and the fields sent for each
+SYNC_ENTITIES = {
+    'accounts': (Account, ['name', 'account_type', 'balance', 'currency', 'is_active']),
+    'transactions': (Transaction, ['account_id', 'category_id', 'amount', 'base_amount', 'description',
+                                   'transaction_date', 'transaction_type', 'payment_method', 'notes',
+                                   'is_recurring']),
+    'budgets': (Budget, ['category_id', 'amount', 'period', 'start_date', 'end_date', 'is_active']),
+    'goals': (SavingsGoal, ['name', 'target_amount', 'current_amount', 'target_date', 'description',
+                            'is_achieved', 'account_id', 'category_id']),
+    'bills': (Bill, ['name', 'amount', 'due_date', 'frequency', 'category_id', 'is_paid', 'auto_pay', 'notes']),
+}
+
+@event.listens_for(db.session, 'before_flush')
+def touch_retagged_transactions(session, flush_context, instances):
+    """Stamp updated_at of transactions whose tag set changed: only transaction_tags is written
+    then, and /api/sync finds changed transactions by updated_at"""
+    for obj in session.dirty:
+        if isinstance(obj, Transaction) and inspect(obj).attrs.tags.history.has_changes():
+            obj.updated_at = datetime.now()
+
+# Rows stamped just before a sync may commit just after it; re-sending this window
+# on the next sync is harmless because clients upsert by id
+SYNC_OVERLAP = timedelta(seconds=30)
+
+def encode_sync_token(watermark):
+    """Encode a sync watermark as an opaque token"""
+    return base64.urlsafe_b64encode(watermark.isoformat().encode()).decode().rstrip('=')
+
+def decode_sync_token(token):
+    """Decode a token from encode_sync_token, raising ValueError if it is malformed"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        return datetime.fromisoformat(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (TypeError, UnicodeDecodeError, base64.binascii.Error) as e:
+        raise ValueError(f"Invalid sync token: {e}")
+
+def _serialize_row(row, fields):
+    data = {'id': row.id}
+    for field in fields:
+        value = getattr(row, field)
+        if isinstance(value, Decimal):
+            value = float(value)
+        elif isinstance(value, (date, datetime)):
+            value = value.isoformat()
+        data[field] = value
+    return data
+
+def record_deletion(user_id, entity, entity_id):
+    """Leave a tombstone for a hard delete; call before committing the delete"""
+    db.session.add(SyncTombstone(user_id=user_id, entity=entity, entity_id=entity_id))
+
+def get_changes_since(user_id, since=None):
+    """Get rows created, updated or deleted since a watermark, for delta sync.
+    
+    Each entity is one range scan on its (user_id, updated_at) index, so the cost
+    follows the amount of change rather than the size of the history. Without a
+    watermark everything is returned. Returns the changes and the next watermark.
+    """
+    watermark = datetime.now()
+    window_start = since - SYNC_OVERLAP if since else None
+    changes = {}
+    
+    for entity, (model, fields) in SYNC_ENTITIES.items():
+        query = model.query.filter(model.user_id == user_id)
+        if window_start:
+            query = query.filter(model.updated_at >= window_start)
+        
+        created, updated = [], []
+        for row in query.order_by(model.updated_at, model.id).all():
+            data = _serialize_row(row, fields)
+            if entity == 'transactions':
+                data['tags'] = [tag.name for tag in row.tags]
+            if window_start and row.created_at and row.created_at < window_start:
+                updated.append(data)
+            else:
+                created.append(data)
+        
+        deleted = []
+        if window_start:
+            deleted = [row.entity_id for row in db.session.query(SyncTombstone.entity_id).filter(
+                and_(
+                    SyncTombstone.user_id == user_id,
+                    SyncTombstone.entity == entity,
+                    SyncTombstone.deleted_at >= window_start
+                )
+            ).all()]
+        
+        if created or updated or deleted:
+            changes[entity] = {'created': created, 'updated': updated, 'deleted': deleted}
+    
+    return changes, watermark
@@ -1,25 +1,22 @@
 import os
 import json
+import hashlib
+import time
 from openai import OpenAI
 from datetime import datetime, date
 from decimal import Decimal
 from flask import current_app
+from sqlalchemy.exc import IntegrityError
 from models import Transaction, Account, Category
-from app import db
+from app import app, db
+from cache import TTLCache, SingleFlight
+from ratelimit import TokenBucketLimiter
+from audio import SpooledUpload, preprocess, record_request
+from categorizer import categorize
+from metrics import track_call
 
-# Initialize OpenAI client
-openai_client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
-
-def process_voice_transaction(user_id, audio_transcript):
-    """Process voice input and extract transaction details using OpenAI"""
-    try:
-        # Use OpenAI to extract transaction details from voice input
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",  # the newest OpenAI model is "gpt-4o" which was released May 13, 2024. do not change this unless explicitly requested by the user
-            messages=[
-                {
-                    "role": "system",
-                    "content": """You are a financial assistant that extracts transaction details from voice input.
+# System prompt of the transaction extraction call; its lines keep the indentation it has always been sent with
+EXTRACTION_PROMPT = """You are a financial assistant that extracts transaction details from voice input.
                     
                     Extract the following information from the user's voice input:
                     - amount: The monetary amount (as a number, no currency symbols)
@@ -52,15 +49,127 @@ def process_voice_transaction(user_id, audio_transcript):
                     
                     If you cannot extract clear transaction information, set confidence to 0.
                     """
-                },
-                {
-                    "role": "user",
-                    "content": f"Extract transaction details from: {audio_transcript}"
+
+# Initialize OpenAI client
+openai_client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+
+# Repeated uploads of the same recording share one transcription and parse
+_in_flight = SingleFlight()
+_recent_results = TTLCache(max_entries=1000, name='voice_results')
+voice_limiter = TokenBucketLimiter(
+    rate=app.config['VOICE_RATE_LIMIT_PER_MINUTE'] / 60,
+    burst=app.config['VOICE_RATE_LIMIT_BURST']
+)
+
+class VoiceRateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f'Voice rate limit exceeded, retry in {retry_after:.0f}s')
+        self.retry_after = retry_after
+
+def _transaction_summary(transaction):
+    return {
+        'id': transaction.id,
+        'amount': float(transaction.amount),
+        'description': transaction.description,
+        'type': transaction.transaction_type,
+        'category': transaction.category.name if transaction.category else 'Uncategorized',
+        'account': transaction.account.name,
+        'date': transaction.transaction_date.strftime('%Y-%m-%d')
+    }
+
+def handle_voice_upload(user_id, audio_file):
+    """Transcribe a voice upload and record its transaction once, however often it is sent.
+    
+    Uploads are keyed by the user and a hash of the audio. A repeat within
+    VOICE_RESULT_CACHE_SECONDS gets the earlier result, one arriving while the first
+    is still being processed waits for it, and the key is stored as the transaction's
+    idempotency key so other worker processes never insert it twice. Only uploads
+    that reach OpenAI spend a token from the user's bucket; VoiceRateLimited is
+    raised when it is empty. audio.AudioRejected is raised for unusable recordings.
+    """
+    started = time.monotonic()
+    upload = SpooledUpload(
+        audio_file.stream,
+        threshold=app.config['VOICE_SPOOL_BYTES'],
+        max_bytes=app.config['VOICE_MAX_UPLOAD_BYTES'],
+        hasher=hashlib.sha256(user_id.encode() + b'\0')
+    )
+    try:
+        digest = upload.hasher.hexdigest()
+        key = (user_id, digest)
+        cached = _recent_results.get(key)
+        if cached is not None:
+            return dict(cached, duplicate=True)
+        
+        idempotency_key = f'voice:{digest[:58]}'
+        
+        def process():
+            existing = Transaction.query.filter_by(user_id=user_id, idempotency_key=idempotency_key).first()
+            if existing is not None:
+                return {
+                    'success': True,
+                    'duplicate': True,
+                    'message': 'This recording was already added',
+                    'transaction': _transaction_summary(existing)
                 }
-            ],
-            response_format={"type": "json_object"},
-            temperature=0.1
-        )
+            
+            preprocess_started = time.monotonic()
+            audio = None
+            if app.config['VOICE_PREPROCESS']:
+                audio = preprocess(upload, app.config['VOICE_MAX_SECONDS'], app.config['VOICE_SILENCE_DB'])
+            preprocess_seconds = time.monotonic() - preprocess_started
+            
+            # Charged only now: a recording rejected above never reaches OpenAI
+            retry_after = voice_limiter.try_acquire(user_id)
+            if retry_after:
+                raise VoiceRateLimited(retry_after)
+            
+            transcribe_started = time.monotonic()
+            if audio is not None:
+                transcription = transcribe_audio(audio)
+            else:
+                with upload.open() as original:
+                    transcription = transcribe_audio((audio_file.filename, original, audio_file.mimetype))
+            transcribe_seconds = time.monotonic() - transcribe_started
+            
+            if transcription['success']:
+                result = process_voice_transaction(user_id, transcription['transcript'], idempotency_key)
+                result['transcript'] = transcription['transcript']
+                # Errors are not cached so a retry can succeed; a confident or unclear parse is final
+                if result['success'] or 'confidence' in result:
+                    _recent_results.set(key, result, app.config['VOICE_RESULT_CACHE_SECONDS'])
+            else:
+                result = transcription
+            
+            record_request(audio is not None, upload.size, len(audio[1]) if audio is not None else upload.size,
+                           preprocess_seconds, transcribe_seconds, time.monotonic() - started)
+            return result
+        
+        result, shared = _in_flight.do(key, process)
+        return dict(result, duplicate=True) if shared else result
+    finally:
+        upload.close()
+
+def process_voice_transaction(user_id, audio_transcript, idempotency_key=None):
+    """Process voice input and extract transaction details using OpenAI"""
+    try:
+        # Use OpenAI to extract transaction details from voice input
+        with track_call('openai', 'chat'):
+            response = openai_client.chat.completions.create(
+                model="gpt-4o",  # the newest OpenAI model is "gpt-4o" which was released May 13, 2024. do not change this unless explicitly requested by the user
+                messages=[
+                    {
+                        "role": "system",
+                        "content": EXTRACTION_PROMPT
+                    },
+                    {
+                        "role": "user",
+                        "content": f"Extract transaction details from: {audio_transcript}"
+                    }
+                ],
+                response_format={"type": "json_object"},
+                temperature=0.1
+            )
         
         # Parse the response
         transaction_data = json.loads(response.choices[0].message.content)
@@ -88,8 +197,9 @@ def process_voice_transaction(user_id, audio_transcript):
                 account = acc
                 break
         
-        # Find the category
-        category = Category.query.filter(
+        # The user's and system rules take the description first; the model's guess is the fallback
+        category_id = categorize(user_id, transaction_data['description'], transaction_data['transaction_type'])
+        category = db.session.get(Category, category_id) if category_id else Category.query.filter(
             ((Category.user_id == user_id) | (Category.is_system == True)) &
             (Category.name.ilike(f"%{transaction_data['category']}%")) &
             (Category.type == transaction_data['transaction_type'])
@@ -104,51 +214,52 @@ def process_voice_transaction(user_id, audio_transcript):
                 type=transaction_data['transaction_type']
             ).first()
         
-        # Create the transaction
-        transaction = Transaction(
-            user_id=user_id,
-            account_id=account.id,
-            category_id=category.id if category else None,
-            amount=Decimal(str(transaction_data['amount'])),
-            description=transaction_data['description'],
-            transaction_date=date.today(),
-            transaction_type=transaction_data['transaction_type'],
-            payment_method='voice_input',
-            notes=f'Added via voice assistant (confidence: {transaction_data["confidence"]:.1%})'
-        )
-        
-        db.session.add(transaction)
-        db.session.commit()
+        # Only a resent recording (its idempotency key) is a duplicate: a matching fingerprint may well be
+        # a daily repeat such as a fare, and voice input has no "Add anyway" to confirm one
+        amount = Decimal(str(transaction_data['amount']))
+        transaction = Transaction.query.filter_by(user_id=user_id, idempotency_key=idempotency_key).first() \
+            if idempotency_key else None
+        duplicate = transaction is not None
         
-        # Check budget limits for expenses
-        if transaction_data['transaction_type'] == 'expense' and category:
-            from utils import check_budget_limits_and_notify
+        if transaction is None:
+            # Create the transaction
+            transaction = Transaction(
+                user_id=user_id,
+                account_id=account.id,
+                category_id=category.id if category else None,
+                amount=amount,
+                description=transaction_data['description'],
+                transaction_date=date.today(),
+                transaction_type=transaction_data['transaction_type'],
+                payment_method='voice_input',
+                notes=f'Added via voice assistant (confidence: {transaction_data["confidence"]:.1%})',
+                idempotency_key=idempotency_key
+            )
+            
+            from utils import apply_base_amount
+            apply_base_amount(transaction)
+            db.session.add(transaction)
             try:
-                notifications_sent = check_budget_limits_and_notify(
-                    user_id,
-                    Decimal(str(transaction_data['amount'])),
-                    category.id
-                )
-                budget_alert = len(notifications_sent) > 0
-            except:
-                budget_alert = False
-        else:
-            budget_alert = False
+                db.session.commit()
+            except IntegrityError:
+                # Another worker process saved the same recording first
+                db.session.rollback()
+                transaction = Transaction.query.filter_by(user_id=user_id, idempotency_key=idempotency_key).first()
+                if transaction is None:
+                    raise
+                duplicate = True
+        
+        # Budget alerts for thresholds this expense crossed were queued by the commit
+        from utils import pop_budget_alerts
+        budget_alert = bool(pop_budget_alerts())
         
         return {
             'success': True,
-            'message': f'Transaction added: {transaction_data["transaction_type"]} of ${transaction_data["amount"]:.2f} for {transaction_data["description"]}',
-            'transaction': {
-                'id': transaction.id,
-                'amount': float(transaction.amount),
-                'description': transaction.description,
-                'type': transaction.transaction_type,
-                'category': category.name if category else 'Uncategorized',
-                'account': account.name,
-                'date': transaction.transaction_date.strftime('%Y-%m-%d')
-            },
+            'message': 'This transaction was already added' if duplicate else f'Transaction added: {transaction_data["transaction_type"]} of ${transaction_data["amount"]:.2f} for {transaction_data["description"]}',
+            'transaction': _transaction_summary(transaction),
             'confidence': transaction_data['confidence'],
-            'budget_alert': budget_alert
+            'budget_alert': budget_alert,
+            'duplicate': duplicate
         }
         
     except json.JSONDecodeError as e:
@@ -165,14 +276,15 @@ def process_voice_transaction(user_id, audio_transcript):
         }
 
 def transcribe_audio(audio_file):
-    """Transcribe audio file using OpenAI Whisper"""
+    """Transcribe audio using OpenAI Whisper; audio_file is a file or a (filename, bytes, content type) tuple"""
     try:
         # Use OpenAI Whisper for transcription
-        transcript = openai_client.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio_file,
-            language="en"
-        )
+        with track_call('openai', 'transcription'):
+            transcript = openai_client.audio.transcriptions.create(
+                model="whisper-1",
+                file=audio_file,
+                language="en"
+            )
         return {
             'success': True,
             'transcript': transcript.text